@@ -1,15 +1,24 @@
 import numpy as np
-from hmmlearn import hmm
+from collections import deque
+from scipy.special import logsumexp
 
 
+def normalize_observation(observation_probs):
+    """
+    Scale observation probabilities to sum to 1 (along the last axis). An all-zero observation carries no
+    information and becomes uniform instead of NaN.
+    """
+    total = observation_probs.sum(axis=-1, keepdims=True)
+    return np.where(total > 0, observation_probs / np.where(total > 0, total, 1), 1 / observation_probs.shape[-1])
 
 
 class GestureFilteringHMM:
-    def __init__(self, num_states, start_neg_prob=0.5, trans_self_prob=0.9, emit_self_prob=0.9):
+    def __init__(self, num_states, start_neg_prob=0.5, trans_self_prob=0.9, emit_self_prob=0.9, history_size=1000):
         """
         Initialize the HMM model.
         
         :param num_states: Number of hidden states (e.g., gestures)
+        :param history_size: Number of most likely states that are kept
         :param start_prob: Initial state probabilities (array of size num_states)
         :param trans_prob: Transition probability matrix (size num_states x num_states)
         :param emit_prob: Emission probability matrix (size num_states x num_classes)
@@ -25,7 +34,7 @@ class GestureFilteringHMM:
         assert self.emit_prob.sum(axis=1).all() == 1, "Emission probabilities must sum to 1"
         #print(self.emit_prob)
         self.current_belief = self.start_prob.copy()  # Initialize belief state
-        self.most_likely_sequence = []  # Sequence of most likely states
+        self.most_likely_sequence = deque(maxlen=history_size)  # Sequence of most likely states
         
     def _initialize_transition_matrix(self, same_prob = 0.9):
         """
@@ -79,8 +88,7 @@ class GestureFilteringHMM:
         observation_probs = observation_probs.squeeze()
         assert observation_probs.ndim == 1, "Observation probabilities must be a 1D array"
         
-        if observation_probs.sum() != 1:
-            observation_probs = observation_probs / observation_probs.sum()
+        observation_probs = normalize_observation(observation_probs)
         #print("Raw", observation_probs)
         
         # Compute updated belief state (Bayesian filtering)
@@ -97,13 +105,161 @@ class GestureFilteringHMM:
         #print("Updated", self.current_belief)
         return self.current_belief
 
+    def load_parameters(self, path):
+        """
+        Load start, transition and emission probabilities fitted with hmm_fitting.py.
+        
+        :param path: Path to the .npz matrix file
+        """
+        params = np.load(path)
+        assert params["trans_prob"].shape == (self.num_states, self.num_states), f"Matrix file does not match {self.num_states} states"
+        self.start_prob = params["start_prob"]
+        self.trans_prob = params["trans_prob"]
+        self.emit_prob = params["emit_prob"]
+        self.current_belief = self.start_prob.copy()
+
+    def _log_emission(self, observation_probs):
+        """
+        Log emission likelihoods for a batch of observation probabilities.
+        
+        :param observation_probs: Array of observation probabilities (size ... x num_classes)
+        :return: Log likelihood of every state for every observation (size ... x num_states)
+        """
+        observation_probs = normalize_observation(observation_probs)
+        with np.errstate(divide="ignore"):
+            return np.log(observation_probs @ self.emit_prob.T)
+
+    def forward_log(self, observation_probs, initial_belief=None):
+        """
+        Run the forward filter in log space over whole sequences without touching the belief state.
+        
+        :param observation_probs: Observation probabilities of shape (T, num_classes) or (B, T, num_classes)
+        :param initial_belief: Belief before the first observation (size num_states), defaults to the start probabilities
+        :return: Normalized log beliefs with the same leading shape as the observations (... x num_states)
+        """
+        observation_probs = np.asarray(observation_probs, dtype=float)
+        assert observation_probs.ndim in (2, 3), "Observation probabilities must be of shape (T, K) or (B, T, K)"
+        single_sequence = observation_probs.ndim == 2
+        if single_sequence:
+            observation_probs = observation_probs[None]
+        
+        if initial_belief is None:
+            initial_belief = self.start_prob
+        
+        with np.errstate(divide="ignore"):
+            log_trans = np.log(self.trans_prob)
+            log_belief = np.log(np.asarray(initial_belief, dtype=float))
+        log_emission = self._log_emission(observation_probs)
+        
+        batch_size, seq_len, _ = observation_probs.shape
+        log_belief = np.broadcast_to(log_belief, (batch_size, self.num_states))
+        log_beliefs = np.empty((batch_size, seq_len, self.num_states))
+        for t in range(seq_len):
+            # log(trans_prob @ belief), vectorized over the batch
+            log_belief = logsumexp(log_trans[None, :, :] + log_belief[:, None, :], axis=2) + log_emission[:, t]
+            log_belief = log_belief - logsumexp(log_belief, axis=1, keepdims=True)
+            log_beliefs[:, t] = log_belief
+        
+        if single_sequence:
+            return log_beliefs[0]
+        return log_beliefs
+
+    def update_sequence(self, observation_probs):
+        """
+        Update the belief state with a whole sequence of observations at once, e.g. when several windows arrive together.
+        Produces the same beliefs as calling update for every row, but runs in log space.
+        
+        :param observation_probs: Array of observation probabilities (size T x num_classes)
+        :return: Belief states after every observation (size T x num_states)
+        """
+        observation_probs = np.asarray(observation_probs, dtype=float)
+        assert observation_probs.ndim == 2, "Observation probabilities must be a 2D array"
+        if observation_probs.shape[0] == 0:
+            return np.empty((0, self.num_states))
+        
+        beliefs = np.exp(self.forward_log(observation_probs, initial_belief=self.current_belief))
+        self.current_belief = beliefs[-1] / beliefs[-1].sum()
+        self.most_likely_sequence.extend(np.argmax(beliefs, axis=1).tolist())
+        return beliefs
+
     def get_most_likely_sequence(self):
         """
         Get the most likely sequence of states.
         
         :return: List of most likely states
         """
-        return self.most_likely_sequence
+        return list(self.most_likely_sequence)
+
+
+class FixedLagSmoother:
+    def __init__(self, hmm, lag=3):
+        """
+        Fixed-lag smoother on top of a GestureFilteringHMM. Every belief is refined with the
+        observations of the following lag windows before a decision is emitted, which trades
+        a latency of lag windows for more stable outputs. Memory is bounded by the lag.
+        
+        :param hmm: GestureFilteringHMM used for the forward filtering
+        :param lag: Number of windows a decision is delayed
+        """
+        self.hmm = hmm
+        self.lag = lag
+        self.beliefs = deque(maxlen=lag + 1)  # Filtered beliefs of the last lag+1 windows
+        self.emissions = deque(maxlen=lag)  # Emission likelihoods of the last lag windows
+        self.n_updates = 0
+        self.n_emitted = 0
+
+    def _smooth(self, position):
+        """
+        Combine the filtered belief at a ring position with a backward pass over the later emissions.
+        
+        :param position: Position of the belief in the ring
+        :return: Smoothed belief state (array of size num_states)
+        """
+        n_later = len(self.beliefs) - 1 - position
+        later_emissions = list(self.emissions)[len(self.emissions) - n_later:] if n_later > 0 else []
+        
+        backward = np.ones(self.hmm.num_states)
+        for emission in reversed(later_emissions):
+            backward = self.hmm.trans_prob.T @ (emission * backward)
+            backward = backward / backward.sum()
+        
+        smoothed = self.beliefs[position] * backward
+        return smoothed / smoothed.sum()
+
+    def update(self, observation_probs):
+        """
+        Filter a new observation and emit the smoothed decision whose lag has expired.
+        
+        :param observation_probs: Array of observation probabilities (size num_classes)
+        :return: Tuple of (window index, smoothed belief state) or None while the lag is not filled yet
+        """
+        observation_probs = np.array(observation_probs).squeeze()
+        belief = self.hmm.update(observation_probs)
+        
+        self.beliefs.append(belief)
+        if self.lag > 0:
+            self.emissions.append(self.hmm.emit_prob @ normalize_observation(observation_probs))
+        self.n_updates += 1
+        
+        if self.n_updates - self.n_emitted <= self.lag:
+            return None
+        
+        smoothed = self._smooth(0)
+        self.n_emitted += 1
+        return self.n_emitted - 1, smoothed
+
+    def flush(self):
+        """
+        Emit the decisions that are still waiting for their lag, e.g. at the end of a recording.
+        
+        :return: List of (window index, smoothed belief state)
+        """
+        n_pending = self.n_updates - self.n_emitted
+        results = []
+        for position in range(len(self.beliefs) - n_pending, len(self.beliefs)):
+            results.append((self.n_emitted, self._smooth(position)))
+            self.n_emitted += 1
+        return results
 
 def test_gesture_filtering_hmm():
     """
@@ -147,10 +303,28 @@ def test_gesture_filtering_hmm():
     hmm.emit_prob[0,8] += hmm.emit_prob[8,8]
     hmm.emit_prob[8,8] = 0
 
+    start_belief = hmm.current_belief.copy()
+
     # Run through observations and test updates
+    beliefs = []
     for t, obs in enumerate(observations):
         belief_state = hmm.update(obs)
+        beliefs.append(belief_state)
         print(f"Timestep {t + 1}: Belief state = {belief_state}, Predicted state = {np.argmax(belief_state)}")
+    
+    # The log-space sequence filter must agree with the step-by-step updates
+    sequence_beliefs = np.exp(hmm.forward_log(observations, initial_belief=start_belief))
+    assert np.allclose(sequence_beliefs, np.array(beliefs)), "Sequence filter does not match step-by-step updates"
+    batch_beliefs = np.exp(hmm.forward_log(np.stack([observations, observations]), initial_belief=start_belief))
+    assert np.allclose(batch_beliefs, np.array(beliefs)[None]), "Batched sequence filter does not match step-by-step updates"
+    
+    # Every window gets exactly one smoothed decision
+    smoother = FixedLagSmoother(GestureFilteringHMM(num_states), lag=3)
+    smoother.hmm.trans_prob, smoother.hmm.emit_prob = hmm.trans_prob, hmm.emit_prob
+    decisions = [smoother.update(obs) for obs in observations]
+    decisions = [decision for decision in decisions if decision is not None] + smoother.flush()
+    assert [idx for idx, _ in decisions] == list(range(len(observations))), "Smoother must emit every decision once"
+    print(f"Smoothed states: {[int(np.argmax(belief)) for _, belief in decisions]}")
 
 
 
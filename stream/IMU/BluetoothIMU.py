@@ -6,15 +6,70 @@ import threading
 from collections import deque
 from collections import defaultdict
 from PPG.wristband_listener import DataBuffer
+from IMU.calibration import IMUCalibration
+from IMU.link_statistics import LinkStatistics
+from clock_sync import ClockDriftEstimator, UniformResampler
+from ring_buffer import SampleRingBuffer
+from session_recorder import SessionRecorder
 from ahrs.filters import Madgwick
 
 SAMPLES_PER_PACKAGE = 8
+IMU_FIELDS = ["acc_x", "acc_y", "acc_z", "gyro_x", "gyro_y", "gyro_z", "timestamp", "timestamp_computer"]
+N_SAMPLE_FIELDS = 7  # acc xyz, gyro xyz, timestamp
+PACKAGE_PREFIX = b"Package count: "
 save_path = r"C:\Users\lhauptmann\Code\WristPPG2\data"
 
 
+def parse_imu_lines(lines, current_package=-1):
+    """
+    Parse complete lines received from the IMU receiver in one vectorized step.
+    
+    :param lines: List of raw lines (bytes, without the newline)
+    :param current_package: Package count before the first line
+    :return: samples (N x 7 array), package of every sample (N), package counts and status messages in the order received
+    """
+    sample_lines = []
+    sample_packages = []
+    packages = []
+    messages = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith(PACKAGE_PREFIX):
+            try:
+                current_package = int(line[len(PACKAGE_PREFIX):])
+                packages.append(current_package)
+            except ValueError:
+                messages.append(line.decode('utf-8', errors='replace'))
+        elif line.count(b"\t") == N_SAMPLE_FIELDS - 1:
+            sample_lines.append(line)
+            sample_packages.append(current_package)
+        else:
+            messages.append(line.decode('utf-8', errors='replace'))
+    
+    if not sample_lines:
+        return np.empty((0, N_SAMPLE_FIELDS)), np.empty(0, dtype=int), packages, messages
+    
+    try:
+        samples = np.array(b"\t".join(sample_lines).split(b"\t"), dtype=float).reshape(-1, N_SAMPLE_FIELDS)
+    except ValueError:
+        # corrupted line somewhere in the chunk, fall back to parsing line by line
+        valid = []
+        for i, line in enumerate(sample_lines):
+            try:
+                valid.append((i, [float(v) for v in line.split(b"\t")]))
+            except ValueError:
+                messages.append(line.decode('utf-8', errors='replace'))
+        samples = np.array([values for _, values in valid], dtype=float).reshape(-1, N_SAMPLE_FIELDS)
+        sample_packages = [sample_packages[i] for i, _ in valid]
+    
+    return samples, np.array(sample_packages, dtype=int), packages, messages
+
+
 
 class DataBuffer:
-    def __init__(self, n_channels=8, frame_rate=128, plotting_window=5, csv_window=2, fileindex=0, save_dir = None):
+    def __init__(self, n_channels=8, frame_rate=128, plotting_window=5, csv_window=2, fileindex=0, save_dir = None, device_name=None):
         
         # timestamp = time.strftime("%Y%m%d-%H%M%S")
         # self.filename = f"..//recordings//ppg_data_{timestamp}"
@@ -22,53 +77,58 @@ class DataBuffer:
             self.save_dir = save_path
         else:
             self.save_dir = save_dir
-        self.filename = os.path.join(self.save_dir, f"imu_{fileindex:03d}")
+        prefix = f"imu_{device_name}" if device_name else "imu"
+        self.filename = os.path.join(self.save_dir, f"{prefix}_{fileindex:03d}")
 
         self.plotting_winoow = plotting_window
         self.csv_window = csv_window
         self.frame_rate = frame_rate
 
-        self.buffers = [deque(maxlen=int((plotting_window+1)*frame_rate + 1)) for _ in range(n_channels)]
-        self.csv_buffers = [deque(maxlen=int((csv_window+1)*frame_rate+1)) for _ in range(n_channels)]
-        self.new_data_buffers = [deque(maxlen=int((plotting_window+1)*frame_rate + 1)) for _ in range(n_channels)]
+        self.plotting_length = int((plotting_window+1)*frame_rate + 1)
+        # whole samples with sequence numbers, every consumer reads with its own cursor
+        self.ring = SampleRingBuffer(IMU_FIELDS[:n_channels], capacity=2*int((max(plotting_window, csv_window)+1)*frame_rate + 1))
+        self.new_data_reader = self.ring.reader()
+        self.csv_reader = self.ring.reader()
 
         self.recording = False
+        self.recorder = None
+        self.record_lock = threading.Lock()
+        self.n_segments = 0  # recordings started, the later ones are appended to the file of the first
         self.n_channels = n_channels
         
         self.dump_thread = None
         self.dump_thread_running = threading.Event()
         
-        self.new_data_indices = [0] * n_channels  # Tracks where to start fetching new samples
-        self.lock = threading.Lock()  # Lock for thread safety
-        
-        
-
-    def add_data(self, qidx, val):
-        self.buffers[qidx].append(val)
-        self.new_data_buffers[qidx].append(val)
-        
-        if self.recording:
-            self.csv_buffers[qidx].append(val)
-        
+    def add_block(self, block):
+        """Add a block of samples (n_samples x n_channels)."""
+        self.ring.write(block)
     
+    def get_since(self, seq):
+        """
+        Zero-copy read of all samples after a sequence number, for consumers with their own cursor.
+        
+        :return: View (n_channels x n_samples), sequence number to continue from, overrun flag
+        """
+        return self.ring.get_since(seq)
 
-    def dump_to_txt(self):
-        # with open(self.filename, mode='a', newline='') as file:
-        #     writer = csv.writer(file)
-        #     for i in range(self.n_channels):
-        #         row = f'{i}' + np.array(self.csv_buffers[i]).astype(str)
-        #         writer.writerow(row)
+    def dump_to_file(self):
         while self.dump_thread_running.is_set():
-            if self.recording:
-                f = open(f"{self.filename}.txt", "a")
-                for i in range(self.n_channels):
-                    f.write(f"{i} ")
-                    while self.csv_buffers[i]:
-                        f.write(f"{self.csv_buffers[i].popleft()} ")
-                    f.write(" \n")
-                f.close()
+            self.flush_recording()
             time.sleep(self.csv_window)
 
+    def flush_recording(self):
+        """Hand all samples since the last flush to the recorder."""
+        with self.record_lock:
+            if self.recording and self.recorder is not None:
+                first_seq = self.csv_reader.seq
+                block, overrun = self.csv_reader.read()
+                if overrun:
+                    print("[IMU]: recording fell behind, samples were lost")
+                    first_seq = self.csv_reader.seq - block.shape[1]
+                # arrival time of every sample on the host (s)
+                host_time = block[self.ring.field_index["timestamp_computer"]] / 1000
+                self.recorder.write(block.T, first_seq=first_seq, host_time=host_time)
+
     def set_recording(self, value):
         if value and not self.recording:
             self.start_recording()
@@ -89,42 +149,38 @@ class DataBuffer:
     #         time.sleep(self.csv_window)
 
     def start_recording(self):
-        self.recording = True
-        ti = time.time()
-        with open(f"{self.filename}.txt", 'a') as f:
-            f.write(f'start time: {ti} \n')
-        f.close()
+        with self.record_lock:
+            self.csv_reader.skip_to_end()
+            self.recorder = SessionRecorder(f"{self.filename}.bin", self.ring.fields, device="imu",
+                                            metadata={"frame_rate": self.frame_rate},
+                                            append=self.n_segments > 0)
+            self.n_segments += 1
+            self.recording = True
         #print("[IMU]: recording started")
 
     def stop_recording(self):
-        self.recording = False
-        tf = time.time()
-
-        with open(f"{self.filename}.txt", 'a') as f:
-            f.write(f'end time: {tf} \n')
-        f.close()
+        self.flush_recording()
+        with self.record_lock:
+            self.recording = False
+            self.recorder.close()
+            self.recorder = None
 
         print("[IMU]: recording stopped")
-        print(f"[IMU]: data saved to {self.filename}.txt")
+        print(f"[IMU]: data saved to {self.filename}.bin")
 
     def plotting_queues(self):
-        return [np.array(self.buffers[i]) for i in range(self.n_channels)]
+        return list(self.ring.latest(self.plotting_length).copy())
     
     def get_new_data(self):
-        with self.lock:
-            new_data = []
-            for i in range(self.n_channels):
-                new_data_channel = []
-                while self.new_data_buffers[i]:
-                    
-                    new_data_channel.append(self.new_data_buffers[i].popleft())
-                new_data.append(np.array(new_data_channel))
-            return new_data
+        block, overrun = self.new_data_reader.read()
+        if overrun:
+            print("[IMU]: consumer fell behind, samples were lost")
+        return list(block.copy())
             
 
     def start_dump_thread(self):
         self.dump_thread_running.set()  # Start the thread
-        self.dump_thread = threading.Thread(target=self.dump_to_txt, daemon=True)
+        self.dump_thread = threading.Thread(target=self.dump_to_file, daemon=True)
         self.dump_thread.start()
 
 
@@ -133,32 +189,47 @@ class DataBuffer:
             self.dump_thread_running.clear()  # Signal the thread to stop
             if self.dump_thread:
                 self.dump_thread.join()  # Wait for the thread to finish
+        if self.recording:
+            self.stop_recording()
 
 import asyncio
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import time
 import threading
 
 class BluetoothIMUReader:
-    def __init__(self, port, baud_rate, file_index=0, frame_rate=112.2):
+    def __init__(self, port, baud_rate, file_index=0, frame_rate=112.2, read_timeout=0.05, uniform_rate=None, name=None):
+        """
+        :param uniform_rate: If set, the samples are resampled to this rate on a uniform grid of the estimated host time
+        :param name: Device name, used for the recording files when several IMUs are recorded
+        """
         self.port = port
+        self.name = name if name else port
         self.baud_rate = baud_rate
-        self.ser = serial.Serial(self.port, self.baud_rate)
+        # reads block until data arrives or read_timeout (s) expires, so the loop never spins
+        self.read_timeout = read_timeout
+        self.ser = serial.Serial(self.port, self.baud_rate, timeout=self.read_timeout)
+        self.read_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="imu_serial")
+        self.calibration = IMUCalibration.load(device=self.port)
         self.received_data = []
-        self.packages = [-1]
-        self.data_losses = []
         self.current_package = -1
-        self.sample_per_package = defaultdict(int)
+        self.link_stats = LinkStatistics(samples_per_package=SAMPLES_PER_PACKAGE)
+        # maps the device timestamps to host time and measures the true sample rate
+        self.clock = ClockDriftEstimator(tick_scale=1e-3)
+        self.resampler = UniformResampler(uniform_rate) if uniform_rate else None
         self.running = False
         self.file_index = file_index
         self.frame_rate = frame_rate
         self.last_signal_time = None
         self.signal_timeout = 5  # Timeout threshold in seconds
         self.new_package_flag = False
+        self.rx_buffer = b""  # bytes of an incomplete line
         self.stop_event = threading.Event()
 
         # Initialize the data buffer
-        self.data_buffer = DataBuffer(n_channels=8, frame_rate=self.frame_rate, plotting_window=5, csv_window=2, fileindex=self.file_index)
+        self.data_buffer = DataBuffer(n_channels=8, frame_rate=self.frame_rate, plotting_window=5, csv_window=2, fileindex=self.file_index,
+                                      device_name=name)
         print(f"Connected to {self.port} at {self.baud_rate} baud rate")
 
     async def send_signal(self, signal):
@@ -173,37 +244,29 @@ class BluetoothIMUReader:
         """Initialize the Bluetooth serial connection asynchronously."""
         await self.send_signal('S')
         while not self.stop_event.is_set():
-            data = await self.read_data_async()
-            if data is not None:
-                if isinstance(data, str) and "Connected to target device" in data:
-                    print("[IMU]: Connection established.")
-                    break
-                if isinstance(data, int):  # Package count
-                    print("[IMU]: Connection established.")
-                    break
-
-    async def read_data_async(self):
-        """Asynchronously read data from the serial port."""
-        if self.ser.in_waiting:
-            #print("1.1 reading data")
-            data = await asyncio.get_running_loop().run_in_executor(None, self.ser.readline)
-            data = data.decode('utf-8').strip()
-            #print("1.2 data read")
-
-            if data.startswith("Package count: "):
-                return int(data[len("Package count: "):])
-            if data == "" or len(data.split("\t")) != 7:
-                return data
-
-            # Parse accelerometer and gyroscope data
-            data_splits = data.split("\t")
-            acc_x, acc_y, acc_z = map(int, data_splits[:3])
-            gyro_x, gyro_y, gyro_z = map(int, data_splits[3:6])
-            timestamp = float(data_splits[6])
-            timestamp_computer = int(time.time() * 1000)
-
-            return acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z, timestamp, timestamp_computer
-        return None
+            chunk = await self.read_chunk_async()
+            if chunk is None:
+                continue
+            _, _, packages, messages = chunk
+            if any("Connected to target device" in message for message in messages) or packages:
+                print("[IMU]: Connection established.")
+                break
+
+    def _read_available(self):
+        """Block until at least one byte arrives (or the read timeout expires), then drain the input buffer."""
+        data = self.ser.read(1)
+        if data and self.ser.in_waiting:
+            data += self.ser.read(self.ser.in_waiting)
+        return data
+
+    async def read_chunk_async(self):
+        """Asynchronously wait for serial data, drain all available bytes and parse the complete lines."""
+        data = await asyncio.get_running_loop().run_in_executor(self.read_executor, self._read_available)
+        if not data:
+            return None
+        lines = (self.rx_buffer + data).split(b"\n")
+        self.rx_buffer = lines.pop()  # incomplete last line
+        return parse_imu_lines(lines, self.current_package)
 
     async def run(self):
         """Main asynchronous loop for reading IMU data."""
@@ -224,47 +287,47 @@ class BluetoothIMUReader:
         """Fetch and process data asynchronously."""
         
         try:
-            data = await self.read_data_async()
+            chunk = await self.read_chunk_async()
 
         except Exception as e:
             print(f"[IMU]: Error reading data: {e}")
             return
 
-        if data:
-            if isinstance(data, int):  # Package count
-                self.last_signal_time = time.time()
-                package = data
-                if package != self.packages[-1]:
-                    self.packages.append(package)
-                self.current_package = package
-                #print(f"[IMU]: Package {package} received.")
-                return None
-            elif isinstance(data, str):
-                print("[IMU]:", data)
-                
-                if "Enter S to start data transmission" in data:
-                    print("[IMU]: Connection lost. Reconnecting...")
-                    self.running = False
-                    await self.init_connection()
-                    self.running = True
-                
-                return None
+        if chunk is None:
+            return None
+        samples, sample_packages, packages, messages = chunk
+        
+        if packages:  # Package count
+            self.last_signal_time = time.time()
+            self.current_package = packages[-1]
+            #print(f"[IMU]: Package {package} received.")
+        self.link_stats.update(packages, sample_packages)
 
+        if len(samples):
             # Process sensor data
-            acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z, timestamp, timestamp_computer = data
-            acc_x = self.process_acc(acc_x)
-            acc_y = self.process_acc(acc_y)
-            acc_z = self.process_acc(acc_z)
-            acc_x, acc_y, acc_z = self.map_geometry_to_ppg(acc_x, acc_y, acc_z)
-            gyro_x = self.process_gyro(gyro_x)
-            gyro_y = self.process_gyro(gyro_y)
-            gyro_z = self.process_gyro(gyro_z)
-            gyro_x, gyro_y, gyro_z = self.map_geometry_to_ppg(gyro_x, gyro_y, gyro_z)
+            arrival_time = time.time()
+            if self.clock.update(samples[:, 6], arrival_time) and self.resampler is not None:
+                print("[IMU]: Device clock restarted, resetting the resampler")
+                self.resampler.reset()
+            calibrated = np.column_stack([self.calibration.apply(samples[:, :6]), samples[:, 6]])
+            if self.resampler is None:
+                block = np.column_stack([calibrated, np.full(len(samples), int(arrival_time * 1000))])
+            else:
+                grid_times, calibrated = self.resampler.process(self.clock.to_host(samples[:, 6]), calibrated)
+                block = np.column_stack([calibrated, grid_times * 1000])
 
             # Add data to buffer
-            for i, val in enumerate([acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z, timestamp, timestamp_computer]):
-                self.data_buffer.add_data(i, val)
-            self.sample_per_package[self.current_package] += 1
+            self.data_buffer.add_block(block)
+
+        for message in messages:
+            print("[IMU]:", message)
+            
+            if "Enter S to start data transmission" in message:
+                print("[IMU]: Connection lost. Reconnecting...")
+                self.running = False
+                await self.init_connection()
+                self.running = True
+                break
 
 
     def start_threads(self):
@@ -299,53 +362,23 @@ class BluetoothIMUReader:
         print("[IMU]: Data reading stopped.")
         self.end_run()
 
-    def map_geometry_to_ppg(self, x, y, z):
-        #z = -z
-        #y = -x
-        #x = -y
-        return -y, -x, -z
-
-    def process_acc(self, acc):
-        acc_lsb_div = 2**14 
-        return acc / acc_lsb_div * 9.81
-
-    def process_gyro(self, gyro):
-        gyro_lsb_div = 64 # since gyro range is 1024 deg/s now
-        return gyro / gyro_lsb_div
-
-         
     def get_package_loss(self):
-        package_count = np.array(self.packages[1:])
-        package_count = np.unique(package_count)
-        package_count.sort()
-        package_diff = np.diff(package_count)
-        package_loss = package_diff[package_diff > 1]
-        #print(package_loss)
-        package_loss = np.sum(package_loss - 1)
-        return package_loss / (len(package_count) + package_loss)
-        
-        
+        return self.link_stats.get_package_loss()
 
     def get_data_loss(self):
-        if len(self.packages) <= 1:
-            return np.nan
-        
-        start_package, end_package = self.packages[1], self.packages[-1]
-        total_amount = np.sum([self.sample_per_package[key] for key in range(start_package, end_package)])
-        desired_amount = (end_package - start_package) * SAMPLES_PER_PACKAGE
-        if desired_amount == 0:
-            return np.nan
-        return 1 - total_amount / desired_amount
+        return self.link_stats.get_data_loss()
     
     def end_run(self):
         """Stops the run loop, saves the data, and closes the serial connection."""
         self.send_signal('E')
         self.running = False  # Stop the reading loop
+        self.read_executor.shutdown(wait=True)  # Wait for a pending blocking read
         self.ser.close()  # Close the serial port
         print(f"[IMU]: Package loss: {self.get_package_loss()*100:.2f} %")
         print(f"[IMU]: Data loss: {self.get_data_loss()*100:.2f} %")
-        print(f"[IMU]: Data saved to {self.data_buffer.filename}.txt")
-        #print("[IMU] Sample ",[np.mean([el for el in self.sample_per_package.values()])])
+        print(f"[IMU]: Sample rate: {self.clock.get_sample_rate():.2f} Hz, clock skew: {self.clock.get_skew()*1e6:.0f} ppm")
+        self.calibration.save()
+        print(f"[IMU]: Data saved to {self.data_buffer.filename}.bin")
 
 
 
@@ -0,0 +1,121 @@
+import os
+import json
+import numpy as np
+
+ACC_LSB_DIV = 2**14  # raw accelerometer counts per g
+GYRO_LSB_DIV = 64  # since gyro range is 1024 deg/s now
+GRAVITY = 9.81
+# IMU axes to PPG wristband axes: (x, y, z) -> (-y, -x, -z)
+GEOMETRY_TO_PPG = np.array([[0, -1, 0],
+                            [-1, 0, 0],
+                            [0, 0, -1]], dtype=float)
+calibration_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "calibration")
+
+
+class IMUCalibration:
+    def __init__(self, device="default", acc_matrix=None, acc_bias=None, gyro_matrix=None, gyro_bias=None,
+                 estimate_gyro_bias=True, still_window=112, acc_std_threshold=0.05, gyro_std_threshold=1.0,
+                 max_bias_step=3.0, bias_rate=0.2, save_dir=None):
+        """
+        Calibration of raw IMU counts: calibrated = raw @ matrix.T - bias for the accelerometer and the gyroscope.
+        The matrices include the LSB scaling, the misalignment and the mapping to the PPG wristband axes.
+        The gyro bias is re-estimated whenever the wrist is still for a whole window.
+
+        :param device: Name of the device the calibration is stored for (e.g. the serial port)
+        :param acc_matrix: 3x3 accelerometer scale/misalignment matrix (raw counts -> m/s^2)
+        :param acc_bias: Accelerometer bias in m/s^2
+        :param gyro_matrix: 3x3 gyroscope scale/misalignment matrix (raw counts -> deg/s)
+        :param gyro_bias: Gyroscope bias in deg/s
+        :param estimate_gyro_bias: Continuously estimate the gyro bias during stillness
+        :param still_window: Number of samples that must be still before the bias is updated
+        :param acc_std_threshold: Maximum std of the acceleration magnitude (m/s^2) during stillness
+        :param gyro_std_threshold: Maximum std of the angular rate (deg/s) during stillness
+        :param max_bias_step: Maximum difference of the mean angular rate to the current bias (deg/s), a slow steady
+                              rotation passes the std tests but must not be taken for bias
+        :param bias_rate: Weight of a new stillness window in the bias estimate
+        :param save_dir: Directory the calibration files are stored in
+        """
+        self.device = device
+        self.acc_matrix = GEOMETRY_TO_PPG * GRAVITY / ACC_LSB_DIV if acc_matrix is None else np.asarray(acc_matrix, dtype=float)
+        self.acc_bias = np.zeros(3) if acc_bias is None else np.asarray(acc_bias, dtype=float)
+        self.gyro_matrix = GEOMETRY_TO_PPG / GYRO_LSB_DIV if gyro_matrix is None else np.asarray(gyro_matrix, dtype=float)
+        self.gyro_bias = np.zeros(3) if gyro_bias is None else np.asarray(gyro_bias, dtype=float)
+
+        self.estimate_gyro_bias = estimate_gyro_bias
+        self.still_window = still_window
+        self.acc_std_threshold = acc_std_threshold
+        self.gyro_std_threshold = gyro_std_threshold
+        self.max_bias_step = max_bias_step
+        self.bias_rate = bias_rate
+        self.save_dir = calibration_path if save_dir is None else save_dir
+
+        self.pending = np.empty((0, 6))  # calibrated samples (without gyro bias) of the current stillness window
+        self.n_bias_updates = 0
+
+    def apply(self, raw):
+        """
+        Calibrate a block of raw samples.
+
+        :param raw: Raw counts (N x 6): acc xyz, gyro xyz
+        :return: Calibrated samples (N x 6): acc in m/s^2, gyro in deg/s
+        """
+        raw = np.asarray(raw, dtype=float)
+        acc = raw[:, :3] @ self.acc_matrix.T - self.acc_bias
+        gyro = raw[:, 3:6] @ self.gyro_matrix.T
+        if self.estimate_gyro_bias:
+            self._update_gyro_bias(acc, gyro)
+        return np.hstack([acc, gyro - self.gyro_bias])
+
+    def _update_gyro_bias(self, acc, gyro):
+        self.pending = np.vstack([self.pending, np.hstack([acc, gyro])])[-self.still_window:]
+        if self.pending.shape[0] < self.still_window:
+            return
+
+        acc_magnitude = np.linalg.norm(self.pending[:, :3], axis=1)
+        gyro_mean = self.pending[:, 3:].mean(axis=0)
+        still = (acc_magnitude.std() < self.acc_std_threshold
+                 and self.pending[:, 3:].std(axis=0).max() < self.gyro_std_threshold
+                 and np.abs(gyro_mean - self.gyro_bias).max() < self.max_bias_step)
+        if still:
+            if self.n_bias_updates == 0 and not self.gyro_bias.any():
+                self.gyro_bias = gyro_mean
+            else:
+                self.gyro_bias = (1 - self.bias_rate) * self.gyro_bias + self.bias_rate * gyro_mean
+            self.n_bias_updates += 1
+            self.pending = self.pending[:0]
+
+    @property
+    def filename(self):
+        device = "".join(c if c.isalnum() else "_" for c in str(self.device))
+        return os.path.join(self.save_dir, f"imu_calibration_{device}.json")
+
+    def to_dict(self):
+        return {
+            "device": self.device,
+            "acc_matrix": self.acc_matrix.tolist(),
+            "acc_bias": self.acc_bias.tolist(),
+            "gyro_matrix": self.gyro_matrix.tolist(),
+            "gyro_bias": self.gyro_bias.tolist(),
+        }
+
+    def save(self):
+        os.makedirs(self.save_dir, exist_ok=True)
+        with open(self.filename, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        print(f"[IMU]: Calibration saved to {self.filename}")
+
+    @classmethod
+    def load(cls, device="default", save_dir=None, **kwargs):
+        """
+        Load the stored calibration of a device, or the default calibration if there is none.
+        """
+        calibration = cls(device=device, save_dir=save_dir, **kwargs)
+        if os.path.isfile(calibration.filename):
+            with open(calibration.filename) as f:
+                stored = json.load(f)
+            calibration.acc_matrix = np.array(stored["acc_matrix"])
+            calibration.acc_bias = np.array(stored["acc_bias"])
+            calibration.gyro_matrix = np.array(stored["gyro_matrix"])
+            calibration.gyro_bias = np.array(stored["gyro_bias"])
+            print(f"[IMU]: Calibration loaded from {calibration.filename}, gyro bias {np.round(calibration.gyro_bias, 2)}")
+        return calibration
@@ -0,0 +1,123 @@
+import asyncio
+import threading
+import time
+import numpy as np
+from IMU.BluetoothIMU import BluetoothIMUReader, IMU_FIELDS
+
+TIMESTAMP_INDEX = IMU_FIELDS.index("timestamp")
+TIMESTAMP_COMPUTER_INDEX = IMU_FIELDS.index("timestamp_computer")
+
+
+class IMUManager:
+    def __init__(self, ports, baud_rate=115200, file_index=0, frame_rate=112.1, uniform_rate=None):
+        """
+        Acquisition of several serial IMUs on one event loop in one thread.
+        Every device keeps its own reader, DataBuffer (recorded as imu_<name>_<index>) and calibration,
+        get_aligned combines their latest samples on a common host time grid.
+
+        :param ports: Dict of device name to serial port, e.g. {"left": "COM6", "right": "COM7"}
+        :param baud_rate: Baud rate of all ports
+        :param file_index: Recording index (-1 = no recording)
+        :param frame_rate: Nominal sample rate of the IMUs
+        :param uniform_rate: Resample every device to this rate (see BluetoothIMUReader)
+        """
+        self.readers = {name: BluetoothIMUReader(port, baud_rate, file_index=file_index, frame_rate=frame_rate,
+                                                 uniform_rate=uniform_rate, name=name)
+                        for name, port in ports.items()}
+        self.file_index = file_index
+        self.frame_rate = frame_rate
+        self.timed_out = set()
+        self.thread = None
+        self.running = False
+
+    def __getitem__(self, name):
+        return self.readers[name]
+
+    async def _run_device(self, name, reader):
+        await reader.init_connection()
+        if reader.stop_event.is_set():
+            return
+        reader.running = True
+        while reader.running:
+            await reader.update()
+            if reader.last_signal_time and time.time() - reader.last_signal_time > reader.signal_timeout:
+                # only this device stops, the others keep streaming
+                print(f"[IMU {name}]: Signal timeout! No data received.")
+                reader.running = False
+                self.timed_out.add(name)
+
+    async def run(self):
+        await asyncio.gather(*(self._run_device(name, reader) for name, reader in self.readers.items()))
+        self.running = False
+
+    def start_threads(self):
+        """Start the shared event loop in one thread and the recording threads of the devices."""
+        self.running = True
+        self.thread = threading.Thread(target=lambda: asyncio.run(self.run()), daemon=True)
+        self.thread.start()
+        if self.file_index != -1:
+            for reader in self.readers.values():
+                reader.data_buffer.start_dump_thread()
+        print(f"[IMU]: Reading {len(self.readers)} devices on one event loop.")
+
+    def stop_threads(self):
+        print("[IMU]: Stopping all devices...")
+        for reader in self.readers.values():
+            reader.running = False
+            reader.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        for reader in self.readers.values():
+            reader.data_buffer.stop_dump_thread()
+            reader.end_run()
+        self.running = False
+
+    def get_device_times(self, name, view):
+        """
+        Host times (s) of buffered samples, from the device clock once its mapping to host time is estimated.
+        """
+        reader = self.readers[name]
+        if reader.resampler is None and reader.clock.n_updates > reader.clock.warmup_updates:
+            return reader.clock.to_host(view[TIMESTAMP_INDEX])
+        return view[TIMESTAMP_COMPUTER_INDEX] / 1000
+
+    def get_aligned(self, n_samples, rate=None):
+        """
+        Latest samples of all devices interpolated onto a common uniform host time grid.
+        The grid ends at the newest time all devices have reached, so no device is extrapolated.
+
+        :param n_samples: Number of samples of the grid
+        :param rate: Sample rate of the grid (frame_rate if None)
+        :return: Grid times in s (n_samples) and dict of device name to samples (n_samples x 6), None if a device has no data yet
+        """
+        rate = self.frame_rate if rate is None else rate
+        latest = {}
+        for name, reader in self.readers.items():
+            # one extra second of margin, so the grid is covered even if a device lags behind
+            view = reader.data_buffer.ring.latest(n_samples + int(reader.frame_rate) + 1)
+            if view.shape[1] < 2:
+                return None, None
+            latest[name] = (self.get_device_times(name, view), view[:TIMESTAMP_INDEX])
+
+        end = min(times[-1] for times, _ in latest.values())
+        grid = end - np.arange(n_samples)[::-1] / rate
+        aligned = {name: np.column_stack([np.interp(grid, times, channel) for channel in values])
+                   for name, (times, values) in latest.items()}
+        return grid, aligned
+
+    def get_link_summary(self):
+        return {name: {**reader.link_stats.summary(), "clock": reader.clock.summary(), "timed_out": name in self.timed_out}
+                for name, reader in self.readers.items()}
+
+
+if __name__ == "__main__":
+    manager = IMUManager({"left": "COM6", "right": "COM7"}, file_index=-1)
+    manager.start_threads()
+    try:
+        while manager.running:
+            time.sleep(1)
+            grid, aligned = manager.get_aligned(150)
+            if grid is not None:
+                print({name: np.round(samples[-1, :3], 2) for name, samples in aligned.items()})
+    except KeyboardInterrupt:
+        manager.stop_threads()
@@ -0,0 +1,107 @@
+import time
+from collections import deque
+import numpy as np
+
+
+class LinkStatistics:
+    def __init__(self, samples_per_package=8, rate_window=5):
+        """
+        Streaming package-loss, data-loss and sample-rate statistics of the IMU link with O(1) memory.
+
+        :param samples_per_package: Number of samples the firmware sends per package
+        :param rate_window: Number of full seconds the effective sample rate is averaged over
+        """
+        self.samples_per_package = samples_per_package
+        self.rate_window = rate_window
+
+        self.first_package = None
+        self.last_package = None
+        self.n_packages = 0  # distinct packages received
+        self.n_lost_packages = 0  # gaps in the package counter
+        self.n_reordered = 0  # packages older than the last one (reorder or counter reset)
+
+        self.last_package_samples = 0  # samples of the package that is still open
+        self.n_closed_samples = 0  # samples of all closed packages
+        self.n_irregular_packages = 0  # closed packages with a sample count != samples_per_package
+        self.n_samples = 0
+
+        self.rate_bins = deque(maxlen=rate_window + 1)  # [second, number of samples]
+
+    def _close_package(self, n_samples):
+        self.n_closed_samples += n_samples
+        if n_samples != self.samples_per_package:
+            self.n_irregular_packages += 1
+
+    def update(self, packages, sample_packages, now=None):
+        """
+        Add the package counts and samples of one chunk.
+
+        :param packages: Package counts in the order received
+        :param sample_packages: Package of every sample of the chunk
+        :param now: Host time in seconds (now if None)
+        """
+        counts = dict(zip(*np.unique(sample_packages, return_counts=True))) if len(sample_packages) else {}
+        for package in packages:
+            if package == self.last_package:
+                continue
+            if self.last_package is None:
+                self.first_package = package
+            elif package > self.last_package:
+                self._close_package(self.last_package_samples + int(counts.pop(self.last_package, 0)))
+                self.n_lost_packages += package - self.last_package - 1
+            else:
+                self.n_reordered += 1
+                continue
+            self.n_packages += 1
+            self.last_package = package
+            self.last_package_samples = 0
+        self.last_package_samples += int(counts.pop(self.last_package, 0))
+
+        n_samples = len(sample_packages)
+        self.n_samples += n_samples
+        second = int(time.time() if now is None else now)
+        if self.rate_bins and self.rate_bins[-1][0] == second:
+            self.rate_bins[-1][1] += n_samples
+        else:
+            self.rate_bins.append([second, n_samples])
+
+    def get_package_loss(self):
+        if self.n_packages == 0:
+            return np.nan
+        return self.n_lost_packages / (self.n_packages + self.n_lost_packages)
+
+    def get_data_loss(self):
+        if self.last_package is None or self.last_package == self.first_package:
+            return np.nan
+        desired_amount = (self.last_package - self.first_package) * self.samples_per_package
+        return 1 - self.n_closed_samples / desired_amount
+
+    def get_sample_rate(self, now=None):
+        """
+        Effective sample rate over the last complete seconds before now, seconds without samples count as 0,
+        so the rate falls to 0 when the link dies.
+        """
+        if not self.rate_bins:
+            return np.nan
+        current = int(time.time() if now is None else now)
+        first = max(self.rate_bins[0][0], current - self.rate_window)
+        if first >= current:
+            return np.nan
+        return sum(count for second, count in self.rate_bins if first <= second < current) / (current - first)
+
+    def summary(self, now=None):
+        # None instead of NaN while there is too little data, NaN is not valid JSON
+        return {
+            "packages": self.n_packages,
+            "lost_packages": self.n_lost_packages,
+            "reordered_packages": self.n_reordered,
+            "irregular_packages": self.n_irregular_packages,
+            "package_loss": _finite_or_none(self.get_package_loss()),
+            "data_loss": _finite_or_none(self.get_data_loss()),
+            "sample_rate": _finite_or_none(self.get_sample_rate(now)),
+            "samples": self.n_samples,
+        }
+
+
+def _finite_or_none(value):
+    return float(value) if np.isfinite(value) else None
@@ -1,163 +1,154 @@
-import serial
-import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
+import os
+import sys
 import time
-import csv
+import signal
+import argparse
+import serial
 import numpy as np
-import os
 
-SAMPLES_PER_PACKAGE = 8
-data_path = r"C:\Users\lhauptmann\Code\WristPPG2\data"
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from IMU.BluetoothIMU import parse_imu_lines, IMU_FIELDS, SAMPLES_PER_PACKAGE
+from IMU.calibration import IMUCalibration
+from IMU.link_statistics import LinkStatistics
+from clock_sync import ClockDriftEstimator
+from session_recorder import RotatingSessionRecorder
 
-class BluetoothIMUReader:
-    def __init__(self, port, baud_rate, save_file="data.csv", save_interval=1000):
+data_path = r"C:\Users\lhauptmann\Code\WristPPG2\data"
+RECORD_FIELDS = IMU_FIELDS + ["package"]
+
+
+class HeadlessIMURecorder:
+    def __init__(self, port, baud_rate, prefix, max_megabytes=256, max_minutes=60, report_interval=5, read_timeout=0.1):
+        """
+        Headless recording of the IMU for long sessions. Every serial read is parsed and handed to a rotating binary
+        recorder as one block, all statistics are streaming, so the memory stays bounded for hours.
+        The raw values (mg and raw gyro units on the device axes, like the older recordings) are recorded, the
+        calibration to m/s^2 on the PPG axes and the online gyro bias are kept up to date in the header.
+
+        :param port: Serial port of the receiver
+        :param baud_rate: Baud rate of the receiver
+        :param prefix: Path of the recording files without the part number
+        :param max_megabytes: Size after which a new file is started
+        :param max_minutes: Duration after which a new file is started
+        :param report_interval: Seconds between the live reports of loss and rate
+        :param read_timeout: Maximum time a serial read blocks (s)
+        """
         self.port = port
-        self.baud_rate = baud_rate
-        self.save_file = save_file
-        self.save_interval = save_interval
-        self.ser = None  # Serial object will be initialized in the `init_connection()` method
-        self.received_data = []
-        self.saving_time = 0
-        self.init_connection()
-        self.packages = [-1]
-        self.data_losses = []
+        self.ser = serial.Serial(port, baud_rate, timeout=read_timeout)
+        self.calibration = IMUCalibration.load(device=port)
+        self.link_stats = LinkStatistics(samples_per_package=SAMPLES_PER_PACKAGE)
+        self.clock = ClockDriftEstimator(tick_scale=1e-3)
+        self.recorder = RotatingSessionRecorder(prefix, RECORD_FIELDS, device="imu", max_bytes=max_megabytes * 2**20,
+                                                max_seconds=max_minutes * 60,
+                                                metadata={"port": port, "units": "raw",
+                                                          "calibration": self.calibration.to_dict()})
+        self.report_interval = report_interval
         self.current_package = -1
-
-    def init_connection(self):
-        """Initialize the Bluetooth serial connection."""
-        self.ser = serial.Serial(self.port, self.baud_rate)
-        time.sleep(2)  # Allow some time for the connection to establish
-        print(f"Connected to {self.port} at {self.baud_rate} baud rate")
-
-
-    def read_data(self):
-        if self.ser.in_waiting:
-            data = self.ser.readline().decode('utf-8').strip()
-            if data.startswith("Package count: "):
-                package_count = int(data[len("Package count: "):])
-                return package_count
-            if data == "" or len(data.split("\t")) != 7:
-                if data != "":
-                    print(data)
-                return None
-            data_splits = data.split("\t")
-            acc_x = int(data_splits[0])
-            acc_y = int(data_splits[1])
-            acc_z = int(data_splits[2])
-            gyro_x = int(data_splits[3])
-            gyro_y = int(data_splits[4])
-            gyro_z = int(data_splits[5])
-            timestamp = float(data_splits[6])
-            timestamp_computer = int(time.time() * 1000)
-            return acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z, timestamp, timestamp_computer
-        return None
-
-    def process_acc(self, acc):
-        # Assuming the maximum value is 2g (units: mg)
-        acc_lsb_div = 2**14
-        return acc / acc_lsb_div * 1000
-
-    def process_gyro(self, gyro):
-        # Assuming the maximum value is 250 deg/s (units: deg/s)
-        gyro_lsb_div = 64
-        return gyro / gyro_lsb_div
-
-    def save_data(self):
-        if len(self.received_data) > 0:
-            with open(self.save_file, mode='a', newline='') as file:
-                writer = csv.DictWriter(file, fieldnames=self.received_data[0].keys())
-                if file.tell() == 0:
-                    writer.writeheader()
-                for data in self.received_data:
-                    writer.writerow(data)
-            self.received_data = []  # Clear the buffer after saving
-
-            
-
-    def update(self):
-        try:
-            data = self.read_data()
-        except Exception as e:
-            print(f"Error reading data: {e}")
-            return
-        
-        if isinstance(data, int):
-            package = data
-            print(f"Package count: {package}")
-            if package != self.packages[-1]:
-                self.packages.append(package)
-            if self.current_package != package:
-                self.current_package = package
-        
-        elif data is not None:
-            acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z, timestamp, timestamp_computer = data
-            acc_x = self.process_acc(acc_x)
-            acc_y = self.process_acc(acc_y)
-            acc_z = self.process_acc(acc_z)
-            gyro_x = self.process_gyro(gyro_x)
-            gyro_y = self.process_gyro(gyro_y)
-            gyro_z = self.process_gyro(gyro_z)
-
-            data_dict = {
-                "acc_x": acc_x, "acc_y": acc_y, "acc_z": acc_z,
-                "gyro_x": gyro_x, "gyro_y": gyro_y, "gyro_z": gyro_z,
-                "timestamp": timestamp, "timestamp_computer": timestamp_computer, "package": self.packages[-1]
-            }
-            self.received_data.append(data_dict)
-        
-        # Save the data periodically based on the save interval
-        current_time = time.time() * 1000
-        if current_time - self.saving_time >= self.save_interval and len(self.received_data) > 0:
-            self.data_losses.append(self.get_data_loss_package())
-            
-            self.save_data()
-            self.saving_time = current_time
-            
-    def get_package_loss(self):
-        package_count = np.array(self.packages[1:])
-        package_count = np.unique(package_count)
-        package_count.sort()
-        package_diff = np.diff(package_count)
-        package_loss = package_diff[package_diff > 1]
-        #print(package_loss)
-        package_loss = np.sum(package_loss - 1)
-        return package_loss / (len(package_count) + package_loss)
-        
-    def get_data_loss_package(self):
-        # explude first and last package
-        sample_packages = np.array([data["package"] for data in self.received_data if data["package"] != self.received_data[0]["package"]])
-        if len(sample_packages) == 0:
-            return np.nan
-        unique_packages = np.unique(sample_packages)
-        data_loss = (len(unique_packages)*SAMPLES_PER_PACKAGE - len(sample_packages)) / (len(unique_packages)*SAMPLES_PER_PACKAGE)
-        return data_loss
-
-    def get_data_loss(self):
-        self.data_losses = np.array(self.data_losses)
-        self.data_losses = self.data_losses[~np.isnan(self.data_losses)]
-        return np.nanmean(self.data_losses)
-
-    def run(self):
+        self.rx_buffer = b""
+        self.stop_requested = False
+        self.start_time = None
+        print(f"Connected to {port} at {baud_rate} baud rate")
+
+    def request_stop(self, *args):
+        self.stop_requested = True
+
+    def send_start(self):
+        self.ser.write(b"S")
+        print("[IMU]: Start signal sent.")
+
+    def _read_available(self):
+        data = self.ser.read(1)
+        if data and self.ser.in_waiting:
+            data += self.ser.read(self.ser.in_waiting)
+        return data
+
+    def process(self, lines):
+        samples, sample_packages, packages, messages = parse_imu_lines(lines, self.current_package)
+        if packages:
+            self.current_package = packages[-1]
+        self.link_stats.update(packages, sample_packages)
+
+        if len(samples):
+            arrival_time = time.time()
+            self.clock.update(samples[:, 6], arrival_time)
+            # only for the online gyro bias, the calibrated values go to the header, not into the records
+            self.calibration.apply(samples[:, :6])
+            block = np.column_stack([samples[:, :6], samples[:, 6],
+                                     np.full(len(samples), int(arrival_time * 1000)), sample_packages])
+            self.recorder.write(block, host_time=arrival_time)
+
+        for message in messages:
+            print("[IMU]:", message)
+            if "Enter S to start data transmission" in message:
+                print("[IMU]: Connection lost. Reconnecting...")
+                self.send_start()
+
+    def report(self):
+        self.recorder.update_metadata({"calibration": self.calibration.to_dict()})
+        stats = self.link_stats
+        print(f"[IMU]: {time.time() - self.start_time:8.0f} s | {stats.n_samples} samples | "
+              f"rate {stats.get_sample_rate():.1f} Hz (device {self.clock.get_sample_rate():.1f} Hz) | "
+              f"package loss {stats.get_package_loss()*100:.2f} % | data loss {stats.get_data_loss()*100:.2f} % | "
+              f"file {os.path.basename(self.recorder.path)}")
+
+    def run(self, duration=None):
+        """
+        Record until SIGINT/SIGTERM or the duration (s) is over.
+        """
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGTERM, self.request_stop)
+        self.start_time = time.time()
+        last_report = self.start_time
+        self.send_start()
         try:
-            while True:
-                self.update()
-        except KeyboardInterrupt:
-            print("Program stopped")
+            while not self.stop_requested:
+                data = self._read_available()
+                if data:
+                    lines = (self.rx_buffer + data).split(b"\n")
+                    self.rx_buffer = lines.pop()
+                    self.process(lines)
+                if time.time() - last_report >= self.report_interval:
+                    self.report()
+                    last_report = time.time()
+                if duration is not None and time.time() - self.start_time >= duration:
+                    break
         finally:
-            print(f"Package loss: {self.get_package_loss()}")
-            print(f"Data loss: {self.get_data_loss()}")
-            print(f"Data saved to {self.save_file}")
-            self.ser.close()  # Close the serial port
+            self.close()
 
-# Example usage
-if __name__ == "__main__":
-    # Set the correct port (e.g., COM3 on Windows or /dev/rfcomm0 on Linux)
-    bluetooth_port = 'COM6'  # Change this to the actual port
-    baud_rate = 115200  # The same baud rate as in Arduino code
+    def close(self):
+        try:
+            self.ser.write(b"E")
+            # the tail: whatever is still in the input buffer and the last incomplete line
+            data = self.ser.read(self.ser.in_waiting) if self.ser.in_waiting else b""
+            self.process((self.rx_buffer + data).split(b"\n"))
+            self.rx_buffer = b""
+        finally:
+            self.ser.close()
+            self.recorder.close()
+            self.calibration.save()
+        self.report()
+        print(f"[IMU]: Package loss: {self.link_stats.get_package_loss()*100:.2f} %")
+        print(f"[IMU]: Data loss: {self.link_stats.get_data_loss()*100:.2f} %")
+        if self.recorder.n_dropped:
+            print(f"[IMU]: {self.recorder.n_dropped} samples dropped by the recorder")
+        print(f"[IMU]: Data saved to {', '.join(self.recorder.paths)}")
 
-    # Initialize the Bluetooth IMU reader
-    filename = "imu_", time.strftime("%m_%d-%H_%M") + ".csv"
-    imu_reader = BluetoothIMUReader(bluetooth_port, baud_rate, save_file=os.path.join(data_path, filename))
 
-    # Run the reader (press Ctrl+C to stop)
-    imu_reader.run()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless IMU session recording")
+    parser.add_argument("--port", type=str, default="COM6", help="serial port of the receiver (e.g. COM6 or /dev/rfcomm0)")
+    parser.add_argument("--baud_rate", type=int, default=115200, help="baud rate of the receiver")
+    parser.add_argument("--save_dir", type=str, default=data_path, help="directory of the recording")
+    parser.add_argument("--name", type=str, default=None, help="file prefix (default imu_<date>)")
+    parser.add_argument("--max_mb", type=float, default=256, help="start a new file after this size")
+    parser.add_argument("--max_minutes", type=float, default=60, help="start a new file after this duration")
+    parser.add_argument("--report_interval", type=float, default=5, help="seconds between the live reports")
+    parser.add_argument("--duration", type=float, default=None, help="stop after this many seconds")
+    args = parser.parse_args()
+
+    name = args.name if args.name else "imu_" + time.strftime("%m_%d-%H_%M")
+    imu_recorder = HeadlessIMURecorder(args.port, args.baud_rate, os.path.join(args.save_dir, name),
+                                       max_megabytes=args.max_mb, max_minutes=args.max_minutes,
+                                       report_interval=args.report_interval)
+    # Ctrl+C stops the recording cleanly
+    imu_recorder.run(duration=args.duration)
@@ -0,0 +1,249 @@
+import os
+import sys
+import time
+import tty
+import select
+import argparse
+import threading
+import numpy as np
+
+if __name__ == "__main__":
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from IMU.calibration import IMUCalibration, ACC_LSB_DIV, GYRO_LSB_DIV
+
+SAMPLES_PER_PACKAGE = 8
+default_replay_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bluetooth_receive", "data.csv")
+
+
+def load_replay_samples(path=default_replay_path):
+    """
+    Load raw IMU counts to replay.
+
+    :param path: data.csv of the receiver (acc in mg, gyro in deg/s) or a session recording (.bin) of the DataBuffer
+    :return: Raw counts (N x 6) as sent by the firmware
+    """
+    if path.endswith(".bin"):
+        from session_recorder import load_session
+        records, _ = load_session(path)
+        calibrated = np.column_stack([records[name] for name in ["acc_x", "acc_y", "acc_z", "gyro_x", "gyro_y", "gyro_z"]])
+        calibration = IMUCalibration(estimate_gyro_bias=False)
+        acc = (calibrated[:, :3] + calibration.acc_bias) @ np.linalg.inv(calibration.acc_matrix).T
+        gyro = (calibrated[:, 3:] + calibration.gyro_bias) @ np.linalg.inv(calibration.gyro_matrix).T
+        raw = np.hstack([acc, gyro])
+    else:
+        data = np.genfromtxt(path, delimiter=",", names=True)
+        raw = np.column_stack([data[f"acc_{axis}"] * ACC_LSB_DIV / 1000 for axis in "xyz"] +
+                              [data[f"gyro_{axis}"] * GYRO_LSB_DIV for axis in "xyz"])
+    return np.clip(np.round(raw), -2**15, 2**15 - 1).astype(int)
+
+
+def format_package(package, samples, timestamp, frame_rate):
+    """
+    Lines of one package exactly as printed by the receiver firmware.
+    """
+    lines = [f"Package count: {package}"]
+    for i, sample in enumerate(samples):
+        lines.append("\t".join(str(v) for v in sample) + f"\t{int(timestamp + i * 1000 / frame_rate)}")
+    return ("\r\n".join(lines) + "\r\n").encode()
+
+
+class VirtualIMU:
+    def __init__(self, samples=None, frame_rate=112.1, burst=1, loss_prob=0.0, reconnect_interval=None,
+                 handshake_delay=1.0, clock_skew_ppm=0.0, loop=True, seed=None):
+        """
+        Pty-backed stand-in for the BLE receiver on the serial port, speaking the same line protocol:
+        the "Enter S to start data transmission" handshake, "Package count: N" lines and tab-separated samples.
+        The slave end (self.port) can be opened by serial.Serial like a real port.
+
+        :param samples: Raw counts (N x 6) to replay, data.csv if None
+        :param frame_rate: Sample rate of the replay in Hz (None = as fast as possible)
+        :param burst: Number of packages written at once (the BLE link delivers packages in bursts)
+        :param loss_prob: Probability of a package being lost (its package count is skipped)
+        :param reconnect_interval: Seconds between simulated connection losses (None = never)
+        :param handshake_delay: Delay before a command is answered (the firmware waits 1 s)
+        :param clock_skew_ppm: Drift of the device timestamps against the host clock
+        :param loop: Restart the replay at the end of the samples
+        :param seed: Seed of the loss injection
+        """
+        self.samples = load_replay_samples() if samples is None else np.asarray(samples, dtype=int)
+        self.frame_rate = frame_rate
+        self.burst = max(1, int(burst))
+        self.loss_prob = loss_prob
+        self.reconnect_interval = reconnect_interval
+        self.handshake_delay = handshake_delay
+        self.clock_skew = clock_skew_ppm * 1e-6
+        self.loop = loop
+        self.rng = np.random.default_rng(seed)
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)  # no echo and no newline translation, like a serial line
+        self.port = os.ttyname(self.slave)
+
+        self.streaming = False
+        self.package = 0
+        self.position = 0
+        self.n_sent_packages = 0
+        self.n_lost_packages = 0
+        self.n_reconnects = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        while data:
+            data = data[os.write(self.master, data):]
+
+    def println(self, message):
+        self.write(message + "\r\n")
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def _handle_commands(self, timeout):
+        readable, _, _ = select.select([self.master], [], [], max(0.0, timeout))
+        if not readable:
+            return
+        for command in os.read(self.master, 1024).decode(errors="replace"):
+            if command == "S" and not self.streaming:
+                time.sleep(self.handshake_delay)
+                self.println("Start recording signal received.")
+                self.println("Connecting to IMU...")
+                self.println("Scanning for BLE devices...")
+                self.println("Found target device: 00:00:00:00:00:00 (virtual)")
+                self.println("Connected to target device!")
+                self._start_stream()
+            elif command == "E":
+                time.sleep(self.handshake_delay)
+                self.streaming = False
+                self.println("Disconnecting from the target device...")
+                self.println("Disconnected successfully.")
+                self.println("End recording signal received.")
+                self.println("Enter S to start data transmission")
+
+    def _start_stream(self):
+        self.streaming = True
+        self.stream_start = time.time()
+        self.stream_packages = 0
+        self.connected_since = self.stream_start
+
+    def _next_package(self):
+        if self.position + SAMPLES_PER_PACKAGE > len(self.samples):
+            if not self.loop:
+                return None
+            self.position = 0
+        samples = self.samples[self.position:self.position + SAMPLES_PER_PACKAGE]
+        self.position += SAMPLES_PER_PACKAGE
+        self.package += 1
+        return samples
+
+    def _send_burst(self):
+        data = b""
+        for _ in range(self.burst):
+            samples = self._next_package()
+            if samples is None:
+                self.streaming = False
+                self.println("Replay finished.")
+                break
+            rate = self.frame_rate or 112.1
+            timestamp = self.package * SAMPLES_PER_PACKAGE * 1000 / rate * (1 + self.clock_skew)
+            if self.rng.random() < self.loss_prob:
+                self.n_lost_packages += 1
+                continue
+            data += format_package(self.package, samples, timestamp, rate)
+            self.n_sent_packages += 1
+        if data:
+            self.write(data)
+        self.stream_packages += self.burst
+
+    def _run(self):
+        self.println("Starting BLE Client...")
+        self.println("Enter S to start data transmission")
+        while not self.stop_event.is_set():
+            if not self.streaming:
+                self._handle_commands(0.1)
+                continue
+
+            if self.reconnect_interval and time.time() - self.connected_since > self.reconnect_interval:
+                # the BLE link drops, the receiver asks for a new start signal
+                self.streaming = False
+                self.n_reconnects += 1
+                self.println("Enter S to start data transmission")
+                continue
+
+            self._send_burst()
+            if self.frame_rate:
+                due = self.stream_start + self.stream_packages * SAMPLES_PER_PACKAGE / self.frame_rate
+                self._handle_commands(due - time.time())
+            else:
+                self._handle_commands(0)
+
+    def get_counters(self):
+        return {"sent_packages": self.n_sent_packages, "lost_packages": self.n_lost_packages,
+                "reconnects": self.n_reconnects}
+
+
+def benchmark_parser(n_packages=20000, chunk_packages=4):
+    """
+    Throughput of parse_imu_lines on replayed firmware output, split into chunks like the serial reads.
+    """
+    from IMU.BluetoothIMU import parse_imu_lines
+
+    samples = load_replay_samples()
+    rate = 112.1
+    stream = []
+    for package in range(n_packages):
+        start = (package * SAMPLES_PER_PACKAGE) % (len(samples) - SAMPLES_PER_PACKAGE)
+        stream.append(format_package(package, samples[start:start + SAMPLES_PER_PACKAGE],
+                                     package * SAMPLES_PER_PACKAGE * 1000 / rate, rate))
+    stream = b"".join(stream)
+    lines = stream.split(b"\n")
+    chunk_lines = chunk_packages * (SAMPLES_PER_PACKAGE + 1)
+    chunks = [lines[i:i + chunk_lines] for i in range(0, len(lines), chunk_lines)]
+
+    start = time.perf_counter()
+    n_samples = 0
+    for chunk in chunks:
+        n_samples += parse_imu_lines(chunk)[0].shape[0]
+    duration = time.perf_counter() - start
+    print(f"[VirtualIMU]: parsed {n_samples} samples in {duration:.3f} s "
+          f"({n_samples / duration:.0f} samples/s, {len(stream) / duration / 1e6:.1f} MB/s)")
+    return n_samples / duration
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Virtual serial IMU receiver")
+    parser.add_argument("--replay", type=str, default=default_replay_path, help="data.csv or session recording (.bin) to replay")
+    parser.add_argument("--rate", type=float, default=112.1, help="sample rate of the replay (0 = as fast as possible)")
+    parser.add_argument("--burst", type=int, default=1, help="packages written at once")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability of a lost package")
+    parser.add_argument("--reconnect", type=float, default=None, help="seconds between simulated connection losses")
+    parser.add_argument("--handshake_delay", type=float, default=1.0, help="delay before a command is answered")
+    parser.add_argument("--skew_ppm", type=float, default=0.0, help="drift of the device clock")
+    parser.add_argument("--benchmark", action="store_true", help="benchmark the line parser and exit")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark_parser()
+        sys.exit(0)
+
+    device = VirtualIMU(load_replay_samples(args.replay), frame_rate=args.rate or None, burst=args.burst,
+                        loss_prob=args.loss, reconnect_interval=args.reconnect,
+                        handshake_delay=args.handshake_delay, clock_skew_ppm=args.skew_ppm)
+    print(f"[VirtualIMU]: serving on {device.start()}")
+    try:
+        while True:
+            time.sleep(5)
+            print("[VirtualIMU]:", device.get_counters())
+    except KeyboardInterrupt:
+        device.stop()
@@ -0,0 +1,65 @@
+import struct
+
+ATT_CID = 0x0004
+ATT_WRITE_REQUEST = 0x12
+ATT_WRITE_COMMAND = 0x52
+ATT_NOTIFICATION = 0x1b
+H4_ACL = 0x02
+
+
+def iter_pcapng_packets(path):
+    """
+    Minimal pcapng reader: yields the timestamp (s) and the payload of every enhanced packet block.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    endian = "<"
+    ts_resolution = 1e-6
+    while offset + 12 <= len(data):
+        block_type, block_length = struct.unpack_from(endian + "II", data, offset)
+        if block_type == 0x0A0D0D0A:  # section header, defines the byte order
+            endian = "<" if data[offset + 8:offset + 12] == b"\x4d\x3c\x2b\x1a" else ">"
+            block_length = struct.unpack_from(endian + "I", data, offset + 4)[0]
+        elif block_type == 6:
+            ts_high, ts_low, captured = struct.unpack_from(endian + "III", data, offset + 12)
+            yield ((ts_high << 32) | ts_low) * ts_resolution, data[offset + 28:offset + 28 + captured]
+        if block_length < 12:
+            break
+        offset += block_length
+
+
+def iter_att_pdus(path):
+    """
+    ATT PDUs of a Bluetooth HCI H4 capture with direction pseudo-header (as saved by Wireshark).
+
+    :return: Generator of (timestamp, sent by the host, PDU starting with the opcode)
+    """
+    for timestamp, packet in iter_pcapng_packets(path):
+        if len(packet) < 14 or packet[4] != H4_ACL:
+            continue
+        direction = struct.unpack_from(">I", packet, 0)[0]
+        cid = struct.unpack_from("<H", packet, 11)[0]
+        if cid != ATT_CID:
+            continue
+        yield timestamp, direction == 0, bytes(packet[13:])
+
+
+def iter_att_packets(path):
+    """
+    ATT packets split into opcode, attribute handle and value (for requests, writes and notifications).
+
+    :return: Generator of (timestamp, sent by the host, ATT opcode, attribute handle, value)
+    """
+    for timestamp, from_host, pdu in iter_att_pdus(path):
+        handle = struct.unpack_from("<H", pdu, 1)[0] if len(pdu) >= 3 else None
+        yield timestamp, from_host, pdu[0], handle, pdu[3:]
+
+
+def load_notifications(path):
+    """
+    Recorded notification payloads of a capture, in the order received.
+
+    :return: List of (timestamp, payload)
+    """
+    return [(timestamp, value) for timestamp, _, opcode, _, value in iter_att_packets(path) if opcode == ATT_NOTIFICATION]
@@ -0,0 +1,142 @@
+import os
+import sys
+import json
+import time
+import uuid
+import struct
+import hashlib
+
+if __name__ == "__main__":
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PPG.ble_capture import iter_att_pdus, iter_att_packets, ATT_WRITE_REQUEST, ATT_WRITE_COMMAND, ATT_NOTIFICATION
+
+STREAM_CHAR_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"
+UART_CHAR_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"
+ATT_READ_BY_TYPE_RESPONSE = 0x09
+ATT_FIND_INFORMATION_RESPONSE = 0x05
+CCCD_UUID = 0x2902
+cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config_cache")
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _uuid_from_le(raw):
+    if len(raw) == 2:
+        return f"0000{struct.unpack('<H', raw)[0]:04x}-0000-1000-8000-00805f9b34fb"
+    return str(uuid.UUID(bytes=raw[::-1]))
+
+
+def _discover_handles(path):
+    """
+    Characteristic value handles (from Read By Type responses) and client configuration descriptor handles
+    (from Find Information responses) seen in a capture.
+    """
+    characteristics = {}
+    cccds = set()
+    for _, from_host, pdu in iter_att_pdus(path):
+        if from_host or len(pdu) < 2:
+            continue
+        if pdu[0] == ATT_READ_BY_TYPE_RESPONSE:
+            length = pdu[1]
+            # characteristic declarations: handle, properties, value handle, UUID
+            if length not in (7, 21):
+                continue
+            for offset in range(2, len(pdu) - length + 1, length):
+                entry = pdu[offset:offset + length]
+                characteristics[struct.unpack_from("<H", entry, 3)[0]] = _uuid_from_le(entry[5:])
+        elif pdu[0] == ATT_FIND_INFORMATION_RESPONSE:
+            length = 4 if pdu[1] == 1 else 18
+            for offset in range(2, len(pdu) - length + 1, length):
+                entry = pdu[offset:offset + length]
+                if length == 4 and struct.unpack_from("<H", entry, 2)[0] == CCCD_UUID:
+                    cccds.add(struct.unpack_from("<H", entry, 0)[0])
+    return characteristics, cccds
+
+
+def _characteristic_of_descriptor(characteristics, handle):
+    """A descriptor belongs to the characteristic with the closest value handle before it."""
+    value_handles = [h for h in characteristics if h < handle]
+    return characteristics[max(value_handles)] if value_handles else None
+
+
+def compile_config_sequence(path):
+    """
+    Extract the configuration of the wristband from a Wireshark capture of the vendor app: all GATT writes from the
+    first write to the UART characteristic up to the first stream notification. The handles are resolved to
+    characteristic UUIDs from the service discovery in the same capture, so tshark is not needed.
+
+    :param path: Capture (.pcapng, Bluetooth HCI H4 with direction header)
+    :return: List of commands, {"op": "write", "uuid": ..., "value": hex, "response": bool} or {"op": "notify", "uuid": ...}
+    """
+    characteristics, cccds = _discover_handles(path)
+
+    commands = []
+    started = False
+    for timestamp, from_host, opcode, handle, value in iter_att_packets(path):
+        if not from_host and opcode == ATT_NOTIFICATION and started:
+            break
+        if not from_host or opcode not in (ATT_WRITE_REQUEST, ATT_WRITE_COMMAND):
+            continue
+        if handle in cccds:
+            char_uuid = _characteristic_of_descriptor(characteristics, handle)
+            if started and char_uuid is not None and value[:1] in (b"\x01", b"\x02"):
+                commands.append({"op": "notify", "uuid": char_uuid})
+            continue
+        char_uuid = characteristics.get(handle)
+        if char_uuid == UART_CHAR_UUID:
+            started = True
+        if started and char_uuid is not None:
+            commands.append({"op": "write", "uuid": char_uuid, "value": value.hex(),
+                             "response": opcode == ATT_WRITE_REQUEST})
+
+    assert started, "[PPG]: Error: no config found in wireshark file"
+    assert any(command["op"] == "notify" for command in commands), "[PPG]: Error: no end of config found in wireshark file"
+    return commands
+
+
+def load_config_sequence(path, cache_dir=cache_path):
+    """
+    Configuration commands of a capture, compiled once and cached as json keyed by the hash of the capture,
+    so connects and reconnects only replay the list.
+
+    :param path: Capture (.pcapng) of the vendor app configuring the wristband
+    :param cache_dir: Directory of the compiled sequences
+    :return: List of commands (see compile_config_sequence)
+    """
+    cache_file = os.path.join(cache_dir, file_hash(path) + ".json")
+    if os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            return json.load(f)["commands"]
+    start = time.perf_counter()
+    commands = compile_config_sequence(path)
+    print(f"[PPG]: compiled {len(commands)} config commands from {os.path.basename(path)} "
+          f"in {(time.perf_counter() - start) * 1000:.1f} ms")
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_file, "w") as f:
+        json.dump({"source": os.path.basename(path), "commands": commands}, f, indent=1)
+    return commands
+
+
+if __name__ == "__main__":
+    ppg_path = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(ppg_path)):
+        if not name.endswith(".pcapng"):
+            continue
+        capture_path = os.path.join(ppg_path, name)
+        try:
+            start = time.perf_counter()
+            commands = compile_config_sequence(capture_path)
+            compile_time = time.perf_counter() - start
+        except AssertionError as exc:
+            print(f"[PPG]: {name}: {exc}")
+            continue
+        load_config_sequence(capture_path)
+        start = time.perf_counter()
+        load_config_sequence(capture_path)
+        load_time = time.perf_counter() - start
+        n_notify = sum(command["op"] == "notify" for command in commands)
+        print(f"[PPG]: {name}: {len(commands)} commands ({n_notify} notify), "
+              f"compile {compile_time * 1000:.1f} ms, cached {load_time * 1000:.2f} ms")
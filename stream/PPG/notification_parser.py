@@ -0,0 +1,506 @@
+import os
+import sys
+import time
+import struct
+from collections import namedtuple
+import numpy as np
+
+if __name__ == "__main__":
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PPG.ble_capture import load_notifications
+
+OVERFLOW_FLAG = 15
+ACC_SCALE = 8 * 9.8 / 32768.0  # +-8 g, 16 bit
+PAYLOAD_BYTES = 18
+LATE_WINDOW = 16  # messages up to this far behind the last index arrived late, they did not wrap the counter
+WORDS = struct.Struct(">4I")  # the 4 PPG words of a chapter, flag byte and 24 bit value
+ACC_WORDS = struct.Struct(">3H")
+BATCH_SIZE = 32  # notifications per parse_many in the benchmark, about 70 ms of a 16 channel stream
+
+
+def build_chapter_layout(n_ppg_channels):
+    """
+    Layout table of the notification chapters: a chapter carries 4 PPG values (flag byte + 24 bit big-endian),
+    the last chapter is followed by the 3 signed 16 bit accelerometer values, the first one sets the frame timestamp.
+
+    :return: List over the chapters of (first PPG channel, accelerometer channels or None, timestamp channel or None)
+    """
+    n_chapters = n_ppg_channels // 4
+    layout = []
+    for chapter in range(n_chapters):
+        acc = slice(n_ppg_channels, n_ppg_channels + 3) if chapter == n_chapters - 1 else None
+        timestamp = n_ppg_channels + 3 if chapter == 0 else None
+        layout.append((4 * chapter, acc, timestamp))
+    return layout
+
+
+class NotificationParser:
+    def __init__(self, n_ppg_channels=16):
+        """
+        Decoder of the wristband notifications into whole frames (PPG channels, acc xyz, timestamp).
+        A notification is [message index 0-255, chapter, payload]; every chapter decodes the next 16 bytes of the
+        concatenated payloads, the rest is carried over. Per notification only the message index is checked and the
+        payload is appended to a batch, the frames completed since the last decode are decoded all at once
+        (parse_many decodes a whole batch of notifications with one pass over the bytes).
+        Lost messages are detected from the message index (modulo 256) and the chapter of the next message; their
+        payloads are replaced by placeholder bytes, so the values they carried are NaN and the carry-over of the
+        chapters after them stays aligned. Overflowed values are NaN as well.
+
+        :param n_ppg_channels: Number of PPG channels (16 or 32)
+        """
+        self.n_ppg_channels = n_ppg_channels
+        self.n_chapters = n_ppg_channels // 4
+        self.n_channels = n_ppg_channels + 4
+        self.layout = build_chapter_layout(n_ppg_channels)
+        self.chapter_channels = np.array([np.arange(first, first + 4) for first, _, _ in self.layout])
+        self.acc_channels = self.layout[-1][1]
+
+        self.last_idx = -1
+        self.last_msg_chapter = -1
+        self.last_data_chapter = -1  # last PPG chapter, received or lost
+        self.last_reception_time = 0
+        self.missed_messages = {}
+        self.missed_since_data = 0  # lost messages not yet assigned to chapters
+        self.lost_packets = 0
+        self.late_packets = 0
+        self.second_cnt = 0  # the device counts seconds
+
+        self.batch = bytearray()  # payloads not decoded yet, placeholders for the lost ones
+        self.lost_bytes = bytearray()  # 1 for every placeholder byte of the batch
+        self.cursor = 0  # batch offset of the 16 bytes of the next chapter
+        # per chapter not decoded yet: batch offset of its 16 bytes and the index of its first value in the frames
+        self.offsets = []
+        self.destinations = []
+        self.frame_start = 0  # first chapter that belongs to the current frame
+        self.acc_offsets = []  # per completed frame the batch offset of the accelerometer values, -1 if lost
+        self.timestamps = []  # per completed frame the host time, NaN if its first chapter was lost
+        self.frame_time = np.nan
+        self.fill = np.nan  # value of the lost and overflowed channels
+        self.no_frames = (np.full((0, self.n_channels), np.nan), [], [])
+
+    def _clear_stream(self):
+        # the next chapter does not continue the previous payloads
+        self.cursor = len(self.batch)
+
+    def _add_chapter(self, chapter, payload, lost=False):
+        self.batch += payload
+        self.lost_bytes += (b"\x01" if lost else b"\x00") * len(payload)
+        if self.cursor + 16 > len(self.batch):
+            raise ValueError(f"Chapter {chapter} is incomplete")
+        self.offsets.append(self.cursor)
+        self.destinations.append(len(self.acc_offsets) * self.n_channels + 4 * chapter)
+        self.cursor += 16
+
+    def _next_frame(self, acc_offset=-1):
+        # whatever is left belongs to the frame (accelerometer, padding)
+        self._clear_stream()
+        self.acc_offsets.append(acc_offset)
+        self.timestamps.append(self.frame_time)
+        self.frame_time = np.nan
+        self.frame_start = len(self.offsets)
+
+    def restart(self):
+        """
+        Forget the message index and the partial frame, e.g. after a reconnect. The counters are kept, the frames
+        completed before are still returned by the next decode.
+        """
+        self.last_idx = -1
+        self.last_msg_chapter = -1
+        self.last_data_chapter = -1
+        self.missed_since_data = 0
+        del self.offsets[self.frame_start:]
+        del self.destinations[self.frame_start:]
+        self.frame_time = np.nan
+        self._clear_stream()
+
+    def _count_message(self, idx, now):
+        """
+        :return: Number of messages lost before this one, None if it arrived after a later one
+        """
+        if self.last_idx == -1:
+            self.missed_messages = {}
+            n_missed = 0
+        else:
+            n_missed = (idx - self.last_idx - 1) % 256
+            if n_missed >= 256 - LATE_WINDOW:
+                # its chapter was already given up as lost
+                self.late_packets += 1
+                return None
+            if idx <= self.last_idx:  # the counter wrapped
+                if self.missed_messages:
+                    print("[PPG]: missed messages:", self.missed_messages)
+                self.missed_messages = {}
+        if n_missed:
+            count, delay = self.missed_messages.get(idx, (0, 0))
+            self.missed_messages[idx] = (count + n_missed, delay + now - self.last_reception_time)
+            self.lost_packets += n_missed
+        self.last_idx = idx
+        return n_missed
+
+    def _skip_chapters(self, chapter):
+        """
+        Account for the PPG chapters lost before a received chapter: the ones between the last and this chapter,
+        and whole frames if more messages than that were lost.
+        """
+        between = (chapter - self.last_data_chapter - 1) % self.n_chapters
+        n_lost = between + max(0, self.missed_since_data - between) // self.n_chapters * self.n_chapters
+        self.missed_since_data = 0
+        for _ in range(n_lost):
+            self.last_data_chapter = (self.last_data_chapter + 1) % self.n_chapters
+            if self.last_data_chapter == 0:
+                self._clear_stream()
+            # placeholder for the payload, the channels of the chapter stay NaN
+            self._add_chapter(self.last_data_chapter, bytes(PAYLOAD_BYTES), lost=True)
+            if self.last_data_chapter == self.n_chapters - 1:
+                self._next_frame()
+
+    def _add_notification(self, data, now):
+        n_missed = self._count_message(data[0], now)
+        if n_missed is None:
+            return
+        self.missed_since_data += n_missed
+        self.last_reception_time = now
+        chapter = data[1]
+        self.last_msg_chapter = chapter
+
+        if chapter < self.n_chapters:
+            self._skip_chapters(chapter)
+            self.last_data_chapter = chapter
+            _, acc, timestamp = self.layout[chapter]
+            if timestamp is not None:
+                self._clear_stream()
+                self.frame_time = now
+            self._add_chapter(chapter, data[2:])
+            if acc is not None:
+                if self.cursor + 6 > len(self.batch):
+                    raise ValueError("Accelerometer values are incomplete")
+                self._next_frame(self.cursor)
+        elif chapter == 19:  # every second a timestamp
+            self.second_cnt += 1
+            self._clear_stream()
+        else:
+            print("chpt ", chapter)
+
+    def _decode(self):
+        """
+        Decode the frames completed since the last call and drop their bytes from the batch.
+
+        :return: Frames (n_frames x n_channels), per frame the bitmasks (bit i for channel i) of the valid and of the
+                 overflowed values
+        """
+        n_frames = len(self.acc_offsets)
+        if not n_frames:
+            return self.no_frames
+        frames = [[self.fill] * self.n_channels for _ in range(n_frames)]
+        valid = [0] * n_frames
+        overflow = [0] * n_frames
+        batch, lost_bytes = self.batch, self.lost_bytes
+        any_lost = 1 in lost_bytes
+        # struct per chapter instead of numpy: a frame has only a few words, the array overhead would dominate
+        for offset, destination in zip(self.offsets[:self.frame_start], self.destinations[:self.frame_start]):
+            frame, channel = divmod(destination, self.n_channels)
+            row = frames[frame]
+            for word in WORDS.unpack_from(batch, offset):
+                if any_lost and lost_bytes.find(1, offset, offset + 4) >= 0:
+                    pass
+                elif word >> 24 == OVERFLOW_FLAG:
+                    overflow[frame] |= 1 << channel
+                else:
+                    row[channel] = float(word & 0xFFFFFF)
+                    valid[frame] |= 1 << channel
+                offset += 4
+                channel += 1
+        acc_bits = 0b111 << self.acc_channels.start
+        for frame, acc_offset in enumerate(self.acc_offsets):
+            row = frames[frame]
+            if acc_offset >= 0:
+                for channel, value in enumerate(ACC_WORDS.unpack_from(batch, acc_offset), self.acc_channels.start):
+                    row[channel] = (value - 65536 if value > 32768 else value) * ACC_SCALE
+                valid[frame] |= acc_bits
+            row[-1] = self.timestamps[frame]
+
+        # keep the chapters of the current frame and the carry-over
+        keep = min(self.offsets[self.frame_start:] + [self.cursor])
+        del self.batch[:keep]
+        del self.lost_bytes[:keep]
+        self.cursor -= keep
+        shift = n_frames * self.n_channels
+        self.offsets = [offset - keep for offset in self.offsets[self.frame_start:]]
+        self.destinations = [destination - shift for destination in self.destinations[self.frame_start:]]
+        self.frame_start = 0
+        self.acc_offsets = []
+        self.timestamps = []
+        return np.array(frames), valid, overflow
+
+    def parse(self, data, now=None):
+        """
+        Decode one notification.
+
+        :param data: Notification payload (bytes or bytearray)
+        :param now: Host time of reception (now if None)
+        :return: Frames completed by this notification (n_frames x n_channels)
+        """
+        self._add_notification(data, time.time() if now is None else now)
+        return self._decode()[0]
+
+    def parse_many(self, notifications):
+        """
+        Decode a batch of notifications at once.
+
+        :param notifications: List of (host time of reception, payload)
+        :return: Frames completed by these notifications (n_frames x n_channels)
+        """
+        for now, data in notifications:
+            self._add_notification(data, now)
+        return self._decode()[0]
+
+
+def mask_invalid(values, valid, fill=np.nan):
+    """
+    Set the values that are not valid to fill, in place.
+
+    :param values: Channels (n_values x n_frames)
+    :param valid: Validity bitmasks of the frames (bit i for channel i), as uint64 or exact floats
+    """
+    valid = np.asarray(valid).astype(np.uint64)
+    bits = (valid[None, :] >> np.arange(values.shape[0], dtype=np.uint64)[:, None]) & np.uint64(1)
+    values[bits == 0] = fill
+    return values
+
+
+class FrameBlock(namedtuple("FrameBlock", ["values", "timestamps", "valid", "overflow"])):
+    """
+    Frames decoded from one notification: values (n_frames x PPG and acc channels, float32, 0 where not valid),
+    host timestamps (float64, NaN if the first chapter was lost) and per frame the bitmasks (uint64, bit i for
+    channel i) of the valid and of the overflowed values.
+    """
+    @property
+    def n_frames(self):
+        return self.values.shape[0]
+
+    def rows(self):
+        """All of it as float64 rows (values, timestamp, valid, overflow), the masks stay exact up to 52 channels."""
+        return np.column_stack([self.values, self.timestamps, self.valid, self.overflow])
+
+
+class FrameAssembler(NotificationParser):
+    def __init__(self, n_ppg_channels=16):
+        """
+        Notification parser with typed output: dense float32 frames and validity/overflow bitmasks instead of NaN,
+        consumers decide themselves how to fill the gaps. lost_packets counts the lost messages.
+
+        :param n_ppg_channels: Number of PPG channels (16 or 32)
+        """
+        super().__init__(n_ppg_channels)
+        self.n_values = self.n_channels - 1
+        self.fill = 0.0
+        self.empty_block = FrameBlock(np.zeros((0, self.n_values), dtype=np.float32), np.zeros(0),
+                                      np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint64))
+
+    def _block(self):
+        if not self.acc_offsets:
+            return self.empty_block
+        frames, valid, overflow = self._decode()
+        return FrameBlock(frames[:, :self.n_values].astype(np.float32), frames[:, self.n_values],
+                          np.array(valid, dtype=np.uint64),
+                          np.array(overflow, dtype=np.uint64))
+
+    def parse(self, data, now=None):
+        """
+        Decode one notification.
+
+        :return: FrameBlock of the frames completed by this notification (usually none or one)
+        """
+        self._add_notification(data, time.time() if now is None else now)
+        return self._block()
+
+    def parse_many(self, notifications):
+        """
+        Decode a batch of notifications at once.
+
+        :param notifications: List of (host time of reception, payload)
+        :return: FrameBlock of the frames completed by these notifications
+        """
+        for now, data in notifications:
+            self._add_notification(data, now)
+        return self._block()
+
+
+class ListNotificationParser(NotificationParser):
+    def __init__(self, n_ppg_channels=16):
+        super().__init__(n_ppg_channels)
+        self.keep = []
+        self.empty_frame = np.full(self.n_channels, np.nan)
+        self.frame = self.empty_frame.copy()
+
+    def _next_frame(self, frames):
+        frames.append(self.frame)
+        self.frame = self.empty_frame.copy()
+
+    def _count_message_list(self, idx):
+        if self.last_idx == -1:
+            self.missed_messages = {}
+            self.last_idx = idx
+        elif self.last_idx == 255:
+            self.last_idx = 0
+            if self.missed_messages:
+                print("[PPG]: missed messages:", self.missed_messages)
+            self.missed_messages = {}
+        else:
+            self.last_idx += 1
+
+    def parse(self, data, now=None):
+        """
+        The list-based decoding notif_callback used before the layout table (pop(0), int.from_bytes per value,
+        list concatenation of the remainders). Kept as the reference for check_parser and benchmark_parser.
+        """
+        now = time.time() if now is None else now
+        data = bytearray(data)
+        num_msg_chapters = self.n_chapters
+        self._count_message_list(data[0])
+        frames = []
+        idx = data.pop(0)
+        while idx > self.last_idx:
+            self.last_idx += 1
+            if idx in self.missed_messages.keys():
+                self.missed_messages[idx] = (self.missed_messages[idx][0] + 1, self.missed_messages[idx][1] + now - self.last_reception_time)
+            else:
+                self.missed_messages[idx] = (1, now - self.last_reception_time)
+            self.last_msg_chapter += 1
+            self.last_msg_chapter %= num_msg_chapters
+            if self.last_msg_chapter == num_msg_chapters - 1:
+                self._next_frame(frames)
+
+        self.last_reception_time = now
+        msg_chapter = data.pop(0)
+        self.last_msg_chapter = msg_chapter
+        if msg_chapter == 0:
+            self.frame[num_msg_chapters*4 + 3] = now
+            of_flags = [data[i*4] == 15 for i in range(4)]
+            ds = [int.from_bytes(data[i*4+1:4+i*4], "big") for i in range(4)]
+            for i, d in enumerate(ds):
+                self.frame[i] = np.nan if of_flags[i] else d
+            self.keep = data[16:]
+        elif msg_chapter in range(1, num_msg_chapters):
+            new_data = self.keep + data if self.keep else data
+            of_flags = [new_data[i*4] == 15 for i in range(4)]
+            ds = [int.from_bytes(new_data[i*4+1:(i+1)*4], "big") for i in range(4)]
+            for i, d in enumerate(ds):
+                self.frame[4*msg_chapter + i] = np.nan if of_flags[i] else d
+            self.keep = new_data[16:]
+            if msg_chapter == num_msg_chapters - 1:
+                ds = [int.from_bytes(self.keep[i*2:(i+1)*2], "big") for i in range(3)]
+                for i, d in enumerate(ds):
+                    if d > 32768:
+                        d -= 65536
+                    self.frame[(msg_chapter+1)*4 + i] = d / 32768.0 * 8 * 9.8
+                self._next_frame(frames)
+        elif msg_chapter == 19:
+            self.second_cnt += 1
+            self.keep = []
+        else:
+            print("chpt ", msg_chapter)
+        return frames
+
+
+def _parse_all(parser, notifications):
+    frames = []
+    for timestamp, payload in notifications:
+        frames.extend(parser.parse(payload, now=timestamp))
+    return np.array(frames).reshape(-1, parser.n_channels)
+
+
+def _assemble_all(assembler, notifications):
+    blocks = [assembler.parse(payload, now=timestamp) for timestamp, payload in notifications]
+    return FrameBlock(*(np.concatenate(part) for part in zip(*blocks)))
+
+
+def _parse_batches(parser, notifications, batch_size=BATCH_SIZE):
+    frames = [parser.parse_many(notifications[i:i + batch_size]) for i in range(0, len(notifications), batch_size)]
+    return np.concatenate(frames)
+
+
+def _assemble_batches(assembler, notifications, batch_size=BATCH_SIZE):
+    blocks = [assembler.parse_many(notifications[i:i + batch_size])
+              for i in range(0, len(notifications), batch_size)]
+    return FrameBlock(*(np.concatenate(part) for part in zip(*blocks)))
+
+
+def check_parser(notifications, n_ppg_channels=16):
+    """
+    Check that the table-driven parser decodes the notifications exactly like the list-based one, and that the
+    frame assembler encodes the same frames with its masks.
+    """
+    reference = _parse_all(ListNotificationParser(n_ppg_channels), notifications)
+    frames = _parse_all(NotificationParser(n_ppg_channels), notifications)
+    assert reference.shape == frames.shape, f"{frames.shape} frames instead of {reference.shape}"
+    assert np.array_equal(reference, frames, equal_nan=True), "Decoded frames differ"
+    batched = _parse_batches(NotificationParser(n_ppg_channels), notifications)
+    assert np.array_equal(batched, frames, equal_nan=True), "Batched decoding differs"
+    _check_assembler(frames, notifications, n_ppg_channels)
+    return frames
+
+
+def check_losses(notifications, n_ppg_channels=16, drop_every=7):
+    """
+    Check the loss handling: with every n-th notification dropped, the same frames have to come out, with exactly
+    the values of the dropped chapters missing and the dropped notifications counted.
+    """
+    complete = _parse_all(NotificationParser(n_ppg_channels), notifications)
+    dropped = [n for i, n in enumerate(notifications) if (i + 1) % drop_every]
+    parser = NotificationParser(n_ppg_channels)
+    frames = _parse_all(parser, dropped)
+    assert complete.shape == frames.shape, f"{frames.shape} frames instead of {complete.shape}"
+    received = ~np.isnan(frames)
+    assert np.array_equal(frames[received], complete[received]), "Values after a loss are misaligned"
+    assert parser.lost_packets == len(notifications) - len(dropped), "Lost messages are not counted"
+    _check_assembler(frames, dropped, n_ppg_channels)
+    return frames
+
+
+def _check_assembler(frames, notifications, n_ppg_channels):
+    block = _assemble_all(FrameAssembler(n_ppg_channels), notifications)
+    values = frames[:, :-1]
+    bits = (block.valid[:, None] >> np.arange(values.shape[1], dtype=np.uint64)) & np.uint64(1)
+    assert np.array_equal(bits.astype(bool), ~np.isnan(values)), "Validity masks differ"
+    assert np.array_equal(block.values[bits.astype(bool)], values[~np.isnan(values)].astype(np.float32))
+    assert np.array_equal(block.timestamps, frames[:, -1], equal_nan=True)
+    batched = _assemble_batches(FrameAssembler(n_ppg_channels), notifications)
+    assert all(np.array_equal(a, b, equal_nan=True) for a, b in zip(batched, block)), "Batched blocks differ"
+
+
+def benchmark_parser(path, n_ppg_channels=16, repeat=50, drop_every=0):
+    """
+    Decode the notifications recorded in a capture with the parsers.
+
+    :param path: Wireshark capture (.pcapng) with the notifications of a streaming session
+    :param n_ppg_channels: Number of PPG channels configured in that session
+    :param repeat: Number of passes over the notifications
+    :param drop_every: Drop every n-th notification to exercise the loss handling (0 = none)
+    """
+    notifications = load_notifications(path)
+    if drop_every:
+        frames = check_losses(notifications, n_ppg_channels, drop_every)
+        notifications = [n for i, n in enumerate(notifications) if (i + 1) % drop_every]
+        print(f"[PPG]: {len(notifications)} notifications, {frames.shape[0]} frames, "
+              f"{np.isnan(frames[:, :-1]).mean() * 100:.1f} % of the values lost")
+    else:
+        frames = check_parser(notifications, n_ppg_channels)
+        print(f"[PPG]: {len(notifications)} notifications, {frames.shape[0]} frames, identical output")
+    for parser_class, parse_all, mode in ((ListNotificationParser, _parse_all, "per notification"),
+                                          (NotificationParser, _parse_all, "per notification"),
+                                          (FrameAssembler, _assemble_all, "per notification"),
+                                          (NotificationParser, _parse_batches, f"batches of {BATCH_SIZE}"),
+                                          (FrameAssembler, _assemble_batches, f"batches of {BATCH_SIZE}")):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            parse_all(parser_class(n_ppg_channels), notifications)
+        duration = (time.perf_counter() - start) / (repeat * len(notifications))
+        print(f"[PPG]: {parser_class.__name__} ({mode}): {duration * 1e6:.2f} us per notification")
+
+
+if __name__ == "__main__":
+    ppg_path = os.path.dirname(os.path.abspath(__file__))
+    benchmark_parser(os.path.join(ppg_path, "Lars_112Hz_Green_IR.pcapng"), n_ppg_channels=16)
+    benchmark_parser(os.path.join(ppg_path, "Lars_112Hz_Green_IR.pcapng"), n_ppg_channels=16, drop_every=7)
+    benchmark_parser(os.path.join(ppg_path, "Lars_112Hz_allchannels.pcapng"), n_ppg_channels=32)
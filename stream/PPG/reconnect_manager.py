@@ -0,0 +1,193 @@
+import time
+import asyncio
+import numpy as np
+import bleak
+from bleak import BleakClient, BleakScanner
+
+CONNECT_ERRORS = (bleak.exc.BleakError, AttributeError, TimeoutError, asyncio.TimeoutError, OSError)
+
+
+class ReconnectManager:
+    def __init__(self, address, client_factory=BleakClient, scanner_factory=BleakScanner, initial_delay=0.1,
+                 max_delay=10.0, backoff_factor=2.0, jitter=0.3, scan_after=2, scan_timeout=5.0, connect_timeout=10.0,
+                 max_attempts=None, seed=None):
+        """
+        Connects to the wristband and reconnects after a lost link: directly to the cached device of the last
+        advertisement (or the address), and only after repeated failures with a scan, which stops as soon as the
+        device advertises. The delay between the attempts grows exponentially with random jitter.
+        The time from losing the link (or starting to connect) to the first sample is kept as a metric.
+
+        :param address: MAC address of the wristband
+        :param client_factory: BleakClient or a stand-in with the same interface
+        :param scanner_factory: BleakScanner or a stand-in (called with detection_callback)
+        :param initial_delay: Delay after the first failed attempt (s)
+        :param max_delay: Upper bound of the delay (s)
+        :param backoff_factor: Growth of the delay per failed attempt
+        :param jitter: Relative random variation of the delay
+        :param scan_after: Number of consecutive failures after which the device is scanned for
+        :param scan_timeout: Maximum duration of a scan (s)
+        :param connect_timeout: Maximum duration of a connect attempt (s)
+        :param max_attempts: Give up after this many consecutive failures (None = never)
+        :param seed: Seed of the jitter
+        """
+        self.address = address
+        self.client_factory = client_factory
+        self.scanner_factory = scanner_factory
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff_factor = backoff_factor
+        self.jitter = jitter
+        self.scan_after = scan_after
+        self.scan_timeout = scan_timeout
+        self.connect_timeout = connect_timeout
+        self.max_attempts = max_attempts
+        self.rng = np.random.default_rng(seed)
+
+        self.device = None  # device of the last advertisement, connecting to it skips the discovery of bleak
+        self.advertisement = None
+        self.last_seen = None
+        self.failures = 0
+        self.disconnected = None
+        self.outage_start = None
+        self.awaiting_first_sample = False
+        self.time_to_first_sample = []
+        self.counters = {"connects": 0, "failed_connects": 0, "scans": 0, "disconnects": 0}
+
+    def next_delay(self):
+        delay = min(self.max_delay, self.initial_delay * self.backoff_factor ** max(0, self.failures - 1))
+        return delay * (1 + self.jitter * self.rng.uniform(-1, 1))
+
+    def _on_disconnect(self, client):
+        if self.outage_start is None:
+            self.outage_start = time.perf_counter()
+        self.counters["disconnects"] += 1
+        if self.disconnected is not None:
+            self.disconnected.set()
+
+    async def scan(self):
+        """
+        Scan until the wristband advertises or the timeout expires, the device is cached.
+
+        :return: Whether the device was found
+        """
+        found = asyncio.Event()
+
+        def detection_callback(device, advertisement_data):
+            if device.address.upper() == self.address.upper():
+                self.device = device
+                self.advertisement = advertisement_data
+                self.last_seen = time.time()
+                found.set()
+
+        self.counters["scans"] += 1
+        scanner = self.scanner_factory(detection_callback=detection_callback)
+        await scanner.start()
+        try:
+            await asyncio.wait_for(found.wait(), self.scan_timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            await scanner.stop()
+        return found.is_set()
+
+    async def connect(self, stop_event):
+        """
+        Try until connected, stopped or max_attempts consecutive failures.
+
+        :param stop_event: threading.Event that ends the attempts
+        :return: Connected client or None
+        """
+        if self.outage_start is None:
+            self.outage_start = time.perf_counter()
+        while not stop_event.is_set():
+            if self.failures and self.failures % self.scan_after == 0:
+                print("[PPG]: BLE device not found, scanning ...")
+                if not await self.scan():
+                    # the cached device is stale as well
+                    self.device = None
+            client = self.client_factory(self.device or self.address, disconnected_callback=self._on_disconnect)
+            self.disconnected = asyncio.Event()
+            try:
+                await asyncio.wait_for(client.connect(), self.connect_timeout)
+            except CONNECT_ERRORS as e:
+                error = e
+            else:
+                if client.is_connected:
+                    # the failures are reset by the first sample, a link that drops while configuring keeps backing off
+                    self.counters["connects"] += 1
+                    self.awaiting_first_sample = True
+                    return client
+                error = "not connected"
+            self.failures += 1
+            self.counters["failed_connects"] += 1
+            if self.max_attempts is not None and self.failures >= self.max_attempts:
+                print(f"[PPG]: BLE device not found after {self.failures} attempts, abort!")
+                return None
+            delay = self.next_delay()
+            print(f"[PPG]: BLE connect error, retry in {delay:.2f} s", error)
+            await self._sleep(delay, stop_event)
+        return None
+
+    async def stream_failed(self, error, stop_event):
+        """
+        Count a connection lost before it streamed (e.g. during the configuration) as a failed attempt and wait the
+        delay before the next connect.
+
+        :param error: Exception that ended the connection
+        :param stop_event: threading.Event that ends the wait
+        :return: False after max_attempts consecutive failures
+        """
+        self.failures += 1
+        self.counters["failed_connects"] += 1
+        if self.max_attempts is not None and self.failures >= self.max_attempts:
+            print(f"[PPG]: BLE streaming failed after {self.failures} attempts, abort!")
+            return False
+        delay = self.next_delay()
+        print(f"[PPG]: BLE streaming error, reconnect in {delay:.2f} s", error)
+        await self._sleep(delay, stop_event)
+        return True
+
+    async def wait_disconnect(self, stop_event, poll_interval=0.1):
+        """
+        Wait until the link drops (notified by bleak) or the stop event is set.
+
+        :return: True if the link dropped
+        """
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(self.disconnected.wait(), poll_interval)
+                return True
+            except asyncio.TimeoutError:
+                pass
+        return False
+
+    def sample_received(self):
+        """
+        Called with every committed frame, the first one after a (re)connect ends the outage.
+
+        :return: Time to the first sample (s) if this ended an outage, else None
+        """
+        if not self.awaiting_first_sample or self.outage_start is None:
+            return None
+        self.awaiting_first_sample = False
+        self.failures = 0
+        duration = time.perf_counter() - self.outage_start
+        self.outage_start = None
+        self.time_to_first_sample.append(duration)
+        return duration
+
+    def summary(self):
+        times = np.array(self.time_to_first_sample)
+        return {
+            **self.counters,
+            "address": getattr(self.device, "address", self.address),
+            "rssi": getattr(self.advertisement, "rssi", None),
+            "time_to_first_sample": float(times[-1]) if len(times) else None,
+            "median_time_to_first_sample": float(np.median(times)) if len(times) else None,
+        }
+
+    @staticmethod
+    async def _sleep(delay, stop_event, poll_interval=0.1):
+        end = time.perf_counter() + delay
+        while not stop_event.is_set() and time.perf_counter() < end:
+            await asyncio.sleep(min(poll_interval, end - time.perf_counter()))
@@ -0,0 +1,329 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import threading
+from collections import namedtuple
+import numpy as np
+import bleak
+
+if __name__ == "__main__":
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PPG.ble_capture import load_notifications
+from PPG.notification_parser import PAYLOAD_BYTES
+from PPG.config_sequence import STREAM_CHAR_UUID, UART_CHAR_UUID
+
+default_replay_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Lars_112Hz_Green_IR.pcapng")
+SECOND_CHAPTER = 19
+
+FakeCharacteristic = namedtuple("FakeCharacteristic", ["uuid", "handle", "description"])
+FakeDevice = namedtuple("FakeDevice", ["address", "name"])
+FakeAdvertisement = namedtuple("FakeAdvertisement", ["local_name", "rssi"])
+
+
+def load_replay_messages(path=default_replay_path):
+    """
+    Recorded notifications of a capture as (time since the first one, chapter + payload), the message index
+    is left out because the virtual bracelet counts its own.
+    """
+    notifications = load_notifications(path)
+    assert notifications, f"No notifications in {path}"
+    start = notifications[0][0]
+    return [(timestamp - start, bytes(payload[1:])) for timestamp, payload in notifications]
+
+
+def synthesize_messages(n_ppg_channels=16, duration=10.0, frame_rate=128, heart_rate=70, overflow_prob=0.0, seed=None):
+    """
+    Notifications of a synthetic PPG recording: a pulse wave with a dicrotic notch at the heart rate on every
+    channel (different gain and offset per channel), noise, the gravity on the accelerometer and the
+    seconds chapter once per second.
+
+    :return: List of (time since the start, chapter + payload)
+    """
+    rng = np.random.default_rng(seed)
+    n_chapters = n_ppg_channels // 4
+    n_frames = int(duration * frame_rate)
+    t = np.arange(n_frames) / frame_rate
+    phase = 2 * np.pi * heart_rate / 60 * t
+    pulse = np.sin(phase) + 0.5 * np.sin(2 * phase + 1.0) + 0.2 * np.sin(3 * phase + 2.0)
+    gain = rng.uniform(2e3, 2e4, n_ppg_channels)
+    offset = rng.uniform(2e5, 2e6, n_ppg_channels)
+    ppg = offset + gain * pulse[:, None] + rng.normal(0, 50, (n_frames, n_ppg_channels))
+    ppg = np.clip(ppg, 0, 0xFFFFFF).astype(">u4")
+    flags = np.where(rng.random(ppg.shape) < overflow_prob, 15, 0).astype(">u4")
+    words = (flags << 24) | ppg
+    acc = np.round(np.array([0.0, 0.0, 1.0]) * 32768 / 8 + rng.normal(0, 20, (n_frames, 3))).astype(np.int64) % 65536
+
+    messages = []
+    for frame in range(n_frames):
+        stream = words[frame].tobytes() + acc[frame].astype(">u2").tobytes()
+        stream += bytes(n_chapters * PAYLOAD_BYTES - len(stream))
+        for chapter in range(n_chapters):
+            messages.append((t[frame], bytes([chapter]) + stream[chapter * PAYLOAD_BYTES:(chapter + 1) * PAYLOAD_BYTES]))
+        if frame % frame_rate == frame_rate - 1:
+            messages.append((t[frame], bytes([SECOND_CHAPTER]) + bytes(PAYLOAD_BYTES)))
+    return messages
+
+
+class FakeServices:
+    def __init__(self, uuids):
+        self.characteristics = {uuid: FakeCharacteristic(uuid, handle, "virtual") for handle, uuid in enumerate(uuids)}
+
+    def get_characteristic(self, specifier):
+        if isinstance(specifier, FakeCharacteristic):
+            return specifier
+        return self.characteristics.get(specifier)
+
+
+class VirtualBracelet:
+    def __init__(self, messages=None, speed=1.0, loss_prob=0.0, reorder_prob=0.0, disconnect_interval=None,
+                 connect_failures=0, connect_delay=0.05, loop=True, seed=None):
+        """
+        Stand-in for the wristband behind the subset of the Bleak API used by WristbandListener. The bracelet keeps
+        its state across clients, so the listener can reconnect to it like to the real one:
+
+            bracelet = VirtualBracelet(speed=10, loss_prob=0.01)
+            listener = WristbandListener(client_factory=bracelet.client, scanner_factory=bracelet.scanner)
+
+        :param messages: (time, chapter + payload) to send, the notifications of the default capture if None
+        :param speed: Replay speed relative to real time
+        :param loss_prob: Probability of a lost notification (the message index still advances)
+        :param reorder_prob: Probability that a notification is delivered after the next one
+        :param disconnect_interval: Seconds of streaming (device time) after which the link drops
+        :param connect_failures: Number of connect attempts that fail before the first success
+        :param connect_delay: Duration of a connect (s)
+        :param loop: Start the messages over at the end
+        :param seed: Seed of the loss and reorder injection
+        """
+        self.messages = load_replay_messages() if messages is None else messages
+        self.duration = self.messages[-1][0] + (self.messages[-1][0] - self.messages[0][0]) / len(self.messages)
+        self.speed = speed
+        self.loss_prob = loss_prob
+        self.reorder_prob = reorder_prob
+        self.disconnect_interval = disconnect_interval
+        self.connect_failures = connect_failures
+        self.connect_delay = connect_delay
+        self.loop = loop
+        self.rng = np.random.default_rng(seed)
+
+        self.address = None  # reported by the scanner, the address of the first client
+        self.connected_client = None
+        self.writes = []
+        self.counters = {"sent": 0, "lost": 0, "reordered": 0, "connects": 0, "failed_connects": 0,
+                         "disconnects": 0, "scans": 0}
+
+    def client(self, address_or_device, disconnected_callback=None, **kwargs):
+        return FakeBleakClient(self, address_or_device, disconnected_callback)
+
+    def scanner(self, detection_callback=None, **kwargs):
+        return FakeBleakScanner(self, detection_callback)
+
+    def get_counters(self):
+        return dict(self.counters)
+
+    def _connect(self, client):
+        if self.address is None:
+            self.address = client.address
+        if self.connect_failures > 0:
+            self.connect_failures -= 1
+            self.counters["failed_connects"] += 1
+            raise bleak.exc.BleakError(f"Device with address {client.address} was not found (virtual)")
+        self.connected_client = client
+        self.counters["connects"] += 1
+
+    async def _stream(self, client, callback, characteristic):
+        """
+        Send the notifications on schedule, every due one at once after a sleep (the BLE link delivers in bursts).
+        """
+        start = time.perf_counter()
+        position, cycle, idx = 0, 0, 0
+        held = None
+        while client.is_connected:
+            if position == len(self.messages):
+                if not self.loop:
+                    break
+                position, cycle = 0, cycle + 1
+            stream_time = cycle * self.duration + self.messages[position][0]
+            if self.disconnect_interval is not None and stream_time >= self.disconnect_interval:
+                # the link drops, the client is notified like by bleak
+                self.counters["disconnects"] += 1
+                client._drop()
+                break
+            delay = start + stream_time / self.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            payload = bytearray([idx]) + self.messages[position][1]
+            position += 1
+            idx = (idx + 1) % 256
+            if self.rng.random() < self.loss_prob:
+                self.counters["lost"] += 1
+                continue
+            if held is None and self.rng.random() < self.reorder_prob:
+                held = payload
+                self.counters["reordered"] += 1
+                continue
+            callback(characteristic, payload)
+            self.counters["sent"] += 1
+            if held is not None:
+                callback(characteristic, held)
+                self.counters["sent"] += 1
+                held = None
+
+
+class FakeBleakClient:
+    def __init__(self, bracelet, address_or_device, disconnected_callback=None):
+        """
+        BleakClient connected to a VirtualBracelet: connect, start_notify, write_gatt_char, stop_notify, disconnect.
+        """
+        self.bracelet = bracelet
+        self.address = getattr(address_or_device, "address", address_or_device)
+        self.disconnected_callback = disconnected_callback
+        self.services = FakeServices([STREAM_CHAR_UUID, UART_CHAR_UUID])
+        self._connected = False
+        self.notify_tasks = {}
+
+    @property
+    def is_connected(self):
+        return self._connected
+
+    def _drop(self):
+        was_connected = self._connected
+        self._connected = False
+        self.notify_tasks = {}
+        if self.bracelet.connected_client is self:
+            self.bracelet.connected_client = None
+        if was_connected and self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+
+    def _check_connected(self):
+        if not self._connected:
+            raise bleak.exc.BleakError("Not connected (virtual)")
+
+    async def connect(self, **kwargs):
+        await asyncio.sleep(self.bracelet.connect_delay)
+        self.bracelet._connect(self)
+        self._connected = True
+        return True
+
+    async def disconnect(self):
+        for task in self.notify_tasks.values():
+            task.cancel()
+        self._drop()
+        return True
+
+    async def write_gatt_char(self, char_specifier, data, response=False):
+        self._check_connected()
+        characteristic = self.services.get_characteristic(char_specifier)
+        self.bracelet.writes.append((characteristic.uuid, bytes(data), response))
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        self._check_connected()
+        characteristic = self.services.get_characteristic(char_specifier)
+        self.notify_tasks[characteristic.uuid] = asyncio.ensure_future(
+            self.bracelet._stream(self, callback, characteristic))
+
+    async def stop_notify(self, char_specifier):
+        self._check_connected()
+        characteristic = self.services.get_characteristic(char_specifier)
+        task = self.notify_tasks.pop(characteristic.uuid, None)
+        if task is not None:
+            task.cancel()
+
+
+class FakeBleakScanner:
+    def __init__(self, bracelet, detection_callback=None):
+        self.bracelet = bracelet
+        self.detection_callback = detection_callback
+
+    async def start(self):
+        self.bracelet.counters["scans"] += 1
+        if self.detection_callback is not None:
+            # the bracelet advertises as soon as it is scanned for
+            await asyncio.sleep(self.bracelet.connect_delay)
+            self.detection_callback(FakeDevice(self.bracelet.address, "virtual bracelet"),
+                                    FakeAdvertisement("virtual bracelet", -60))
+
+    async def stop(self):
+        pass
+
+
+def benchmark_listener(bracelet, duration=10.0, n_ppg_channels=16):
+    """
+    Stream from a virtual bracelet into a WristbandListener and report the throughput of the parser and the buffer,
+    and the latency from the arrival of a notification to the wake-up of a consumer blocked in read_blocking.
+
+    :param bracelet: VirtualBracelet, e.g. at speed=10 for 10x real time
+    :param duration: Wall time of the run (s)
+    """
+    from PPG.wristband_listener import WristbandListener
+
+    listener = WristbandListener(n_ppg_channels=n_ppg_channels, config_path=default_replay_path,
+                                 client_factory=bracelet.client, scanner_factory=bracelet.scanner)
+    ring = listener.data_buffer.ring
+    callback = listener.notif_callback
+    busy = [0.0]
+    commits = {}  # ring sequence number -> arrival of the notification that committed it
+    wakes = []  # (time, sequence number read up to) of the consumer
+    done = threading.Event()
+
+    def timed_callback(sender, data):
+        start = time.perf_counter()
+        callback(sender, data)
+        busy[0] += time.perf_counter() - start
+        commits.setdefault(ring.seq, start)
+
+    def consume():
+        reader = ring.reader()
+        while not done.is_set():
+            view, _ = reader.read_blocking(timeout=0.1)
+            if view.shape[1]:
+                wakes.append((time.perf_counter(), reader.seq))
+
+    listener.notif_callback = timed_callback
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    listener.start_threads()
+    time.sleep(duration)
+    done.set()
+    consumer.join()
+    frames = listener.data_buffer.ring.seq
+    reconnect = listener.reconnect.summary()
+    listener.stop_threads()
+
+    counters = bracelet.get_counters()
+    print(f"[VirtualBracelet]: {counters}")
+    print(f"[VirtualBracelet]: {counters['sent']} notifications -> {frames} frames in {duration:.1f} s "
+          f"({counters['sent'] / duration:.0f} notifications/s, {frames / duration:.0f} frames/s), "
+          f"{listener.parser.lost_packets} messages detected as lost")
+    print(f"[VirtualBracelet]: reconnect {reconnect}")
+    if counters["sent"]:
+        print(f"[VirtualBracelet]: callback {busy[0] / counters['sent'] * 1e6:.1f} us per notification, "
+              f"{busy[0] / duration * 100:.1f} % of the event loop")
+    latencies = [(wake - commits[seq]) * 1e3 for wake, seq in wakes if seq in commits]
+    if latencies:
+        print(f"[VirtualBracelet]: notification to consumer {np.median(latencies):.2f} ms median, "
+              f"{np.percentile(latencies, 99):.2f} ms p99, {max(latencies):.2f} ms max ({len(latencies)} wake-ups)")
+    return counters, frames
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream a WristbandListener from a virtual bracelet")
+    parser.add_argument("--replay", type=str, default=default_replay_path, help="capture (.pcapng) with the notifications to replay")
+    parser.add_argument("--synthetic", action="store_true", help="send a synthetic PPG waveform instead of the capture")
+    parser.add_argument("--n_ppg_channels", type=int, default=16, help="PPG channels of the stream")
+    parser.add_argument("--speed", type=float, default=10.0, help="replay speed relative to real time")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability of a lost notification")
+    parser.add_argument("--reorder", type=float, default=0.0, help="probability of a swapped notification")
+    parser.add_argument("--disconnect", type=float, default=None, help="seconds of streaming after which the link drops")
+    parser.add_argument("--connect_failures", type=int, default=0, help="failed connect attempts before the first success")
+    parser.add_argument("--duration", type=float, default=10.0, help="wall time of the run (s)")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        messages = synthesize_messages(args.n_ppg_channels, duration=60)
+    else:
+        messages = load_replay_messages(args.replay)
+    virtual_bracelet = VirtualBracelet(messages, speed=args.speed, loss_prob=args.loss, reorder_prob=args.reorder,
+                                       disconnect_interval=args.disconnect, connect_failures=args.connect_failures)
+    benchmark_listener(virtual_bracelet, duration=args.duration, n_ppg_channels=args.n_ppg_channels)
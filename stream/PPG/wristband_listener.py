@@ -1,19 +1,20 @@
 import asyncio
 import threading
-from multiprocessing import Manager, Process
-import multiprocessing
 #import matplotlib
 #matplotlib.use("TkAgg")
 #import matplotlib.pyplot as plt
 #import matplotlib.animation as animation
 import time
-import pyshark
 from bleak import BleakClient, BleakScanner
-import bleak
 from collections import deque
 import csv
 import os
 import numpy as np
+from session_recorder import SessionRecorder
+from ring_buffer import SampleRingBuffer
+from PPG.notification_parser import FrameAssembler, mask_invalid
+from PPG.config_sequence import load_config_sequence
+from PPG.reconnect_manager import ReconnectManager, CONNECT_ERRORS
 import nest_asyncio
 nest_asyncio.apply()
 import pandas as pd
@@ -26,7 +27,7 @@ bracelet_uuids = {
 }
 
 class DataBuffer:
-    def __init__(self, n_channels=19, frame_rate=128, plotting_window=5, csv_window=2, fileindex=0):
+    def __init__(self, n_channels=19, frame_rate=128, plotting_window=5, csv_window=2, fileindex=0, ring=None):
         
         # timestamp = time.strftime("%Y%m%d-%H%M%S")
         # self.filename = f"..//recordings//ppg_data_{timestamp}"
@@ -36,41 +37,81 @@ class DataBuffer:
         self.csv_window = csv_window
         self.frame_rate = frame_rate
 
-
-        self.buffers = [deque(maxlen=int((plotting_window+1)*frame_rate + 1)) for _ in range(n_channels)]
-        self.csv_buffers = [deque(maxlen=int((csv_window+1)*frame_rate+1)) for _ in range(n_channels)]
+        self.plotting_length = int((plotting_window+1)*frame_rate + 1)
+        self.fields = [f"ppg_{i}" for i in range(n_channels - 4)] + ["acc_x", "acc_y", "acc_z", "timestamp"]
+        # bitmasks of the valid and the overflowed values of a frame (bit i for channel i), stored with the frames
+        self.mask_fields = ["valid", "overflow"]
+        # whole frames written by the BLE callback, other processes read them from the session file of the daemon
+        if ring is None:
+            ring = SampleRingBuffer(self.fields + self.mask_fields, capacity=2*int((max(plotting_window, csv_window)+1)*frame_rate + 1))
+        self.ring = ring
+        self.new_data_reader = self.ring.reader()
+        self.csv_reader = self.ring.reader()
 
         self.recording = False
+        self.recorder = None
+        self.record_lock = threading.Lock()
+        self.n_segments = 0  # recordings started, the later ones are appended to the file of the first
         self.n_channels = n_channels
         
         self.running = True
-
-    def add_data(self, qidx, qu):
-        # if qu.qsize() > 1:
-        while not qu.empty():
-            val = qu.get(True, 0.0005)
-            self.buffers[qidx].append(val)
-            self.csv_buffers[qidx].append(val)
+        self.stop_dump = threading.Event()
+
+    def add_frames(self, frames):
+        """Commit whole frames (n_frames x n_channels + masks), see FrameBlock.rows."""
+        self.ring.write(frames)
+
+    def mask_gaps(self, block, fill=np.nan):
+        """
+        Channels of a block read from the ring with the values that are not valid (lost or overflowed) set to fill.
+
+        :param block: Block (n_channels + masks x n_frames) as returned by get_since
+        :return: Array (n_channels x n_frames)
+        """
+        values = np.array(block[:self.n_channels])
+        mask_invalid(values[:-1], block[self.n_channels], fill)
+        return values
+
+    def get_since(self, seq):
+        """
+        Zero-copy read of all frames after a sequence number, for consumers with their own cursor.
+        
+        :return: View (n_channels + masks x n_frames), sequence number to continue from, overrun flag
+        """
+        return self.ring.get_since(seq)
         
+    def get_new_data(self, timeout=None):
+        """
+        Frames committed since the last call, per channel and with the validity/overflow masks as the last two
+        rows. The values are dense, 0 where not valid. With a timeout, block until at least one complete frame
+        arrives instead of polling.
+        """
+        block, overrun = self.new_data_reader.read_blocking(timeout) if timeout else self.new_data_reader.read()
+        if overrun:
+            print("[PPG]: consumer fell behind, frames were lost")
+        return list(block.copy())
+
     def set_running(self, value):
         self.running = value
-
-    def dump_to_txt(self):
-        # with open(self.filename, mode='a', newline='') as file:
-        #     writer = csv.writer(file)
-        #     for i in range(self.n_channels):
-        #         row = f'{i}' + np.array(self.csv_buffers[i]).astype(str)
-        #         writer.writerow(row)
-        while self.running:
-            if self.recording:
-                f = open(f"{self.filename}.txt", "a")
-                for i in range(self.n_channels):
-                    f.write(f"{i} ")
-                    while self.csv_buffers[i]:
-                        f.write(f"{self.csv_buffers[i].popleft()} ")
-                    f.write(" \n")
-                f.close()
-            time.sleep(self.csv_window)
+        if not value:
+            self.stop_dump.set()
+
+    def dump_to_file(self):
+        # wakes up for every recording batch and immediately when stopped
+        while self.running and not self.stop_dump.wait(self.csv_window):
+            self.flush_recording()
+
+    def flush_recording(self):
+        """Hand all frames since the last flush to the recorder."""
+        with self.record_lock:
+            if self.recording and self.recorder is not None:
+                first_seq = self.csv_reader.seq
+                block, overrun = self.csv_reader.read()
+                if overrun:
+                    print("[PPG]: recording fell behind, frames were lost")
+                    first_seq = self.csv_reader.seq - block.shape[1]
+                # arrival time of every sample on the host (s)
+                self.recorder.write(block.T, first_seq=first_seq, host_time=block[self.ring.field_index["timestamp"]])
 
     def set_recording(self, value):
         if value and not self.recording:
@@ -92,42 +133,39 @@ class DataBuffer:
     #         time.sleep(self.csv_window)
 
     def start_recording(self):
-        self.recording = True
-        ti = time.time()
-        with open(f"{self.filename}.txt", 'a') as f:
-            f.write(f'start time: {ti} \n')
-        f.close()
+        with self.record_lock:
+            self.csv_reader.skip_to_end()
+            self.recorder = SessionRecorder(f"{self.filename}.bin", self.fields + self.mask_fields, device="ppg",
+                                            metadata={"frame_rate": self.frame_rate},
+                                            append=self.n_segments > 0)
+            self.n_segments += 1
+            self.recording = True
         print("[PPG]: recording started")
 
     def stop_recording(self):
-        self.recording = False
-        tf = time.time()
-
-        with open(f"{self.filename}.txt", 'a') as f:
-            f.write(f'end time: {tf} \n')
-        f.close()
+        self.flush_recording()
+        with self.record_lock:
+            self.recording = False
+            self.recorder.close()
+            self.recorder = None
 
         print("[PPG]: recording stopped")
-        print(f"[PPG]: data saved to {self.filename}.txt")
+        print(f"[PPG]: data saved to {self.filename}.bin")
 
     def plotting_queues(self):
-        return [np.array(self.buffers[i]) for i in range(self.n_channels)]
+        # the plots interpolate over the gaps
+        return list(self.mask_gaps(self.ring.latest(self.plotting_length)))
 
 class WristbandListener:
     def __init__(self, bracelet="M", n_ppg_channels=16, frame_rate=128, window_size=5, 
-                 csv_window=2, queue_update_rate=5, fileindex=0):
+                 csv_window=2, fileindex=0, config_path=None, client_factory=BleakClient, scanner_factory=BleakScanner):
         self.n_ppg_channels = n_ppg_channels
         self.frame_rate = frame_rate
-        self.queue_max_length = int((window_size+1)*frame_rate + 1)
-        self.data_queues = [multiprocessing.Queue(maxsize=self.queue_max_length) 
-                            for _ in range(n_ppg_channels+4)]
-        self.second_cnt = 0  # the device counts seconds
-        self.last_idx = -1  # index of received message, counts 0-255 (to check for dropped packages)
-        self.last_reception_time = 0
-        self.last_msg_chapter = -1
-        self.queue_update_rate = queue_update_rate
-        self.keep = []
+        self.n_channels = n_ppg_channels + 4
+        # assembles the frames from the notifications, tracks the message index (0-255) to detect dropped packages
+        self.parser = FrameAssembler(n_ppg_channels)
         self.client = None
+        self.last_frame_time = None
         self.threads = []
         # self.ppg_exp_avg = [0 for _ in range(n_ppg_channels)]
         # self.sf = 0.9s
@@ -137,6 +175,8 @@ class WristbandListener:
         self.stop_event = threading.Event()  
         
         self.BRACELET_UUID = bracelet_uuids[bracelet]
+        # BleakClient/BleakScanner, or the stand-ins of PPG.virtual_bracelet
+        self.reconnect = ReconnectManager(self.BRACELET_UUID, client_factory=client_factory, scanner_factory=scanner_factory)
         self.STREAM_CHAR_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"
         self.UART_CHAR_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"
         Wireshark_logs_path = r"C:\Users\lhauptmann\Code\WristPPG2\stream\PPG"
@@ -146,191 +186,94 @@ class WristbandListener:
         self.WIRESHARK_LOG_FP = r'C:\Users\lhauptmann\Code\WristPPG2\stream\PPG\Lars_112Hz_Green_Ir.pcapng'
         #self.WIRESHARK_LOG_FP = r'C:\Users\lhauptmann\Code\WristPPG2\stream\PPG\Lars_112Hz_Green_ambient.pcapng'
         #self.WIRESHARK_LOG_FP = r'C:\Users\lhauptmann\Code\WristPPG2\stream\PPG\Lars_112Hz_Green_red.pcapng'
+        if config_path is not None:
+            self.WIRESHARK_LOG_FP = config_path
         assert(os.path.isfile(self.WIRESHARK_LOG_FP))
 
     async def connect_and_stream(self):
-        capture = pyshark.FileCapture(self.WIRESHARK_LOG_FP, use_json=True, include_raw=True)
-        config_s, config_e = self._find_config_sequence(capture)
-        print(f"[PPG]: Found config, start idx: {config_s} end idx: {config_e}")
-        print("[PPG]: starting ble scanning ...")
-        disconn_cnt = 0
+        # compiled once per capture, every (re)connect only replays the commands
+        commands = load_config_sequence(self.WIRESHARK_LOG_FP)
+        print(f"[PPG]: Found config, {len(commands)} commands")
+        print("[PPG]: connecting ...")
         while not self.stop_event.is_set():
-            if self.client is None or not self.client.is_connected:
-                self.client = BleakClient(self.BRACELET_UUID)
-                try:
-                    await self.client.connect()
-                except (bleak.exc.BleakDeviceNotFoundError, bleak.exc.BleakError, AttributeError, TimeoutError) as e:
-                    print("[PPG]: BLE connect error, retry ", e)
-                    disconn_cnt += 1
-                if self.client.is_connected:
-                    disconn_cnt = 0
-                    print("[PPG]: CONNECTED BLE BRACELET")
-                    await self._stream(capture, config_s, config_e)
-                    while max([q.qsize() for q in self.data_queues]) < self.queue_max_length and not self.stop_event.is_set():
-                        await asyncio.sleep(1)
-                    print("[PPG]: full queues, exit")
-                    await capture.close_async()
-                    await self.client.stop_notify(self.STREAM_CHAR_UUID)
-                    await self.client.disconnect()
-                    break
-            if disconn_cnt == 3:
-                print("[PPG]: BLE device not found, do a scan and retry")
-                scanner = BleakScanner()
-                await scanner.start()
-                await asyncio.sleep(3)
-                await scanner.stop()
-            elif disconn_cnt > 3:
-                print("[PPG]: BLE device still not found, abort!")
+            self.client = await self.reconnect.connect(self.stop_event)
+            if self.client is None:
                 break
-            else:
-                await asyncio.sleep(1)
-                
-            
-
-    def _find_config_sequence(self, capture):
-        config_s, config_e = None, None
-        for capidx, cap in enumerate(capture):
-            if config_s is None:
-                if 'btatt' in cap.frame_info.protocols and cap.btatt.has_field('uart_tx'):
-                    config_s = capidx
-            elif 'btatt' in cap.frame_info.protocols and cap.btatt.opcode == '0x1b':
-                config_e = capidx
-                break
-        assert config_s is not None, "[PPG]: Error: no config found in wireshark file"
-        assert config_e is not None, "[PPG]: Error: no end of config found in wireshark file"
-        return config_s, config_e
+            print("[PPG]: CONNECTED BLE BRACELET")
+            # the message index starts over, the partial frame of the last connection is lost
+            self.parser.restart()
+            try:
+                await self._stream(commands)
+            except CONNECT_ERRORS as e:
+                # the link dropped while configuring, start over with a new connection
+                await self._disconnect()
+                if not await self.reconnect.stream_failed(e, self.stop_event):
+                    break
+                continue
+            if await self.reconnect.wait_disconnect(self.stop_event):
+                print("[PPG]: connection lost, reconnect")
+                continue
+            print("[PPG]: stopped, exit")
+            await self._disconnect(self.STREAM_CHAR_UUID)
 
-    async def _stream(self, capture, config_s, config_e):
-        stream_char = self.client.services.get_characteristic(self.STREAM_CHAR_UUID)
-        uart_char = self.client.services.get_characteristic(self.UART_CHAR_UUID)
-        capture = pyshark.FileCapture(self.WIRESHARK_LOG_FP, use_json=True, include_raw=True)
-        for idx, cap in enumerate(capture):
-            if idx < config_s or idx > config_e:
-                    continue
+    async def _disconnect(self, notify_uuid=None):
+        """
+        Disconnect the client, the link may already be gone.
+        """
+        try:
+            if notify_uuid is not None:
+                await self.client.stop_notify(notify_uuid)
+            await self.client.disconnect()
+        except CONNECT_ERRORS as e:
+            print("[PPG]: disconnect error", e)
+
+    async def _stream(self, commands):
+        """
+        Replay the configuration of the vendor app, it ends with the subscription to the stream characteristic.
+        """
+        characteristics = {uuid: self.client.services.get_characteristic(uuid)
+                           for uuid in {command["uuid"] for command in commands}}
+        for command in commands:
             if self.stop_event.is_set():
                 break
-            if 'btatt' in cap.frame_info.protocols:
-                if not cap.btatt.has_field('opcode'):
-                    print(idx, " no opcode!!!!")
-                    continue
-                if cap.btatt.opcode == '0x12':
-                    uuid = cap.btatt.handle_tree.uuid128.replace(':', '') if cap.btatt.handle_tree.has_field('uuid128') else cap.btatt.handle_tree.characteristic_uuid128.replace(':', '')
-                    if uuid == "6e400001b5a3f393e0a9e50e24dcca9e":
-                        await self.client.start_notify(stream_char, self.notif_callback)
-                    elif uuid == "6e400002b5a3f393e0a9e50e24dcca9e":
-                        await self.client.write_gatt_char(uart_char, bytes.fromhex(cap.btatt_raw.value)[3:], response=True)
-                elif cap.btatt.opcode in ['0x13', '0x0a', '0x0b']:
-                    pass
-                else:
-                    print(".", end="")
-        while self.data_queues[0].qsize()<128 and not self.stop_event.is_set():            
-            await asyncio.sleep(1)
-            
-        await capture.close_async()
-            
-            
-            
+            if command["op"] == "notify":
+                await self.client.start_notify(characteristics[command["uuid"]], self.notif_callback)
+            elif command["op"] == "write":
+                await self.client.write_gatt_char(characteristics[command["uuid"]], bytes.fromhex(command["value"]),
+                                                  response=command.get("response", True))
 
     def notif_callback(self, sender, data):
-        num_msg_chapters = self.n_ppg_channels // 4
-        #print(data)
-        if self.last_idx == -1:
-            self.missed_messages = {}
-            self.last_idx = data[0]
-        elif self.last_idx == 255:
-            self.last_idx = 0
-            if self.missed_messages:
-                print("[PPG]: missed messages:", self.missed_messages)
-            self.missed_messages = {}
-        else:
-            self.last_idx += 1
-            
-        
+        # every notification is decoded as it arrives, a frame is committed with its last chapter
         try:
-            
-            idx = data.pop(0)
-            
-            if idx > self.last_idx:
-                print(data)
-            #print(idx)
-            while idx > self.last_idx: #Package loss
-                #print(self.last_idx, idx)
-                self.last_idx += 1
-                #print("error, missed message idx {}".format(idx))
-                if idx in self.missed_messages.keys():
-                    self.missed_messages[idx] = (self.missed_messages[idx][0] + 1, self.missed_messages[idx][1] +  time.time() - self.last_reception_time)
-                else:
-                    self.missed_messages[idx] = (1, time.time() - self.last_reception_time)
-                    
-                # Fill up the queues with NaNs if package got lost
-                self.last_msg_chapter += 1
-                self.last_msg_chapter %= num_msg_chapters
-                for qu in self.data_queues[self.last_msg_chapter*4:(self.last_msg_chapter+1)*4]:
-                    qu.put_nowait(np.nan)
-                    
-                if self.last_msg_chapter == num_msg_chapters - 1:
-                    for qu in self.data_queues[(self.last_msg_chapter+1)*4:(self.last_msg_chapter+1)*4+3]:
-                        qu.put_nowait(np.nan)     
-                        
-                if self.last_msg_chapter == 0: # timestamp
-                    self.data_queues[num_msg_chapters*4 + 3].put_nowait(np.nan) 
-                
-
-            self.last_reception_time = time.time()
-            msg_chapter = data.pop(0)
-            self.last_msg_chapter = msg_chapter
-            #print(idx, msg_chapter)
-            
-            
-            
-            if msg_chapter == 0: # first msg_chapter
-                self.data_queues[num_msg_chapters*4 + 3].put_nowait(time.time()) 
-                # self.of_flags[:4] = [data[i*4] == 15 for i in range(4)]
-                of_flags = [data[i*4] == 15 for i in range(4)]
-                ds = [int.from_bytes(data[i*4+1:4+i*4], "big") for i in range(4)]
-                for i, (d, qu) in enumerate(zip(ds, self.data_queues[:4])):
-                    if of_flags[i]:
-                        qu.put_nowait(np.nan)
-                    else:
-                        qu.put_nowait(d)
-                        
-                self.keep = data[16:]
-
-            elif msg_chapter in range(1, num_msg_chapters):
-                
-                if self.keep:
-                    new_data = self.keep + data
-                else:
-                    new_data = data
-                of_flags = [new_data[i*4] == 15 for i in range(4)]
-                ds = [int.from_bytes(new_data[i*4+1:(i+1)*4], "big") for i in range(4)]
-                for i, (d, qu) in enumerate(zip(ds, self.data_queues[4*msg_chapter:4*(msg_chapter+1)])):
-                    if of_flags[i]:
-                        qu.put_nowait('NaN')
-                    else:
-                        qu.put_nowait(d)
-                self.keep = new_data[16:]
-
-                if msg_chapter == num_msg_chapters - 1: # last msg_chapter
-                    ds = [int.from_bytes(self.keep[i*2:(i+1)*2], "big") for i in range(3)]
-                    #print(ds)
-                    #print(ds, num_msg_chapters*4, num_msg_chapters*4+3, len(self.data_queues))
-                    for d, qu in zip(ds, self.data_queues[(msg_chapter+1)*4:(msg_chapter+1)*4+3]):
-                        if d > 32768:
-                            d -= 65536
-                        qu.put_nowait(d / 32768.0 * 8 * 9.8)
-                        #print(msg_chapter, (num_msg_chapters+1)*4, (num_msg_chapters+1)*4+3)
-
-            elif msg_chapter == 19: # every second a timestamp
-                self.second_cnt += 1
-                self.keep = []
-                #print("timestamp seconds: ", self.second_cnt)
-            else:
-                print("chpt ", msg_chapter)
-                
+            block = self.parser.parse(data)
         except Exception as exc:
-            print("full q")
+            print("[PPG]: notification error")
             print(exc)
+            # resynchronise on the next message
+            self.parser.restart()
+            return
+        if block.n_frames:
+            time_to_first_sample = self.reconnect.sample_received()
+            if time_to_first_sample is not None:
+                print(f"[PPG]: first sample after {time_to_first_sample * 1000:.0f} ms")
+                self._fill_gap(block.timestamps[0])
+            self.data_buffer.add_frames(block.rows())
+            if not np.isnan(block.timestamps[-1]):
+                self.last_frame_time = block.timestamps[-1]
+
+    def _fill_gap(self, first_time):
+        """
+        Frames missed while disconnected, marked as not valid, so the sequence numbers stay continuous in time.
+        The values are NaN instead of the usual 0: consumers that ignore the masks, e.g. the knock detection,
+        must not see a jump from 0 back to the signal.
+        """
+        if self.last_frame_time is None or np.isnan(first_time):
+            return
+        n_missed = int(round((first_time - self.last_frame_time) * self.frame_rate)) - 1
+        if n_missed > 0:
+            gap = np.full((n_missed, len(self.data_buffer.ring.fields)), np.nan)
+            gap[:, self.n_channels:] = 0  # no valid and no overflowed values
+            self.data_buffer.add_frames(gap)
 
 
     def start_streaming(self):
@@ -341,20 +284,11 @@ class WristbandListener:
     def start_threads(self):
         if self.threads == []:
             self.threads.append(threading.Thread(target=self.start_streaming, daemon=True))
-            self.threads.append(threading.Thread(target=self.data_transfer, daemon=True))
-            self.threads.append(threading.Thread(target=self.data_buffer.dump_to_txt, daemon=True))
+            self.threads.append(threading.Thread(target=self.data_buffer.dump_to_file, daemon=True))
 
         for thread in self.threads:
             thread.start()
 
-    def data_transfer(self):
-        while not self.stop_event.is_set():
-            if all(q.empty() for q in self.data_queues):
-                continue
-            for qidx, qu in enumerate(self.data_queues):
-                self.data_buffer.add_data(qidx, qu) 
-            time.sleep(1.0 / self.queue_update_rate)
-
     def stop_threads(self):
         
         # Stop recording and join threads
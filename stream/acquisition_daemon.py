@@ -0,0 +1,204 @@
+import os
+import sys
+import time
+import signal
+import argparse
+import threading
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from live_session import LiveSessionWriter
+from knock_sync import KnockSync
+
+data_path = r"C:\Users\lhauptmann\Code\WristPPG2\data"
+
+
+class AcquisitionDaemon:
+    def __init__(self, path, sources, max_hours=4, report_interval=10, sync=True):
+        """
+        Owns the sensors and writes everything they deliver into one live session file. The visualizer, the
+        inference and notebooks attach to the file (LiveSessionReader) instead of connecting to the sensors
+        themselves, and the file is the recording of the session.
+
+        :param path: Live session file to write
+        :param sources: Dict of stream name to listener (WristbandListener, BluetoothIMUReader) or DataBuffer with a ring
+        :param max_hours: Capacity of the file per stream
+        :param report_interval: Seconds between the reports of the stream counters
+        :param sync: Detect knocks on the accelerometers of the ppg and the imu stream and publish their offset
+                     in the header of the session file and of running recordings
+        """
+        self.sources = sources
+        self.buffers = {name: getattr(source, "data_buffer", source) for name, source in sources.items()}
+        streams = {name: buffer.ring.fields for name, buffer in self.buffers.items()}
+        max_samples = {name: int(max_hours * 3600 * getattr(buffer, "frame_rate", 128) * 1.1)
+                       for name, buffer in self.buffers.items()}
+        self.session = LiveSessionWriter(path, streams, max_samples=max_samples,
+                                         metadata={"frame_rates": {name: getattr(buffer, "frame_rate", None)
+                                                                   for name, buffer in self.buffers.items()}})
+        self.report_interval = report_interval
+        self.sync = KnockSync() if sync and {"ppg", "imu"} <= set(self.buffers) else None
+        if self.sync is not None:
+            self.sync_columns = {name: self._sync_columns(self.buffers[name].ring.fields) for name in ("ppg", "imu")}
+            self.sync.subscribe(self._publish_sync)
+        self.publish_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    @staticmethod
+    def _sync_columns(fields):
+        """
+        :return: Columns of the accelerometer, of the host time and its scale to seconds, and of the validity mask
+        """
+        # the host time of arrival is the common clock of both devices, the IMU stores it in ms (BluetoothIMUReader)
+        time_field, time_scale = ("timestamp_computer", 1e-3) if "timestamp_computer" in fields else ("timestamp", 1.0)
+        valid_column = fields.index("valid") if "valid" in fields else None
+        return ([fields.index(field) for field in ("acc_x", "acc_y", "acc_z")], fields.index(time_field), time_scale,
+                valid_column)
+
+    def _publish_sync(self, summary):
+        with self.publish_lock:
+            self.session.update_metadata({"sync": summary})
+            for buffer in self.buffers.values():
+                recorder = getattr(buffer, "recorder", None)
+                if recorder is not None:
+                    recorder.update_metadata({"sync": summary})
+
+    def _pump(self, name, buffer):
+        # forwards whole blocks from the ring of the listener to the session file as they are committed
+        reader = buffer.ring.reader()
+        while not self.stop_event.is_set():
+            block, overrun = reader.read_blocking(timeout=0.1)
+            if overrun:
+                print(f"[Session]: {name} ring overrun, samples were lost")
+            self.session.append(name, block.T)
+            if self.sync is not None and name in self.sync_columns and block.shape[1]:
+                acc_columns, time_column, time_scale, valid_column = self.sync_columns[name]
+                acc = np.array(block[acc_columns])
+                if valid_column is not None:
+                    # lost values are stored as 0, the jump back to gravity would look like a knock
+                    bits = block[valid_column].astype(np.uint64)[None, :] >> np.array(acc_columns, dtype=np.uint64)[:, None]
+                    acc[(bits & np.uint64(1)) == 0] = np.nan
+                getattr(self.sync, f"update_{name}")(acc.T, block[time_column] * time_scale)
+
+    def start(self):
+        for name, source in self.sources.items():
+            if hasattr(source, "start_threads"):
+                source.start_threads()
+            thread = threading.Thread(target=self._pump, args=(name, self.buffers[name]), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        print(f"[Session]: writing {', '.join(self.sources)} to {self.session.path}")
+
+    def stop(self):
+        # the pumps first, stopping a listener releases its ring
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        for source in self.sources.values():
+            if hasattr(source, "stop_threads"):
+                source.stop_threads()
+        counts = {name: self.session.seq(name) for name in self.sources}
+        if self.sync is not None:
+            self._publish_sync(self.sync.summary())
+        self.session.close()
+        print(f"[Session]: closed {self.session.path}: {counts}")
+
+    def run(self, duration=None):
+        """
+        Acquire until SIGINT/SIGTERM or the duration (s) is over.
+        """
+        signal.signal(signal.SIGINT, lambda *args: self.stop_event.set())
+        signal.signal(signal.SIGTERM, lambda *args: self.stop_event.set())
+        self.start()
+        start_time = time.time()
+        try:
+            while not self.stop_event.wait(self.report_interval):
+                sync = f" | offset {self.sync.offset * 1000:.1f} ms" if self.sync and self.sync.offset is not None else ""
+                print(f"[Session]: {time.time() - start_time:8.0f} s | " +
+                      " | ".join(f"{name} {self.session.seq(name)}" for name in self.sources) + sync)
+                if duration is not None and time.time() - start_time >= duration:
+                    break
+        finally:
+            self.stop()
+
+
+def check_sync(n_ppg_channels=16, offset=0.12, duration=12.0, frame_rate=112.0):
+    """
+    Knock sync through the buffers of the real listeners: the PPG rows as written by WristbandListener (host time
+    in s, validity masks, a disconnection gap) and the IMU rows as written by BluetoothIMUReader (host time in ms).
+    The offset published in the session header has to be the simulated one.
+
+    :param offset: Delay of the PPG host times behind the IMU ones (s)
+    """
+    import tempfile
+    from PPG.wristband_listener import DataBuffer as PPGDataBuffer
+    from IMU.BluetoothIMU import DataBuffer as IMUDataBuffer
+    from live_session import LiveSessionReader
+
+    ppg = PPGDataBuffer(n_channels=n_ppg_channels + 4, frame_rate=frame_rate, plotting_window=duration)
+    imu = IMUDataBuffer(frame_rate=frame_rate, plotting_window=duration)
+    path = os.path.join(tempfile.mkdtemp(), "check_sync.live")
+    daemon = AcquisitionDaemon(path, {"ppg": ppg, "imu": imu}, max_hours=duration / 3600, report_interval=duration)
+
+    rng = np.random.default_rng(0)
+    n = int(duration * frame_rate)
+    times = time.time() + np.arange(n) / frame_rate
+    acc = np.array([0, 0, 9.8]) + rng.normal(0, 0.02, (n, 3))
+    for knock in np.arange(2, duration - 1, 3):
+        acc[int(knock * frame_rate):int(knock * frame_rate) + 2] += [30, -30, 40]
+    ppg_rows = np.zeros((n, len(ppg.ring.fields)))
+    ppg_rows[:, n_ppg_channels:n_ppg_channels + 3] = acc
+    ppg_rows[:, n_ppg_channels + 3] = times + offset
+    ppg_rows[:, n_ppg_channels + 4] = (1 << (n_ppg_channels + 3)) - 1
+    ppg_rows[n // 2:n // 2 + 50] = np.nan  # frames missed while disconnected
+    ppg_rows[n // 2:n // 2 + 50, n_ppg_channels + 4:] = 0
+    imu_rows = np.zeros((n, len(imu.ring.fields)))
+    imu_rows[:, :3] = acc
+    imu_rows[:, 6] = np.arange(n) * 1000 / frame_rate
+    imu_rows[:, 7] = np.round(times * 1000)
+
+    daemon.start()
+    for start in range(0, n, 56):
+        ppg.add_frames(ppg_rows[start:start + 56])
+        imu.add_block(imu_rows[start:start + 56])
+        time.sleep(0.005)
+    time.sleep(0.5)
+    daemon.stop()
+    sync = LiveSessionReader(path).metadata().get("sync", {})
+    assert sync.get("offset") is not None and abs(sync["offset"] - offset) < 0.02, f"Wrong offset: {sync}"
+    print(f"[Sync]: offset {sync['offset'] * 1000:.1f} ms from {sync['pairs']} knocks, simulated {offset * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Acquire the wristband and the IMU into a live session file")
+    parser.add_argument("--save_dir", type=str, default=data_path, help="directory of the session file")
+    parser.add_argument("--name", type=str, default=None, help="file name (default session_<date>.live)")
+    parser.add_argument("--sensor_size", type=str, default="M", help="size of the sensor footprint")
+    parser.add_argument("--n_ppg_channels", type=int, default=16, help="PPG channels of the wristband")
+    parser.add_argument("--imu_port", type=str, default="COM6", help="serial port of the IMU receiver")
+    parser.add_argument("--no_ppg", action="store_true", help="acquire the IMU only")
+    parser.add_argument("--no_imu", action="store_true", help="acquire the wristband only")
+    parser.add_argument("--max_hours", type=float, default=4, help="capacity of the session file")
+    parser.add_argument("--no_sync", action="store_true", help="do not synchronize the streams on knocks")
+    parser.add_argument("--duration", type=float, default=None, help="stop after this many seconds")
+    parser.add_argument("--check", action="store_true", help="check the knock sync on simulated streams and exit")
+    args = parser.parse_args()
+    if args.check:
+        check_sync(args.n_ppg_channels)
+        sys.exit(0)
+
+    sources = {}
+    if not args.no_ppg:
+        from PPG.wristband_listener import WristbandListener
+        sources["ppg"] = WristbandListener(bracelet=args.sensor_size, n_ppg_channels=args.n_ppg_channels,
+                                           frame_rate=112.22, fileindex=-1)
+    if not args.no_imu:
+        from IMU.BluetoothIMU import BluetoothIMUReader
+        sources["imu"] = BluetoothIMUReader(port=args.imu_port, baud_rate=115200, file_index=-1, frame_rate=112.1)
+
+    name = args.name if args.name else "session_" + time.strftime("%m_%d-%H_%M") + ".live"
+    daemon = AcquisitionDaemon(os.path.join(args.save_dir, name), sources, max_hours=args.max_hours,
+                               sync=not args.no_sync)
+    # Ctrl+C stops the acquisition cleanly
+    daemon.run(duration=args.duration)
@@ -105,6 +105,64 @@ class RCSFilter():
         return results
 
 
+class ActivityGate():
+    def __init__(self, threshold=0.5, window_size=150, hold_samples=64, decay=1.6, nothing_prob=0.98):
+        """
+        Gate that skips model inference while the wrist is still, based on the running RCS of the accelerometer.
+        The gate stays open as long as motion happened within the last inference window (pre-roll) plus
+        hold_samples, so the window containing a gesture onset is always inferred.
+
+        Args:
+            threshold (float): RCS value above which a sample counts as motion.
+            window_size (int): Number of samples of one inference window.
+            hold_samples (int): Number of samples the gate stays open after the window has left the motion.
+            decay (float): Decay of the RCS filter.
+            nothing_prob (float): Probability of the "Nothing" class in the synthetic observation.
+        """
+        self.threshold = threshold
+        self.window_size = window_size
+        self.hold_samples = hold_samples
+        self.nothing_prob = nothing_prob
+        self.RCS_filter = RCSFilter(decay=decay)
+        self.samples_since_motion = np.inf
+        self.n_skipped = 0
+        self.n_executed = 0
+
+    def update_batch(self, batch):
+        """
+        Feed new accelerometer samples (n_samples, n_channels) to the gate.
+        """
+        for rcs_value in self.RCS_filter.update_batch(np.atleast_2d(batch)):
+            if rcs_value > self.threshold:
+                self.samples_since_motion = 0
+            else:
+                self.samples_since_motion += 1
+
+    def is_active(self):
+        return self.samples_since_motion < self.window_size + self.hold_samples
+
+    def should_infer(self):
+        """
+        Decide whether the model has to run on the current window and count the decision.
+        """
+        if self.is_active():
+            self.n_executed += 1
+            return True
+        self.n_skipped += 1
+        return False
+
+    def idle_observation(self, n_classes):
+        """
+        Synthetic "Nothing" observation that replaces the model output while the gate is closed.
+        """
+        observation = np.full(n_classes, (1 - self.nothing_prob) / (n_classes - 1))
+        observation[0] = self.nothing_prob
+        return observation
+
+    def get_counters(self):
+        return {"skipped": self.n_skipped, "executed": self.n_executed, "active": bool(self.is_active())}
+
+
 class RCSEventFilter():
     def __init__(self, threshold=2, n_samples_peak = 20, n_samples_reset=40, save_RCS = False):
         self.threshold = threshold
@@ -0,0 +1,174 @@
+import numpy as np
+
+
+class ClockDriftEstimator:
+    def __init__(self, tick_scale=1e-3, forgetting=0.999, outlier_sigma=4.0, warmup_updates=20, reset_ticks=1000):
+        """
+        Online mapping of device clock ticks to host time with recursive least squares:
+        host - host0 = offset + (1 + skew) * (ticks - ticks0) * tick_scale.
+        Host arrival times carry the transport and scheduling jitter, late outliers are rejected after the warm-up.
+        The true sample rate is measured from the device tick intervals and the estimated skew.
+
+        :param tick_scale: Seconds per device tick (the IMU timestamps are in ms)
+        :param forgetting: RLS forgetting factor, the effective memory is 1/(1-forgetting) updates
+        :param outlier_sigma: Updates arriving later than outlier_sigma residual stds are ignored
+        :param warmup_updates: Number of updates before outliers are rejected
+        :param reset_ticks: A backwards jump of the device clock by more than this restarts the estimation
+        """
+        self.tick_scale = tick_scale
+        self.forgetting = forgetting
+        self.outlier_sigma = outlier_sigma
+        self.warmup_updates = warmup_updates
+        self.reset_ticks = reset_ticks
+        self.n_resets = 0
+        self.reset()
+
+    def reset(self):
+        self.ticks0 = None
+        self.host0 = None
+        self.last_tick = None
+        self.theta = np.zeros(2)  # offset (s), skew
+        self.P = np.diag([1.0, 1e-2])
+        self.residual_var = 1e-4
+        self.tick_interval = None  # device ticks per sample
+        self.n_updates = 0
+        self.n_outliers = 0
+
+    def update(self, ticks, host_time):
+        """
+        Add the device ticks of a received chunk and its host arrival time.
+        The arrival time is closest to the last sample of the chunk, so only that one enters the regression.
+
+        :param ticks: Device timestamps of the samples of the chunk
+        :param host_time: Host time of arrival in seconds
+        :return: True if the device clock jumped back and the estimation was restarted
+        """
+        ticks = np.atleast_1d(np.asarray(ticks, dtype=float))
+        if ticks.size == 0:
+            return False
+
+        restarted = False
+        if self.last_tick is not None and ticks[0] < self.last_tick - self.reset_ticks:
+            self.reset()
+            self.n_resets += 1
+            restarted = True
+        if self.ticks0 is None:
+            self.ticks0, self.host0 = ticks[-1], host_time
+
+        intervals = np.diff(ticks if self.last_tick is None else np.append(self.last_tick, ticks))
+        intervals = intervals[intervals > 0]
+        if intervals.size:
+            # the median ignores the gaps of lost packages
+            interval = np.median(intervals)
+            self.tick_interval = interval if self.tick_interval is None else 0.95 * self.tick_interval + 0.05 * interval
+        self.last_tick = ticks[-1]
+
+        x = np.array([1.0, (ticks[-1] - self.ticks0) * self.tick_scale])
+        y = host_time - self.host0 - x[1]
+        residual = y - x @ self.theta
+        if self.n_updates >= self.warmup_updates and residual > self.outlier_sigma * np.sqrt(self.residual_var):
+            self.n_outliers += 1
+            return restarted
+
+        gain = self.P @ x / (self.forgetting + x @ self.P @ x)
+        self.theta = self.theta + gain * residual
+        self.P = (self.P - np.outer(gain, x @ self.P)) / self.forgetting
+        self.residual_var = 0.99 * self.residual_var + 0.01 * residual**2
+        self.n_updates += 1
+        return restarted
+
+    def to_host(self, ticks):
+        """
+        Map device ticks to host time in seconds.
+        """
+        dt = (np.asarray(ticks, dtype=float) - self.ticks0) * self.tick_scale
+        return self.host0 + self.theta[0] + (1 + self.theta[1]) * dt
+
+    def get_skew(self):
+        return self.theta[1]
+
+    def get_sample_rate(self):
+        """True sample rate in host seconds."""
+        if self.tick_interval is None:
+            return np.nan
+        return 1 / (self.tick_interval * self.tick_scale * (1 + self.theta[1]))
+
+    def summary(self):
+        return {
+            # None until the tick interval is known, NaN is not valid JSON
+            "sample_rate": float(self.get_sample_rate()) if self.tick_interval is not None else None,
+            "skew_ppm": float(self.theta[1] * 1e6),
+            "offset_ms": float(self.theta[0] * 1000),
+            "jitter_ms": float(np.sqrt(self.residual_var) * 1000),
+            "updates": self.n_updates,
+            "outliers": self.n_outliers,
+            "resets": self.n_resets,
+        }
+
+
+class UniformResampler:
+    def __init__(self, rate, max_gap=0.1):
+        """
+        Streaming linear interpolation of irregularly timed samples onto an exact uniform time grid.
+        The last input sample is kept across calls, so consecutive blocks produce a seamless grid.
+
+        :param rate: Output sample rate in Hz
+        :param max_gap: Gaps longer than this (s) are not interpolated, the grid continues after the gap in phase
+        """
+        self.rate = rate
+        self.max_gap = max_gap
+        self.reset()
+
+    def reset(self):
+        self.grid_origin = None
+        self.next_index = 0
+        self.last_time = None
+        self.last_sample = None
+        self.n_gaps = 0
+
+    def process(self, times, block):
+        """
+        Resample a block of samples.
+
+        :param times: Time of every sample in seconds (increasing)
+        :param block: Array of shape (n_samples, n_channels)
+        :return: Grid times (M) and resampled samples (M x n_channels)
+        """
+        times = np.asarray(times, dtype=float)
+        block = np.asarray(block, dtype=float)
+        n_channels = block.shape[1]
+        if times.size == 0:
+            return np.empty(0), np.empty((0, n_channels))
+
+        if self.last_time is not None:
+            keep = times > self.last_time
+            times, block = times[keep], block[keep]
+            if times.size == 0:
+                return np.empty(0), np.empty((0, n_channels))
+            times = np.append(self.last_time, times)
+            block = np.vstack([self.last_sample, block])
+        if self.grid_origin is None:
+            self.grid_origin = times[0]
+
+        outputs_t, outputs = [], []
+        # split at gaps, every segment is interpolated on its own
+        gaps = np.flatnonzero(np.diff(times) > self.max_gap) + 1
+        for segment_t, segment in zip(np.split(times, gaps), np.split(block, gaps)):
+            first_index = int(np.ceil((segment_t[0] - self.grid_origin) * self.rate - 1e-9))
+            if first_index > self.next_index:
+                if outputs_t or self.last_time is not None:
+                    self.n_gaps += 1
+                self.next_index = first_index
+            stop_index = int(np.floor((segment_t[-1] - self.grid_origin) * self.rate + 1e-9)) + 1
+            if stop_index <= self.next_index:
+                continue
+            grid = self.grid_origin + np.arange(self.next_index, stop_index) / self.rate
+            outputs_t.append(grid)
+            outputs.append(np.column_stack([np.interp(grid, segment_t, segment[:, i]) for i in range(n_channels)]))
+            self.next_index = stop_index
+
+        self.last_time = times[-1]
+        self.last_sample = block[-1]
+        if not outputs_t:
+            return np.empty(0), np.empty((0, n_channels))
+        return np.concatenate(outputs_t), np.vstack(outputs)
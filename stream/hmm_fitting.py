@@ -0,0 +1,304 @@
+import os
+import glob
+import argparse
+import numpy as np
+from scipy.special import logsumexp
+from concurrent.futures import ProcessPoolExecutor
+
+from GestureFiltering import GestureFilteringHMM
+
+
+def gesture_transition_mask(num_states=9):
+    """
+    Structural transition constraints of the live gesture HMM (rows: next state, columns: current state).
+    8 is the Rotation state, 5 is the Pinch Close state, 6 is the Pinch Open state.
+
+    :param num_states: Number of hidden states
+    :return: Boolean mask of allowed transitions (size num_states x num_states)
+    """
+    mask = np.ones((num_states, num_states), dtype=bool)
+    # It is not possible to go to 8 from any state but 5, 6 and 8
+    mask[8, :] = False
+    mask[8, [5, 6, 8]] = True
+    # you can only transition to 6 from 5, 6 and 8
+    mask[6, :] = False
+    mask[6, [5, 6, 8]] = True
+    # from state 5 you can either go to 5, 6 or 8
+    mask[:, 5] = False
+    mask[[5, 6, 8], 5] = True
+    # from state 8 you can either go to 8 or 6
+    mask[:, 8] = False
+    mask[[6, 8], 8] = True
+    return mask
+
+
+def gesture_emission_mask(num_states=9):
+    """
+    Structural emission constraints of the live gesture HMM: 8 is never emitted by the model.
+
+    :param num_states: Number of hidden states
+    :return: Boolean mask of allowed emissions (size num_states x num_classes)
+    """
+    mask = np.ones((num_states, num_states), dtype=bool)
+    mask[8, 8] = False
+    return mask
+
+
+def load_sessions(data_dir, num_classes):
+    """
+    Load cached model-probability sequences. Every .npz file holds one session with
+    "probs" (T x n_outputs) and optionally "labels" (T, -1 for unknown).
+    Probabilities with fewer columns than num_classes are zero-padded, like the live filter does.
+
+    :param data_dir: Directory with the cached sessions
+    :param num_classes: Number of observation classes of the HMM
+    :return: List of (probs, labels) tuples
+    """
+    sessions = []
+    for path in sorted(glob.glob(os.path.join(data_dir, "*.npz"))):
+        cached = np.load(path)
+        probs = cached["probs"].astype(float)
+        probs = np.pad(probs, ((0, 0), (0, num_classes - probs.shape[1])))
+        labels = cached["labels"].astype(int) if "labels" in cached else np.full(probs.shape[0], -1)
+        sessions.append((probs, labels))
+    print(f"[HMM]: Loaded {len(sessions)} sessions from {data_dir}")
+    return sessions
+
+
+def pad_sessions(sessions):
+    """
+    Stack sessions of different lengths into padded arrays.
+
+    :param sessions: List of (probs, labels) tuples
+    :return: probs (B x T x K), labels (B x T), valid mask (B x T)
+    """
+    max_len = max(probs.shape[0] for probs, _ in sessions)
+    num_classes = sessions[0][0].shape[1]
+    probs = np.full((len(sessions), max_len, num_classes), 1.0 / num_classes)
+    labels = np.full((len(sessions), max_len), -1)
+    valid = np.zeros((len(sessions), max_len), dtype=bool)
+    for b, (session_probs, session_labels) in enumerate(sessions):
+        probs[b, :len(session_probs)] = session_probs
+        labels[b, :len(session_labels)] = session_labels
+        valid[b, :len(session_probs)] = True
+    probs = probs / probs.sum(axis=2, keepdims=True)
+    return probs, labels, valid
+
+
+class HMMFitter:
+    def __init__(self, num_states=9, trans_mask=None, emit_mask=None, free_states=(8,), label_confidence=0.9,
+                 pseudocount=1e-3, n_iter=50, tol=1e-4):
+        """
+        Baum-Welch fitting of the transition and emission matrices of GestureFilteringHMM.
+        The emission model matches GestureFilteringHMM.update: the likelihood of an observation o in state s is emit_prob[s] @ o.
+        Structural zeros in the masks stay zero, labels (if given) are soft evidence on the state posteriors.
+
+        :param num_states: Number of hidden states
+        :param trans_mask: Boolean mask of allowed transitions (next state x current state), all allowed if None
+        :param emit_mask: Boolean mask of allowed emissions (state x class), all allowed if None
+        :param free_states: States that are never labelled and are always allowed (e.g. the Rotation state)
+        :param label_confidence: Weight of the labelled state in the state posterior
+        :param pseudocount: Dirichlet pseudocount added to every allowed entry
+        :param n_iter: Maximum number of EM iterations
+        :param tol: Stop when the mean log likelihood per sample improves less than this
+        """
+        self.num_states = num_states
+        self.trans_mask = np.ones((num_states, num_states), dtype=bool) if trans_mask is None else trans_mask
+        self.emit_mask = np.ones((num_states, num_states), dtype=bool) if emit_mask is None else emit_mask
+        self.free_states = list(free_states)
+        self.label_confidence = label_confidence
+        self.pseudocount = pseudocount
+        self.n_iter = n_iter
+        self.tol = tol
+
+        hmm = GestureFilteringHMM(num_states)
+        self.start_prob = hmm.start_prob
+        self.trans_prob = self._normalize(hmm.trans_prob * self.trans_mask, self.trans_mask, axis=0)
+        self.emit_prob = self._normalize(hmm.emit_prob * self.emit_mask, self.emit_mask, axis=1)
+
+    def _normalize(self, counts, mask, axis):
+        counts = (counts + self.pseudocount) * mask
+        return counts / counts.sum(axis=axis, keepdims=True)
+
+    def _log_evidence(self, labels):
+        """
+        Soft log evidence of the labels on the hidden states (B x T x num_states).
+        Labelled samples favour the labelled state, and a free state only where the transition mask lets it follow
+        the labelled state (e.g. Rotation during a Pinch Close label). Unlabelled samples are uninformative.
+        """
+        evidence = np.zeros(labels.shape + (self.num_states,))
+        labelled = labels >= 0
+        evidence[labelled] = np.log((1 - self.label_confidence) / self.num_states)
+        evidence[labelled, labels[labelled]] = np.log(self.label_confidence)
+        for state in self.free_states:
+            predecessors = self.trans_mask[state].copy()
+            predecessors[state] = False
+            if predecessors.all():
+                # unconstrained, the free state would absorb every label
+                continue
+            reachable = labelled & predecessors[np.maximum(labels, 0)]
+            evidence[reachable, state] = np.log(self.label_confidence)
+        return evidence
+
+    def init_from_labels(self, probs, labels, valid):
+        """
+        Initialize the matrices with label transition counts and label-conditioned mean probabilities.
+        """
+        labelled = (labels >= 0) & valid
+        if not labelled.any():
+            return
+
+        pairs = labelled[:, 1:] & labelled[:, :-1]
+        trans_counts = np.zeros((self.num_states, self.num_states))
+        np.add.at(trans_counts, (labels[:, 1:][pairs], labels[:, :-1][pairs]), 1)
+        self.trans_prob = self._normalize(trans_counts + self.trans_prob, self.trans_mask, axis=0)
+
+        emit_counts = np.zeros((self.num_states, probs.shape[2]))
+        np.add.at(emit_counts, labels[labelled], probs[labelled])
+        self.emit_prob = self._normalize(emit_counts + self.emit_prob, self.emit_mask, axis=1)
+
+    def _e_step(self, probs, labels, valid):
+        """
+        Batched forward-backward pass in log space over all sessions.
+
+        :return: Mean log likelihood per sample, start, transition and emission statistics
+        """
+        batch_size, seq_len, _ = probs.shape
+        with np.errstate(divide="ignore"):
+            log_trans = np.log(self.trans_prob)
+            log_start = np.log(self.start_prob)
+            emission = probs @ self.emit_prob.T
+            log_emission = np.log(emission) + self._log_evidence(labels)
+        # Padded steps are uninformative and leave the backward messages untouched
+        log_emission[~valid] = 0
+
+        log_alpha = np.empty((batch_size, seq_len, self.num_states))
+        log_scale = np.empty((batch_size, seq_len))
+        current = log_start[None, :] + log_emission[:, 0]
+        for t in range(seq_len):
+            if t > 0:
+                current = logsumexp(log_trans[None, :, :] + current[:, None, :], axis=2) + log_emission[:, t]
+            log_scale[:, t] = logsumexp(current, axis=1)
+            current = current - log_scale[:, t, None]
+            log_alpha[:, t] = current
+
+        log_beta = np.zeros((batch_size, seq_len, self.num_states))
+        trans_stats = np.zeros((self.num_states, self.num_states))
+        for t in range(seq_len - 1, 0, -1):
+            message = log_emission[:, t] + log_beta[:, t]  # (B x next state)
+            log_xi = log_alpha[:, t - 1, None, :] + log_trans[None, :, :] + message[:, :, None] - log_scale[:, t, None, None]
+            trans_stats += np.exp(log_xi[valid[:, t]]).sum(axis=0)
+            log_beta[:, t - 1] = logsumexp(log_trans[None, :, :] + message[:, :, None], axis=1) - log_scale[:, t, None]
+
+        gamma = np.exp(log_alpha + log_beta)
+        gamma = gamma / gamma.sum(axis=2, keepdims=True)
+        gamma[~valid] = 0
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            responsibility = np.where(emission > 0, gamma / emission, 0)
+        emit_stats = self.emit_prob * np.einsum("bts,btc->sc", responsibility, probs)
+
+        log_likelihood = log_scale[valid].sum() / valid.sum()
+        return log_likelihood, gamma[:, 0].sum(axis=0), trans_stats, emit_stats
+
+    def fit(self, sessions):
+        """
+        Fit the matrices to the sessions with EM, vectorized across all sessions.
+
+        :param sessions: List of (probs, labels) tuples
+        :return: self
+        """
+        probs, labels, valid = pad_sessions(sessions)
+        self.init_from_labels(probs, labels, valid)
+
+        previous = -np.inf
+        for iteration in range(self.n_iter):
+            log_likelihood, start_stats, trans_stats, emit_stats = self._e_step(probs, labels, valid)
+            self.start_prob = (start_stats + self.pseudocount) / (start_stats + self.pseudocount).sum()
+            self.trans_prob = self._normalize(trans_stats, self.trans_mask, axis=0)
+            self.emit_prob = self._normalize(emit_stats, self.emit_mask, axis=1)
+            if log_likelihood - previous < self.tol:
+                break
+            previous = log_likelihood
+        print(f"[HMM]: EM stopped after {iteration + 1} iterations, log likelihood per sample {log_likelihood:.4f}")
+        return self
+
+    def to_hmm(self):
+        """
+        Build a GestureFilteringHMM with the fitted matrices.
+        """
+        hmm = GestureFilteringHMM(self.num_states)
+        hmm.start_prob = self.start_prob.copy()
+        hmm.trans_prob = self.trans_prob.copy()
+        hmm.emit_prob = self.emit_prob.copy()
+        hmm.current_belief = hmm.start_prob.copy()
+        return hmm
+
+    def save(self, path):
+        np.savez(path, start_prob=self.start_prob, trans_prob=self.trans_prob, emit_prob=self.emit_prob)
+        print(f"[HMM]: Matrices saved to {path}")
+
+
+def evaluate(hmm, sessions):
+    """
+    Filtering accuracy on the labelled samples and mean log likelihood of the filtered beliefs at the labels.
+    """
+    probs, labels, valid = pad_sessions(sessions)
+    log_beliefs = hmm.forward_log(probs)
+    labelled = (labels >= 0) & valid
+    if not labelled.any():
+        return np.nan, np.nan
+    accuracy = (log_beliefs.argmax(axis=2)[labelled] == labels[labelled]).mean()
+    label_log_prob = log_beliefs[labelled, labels[labelled]].mean()
+    return accuracy, label_log_prob
+
+
+def _fit_fold(fold_args):
+    fitter_kwargs, train_sessions, test_sessions = fold_args
+    fitter = HMMFitter(**fitter_kwargs).fit(train_sessions)
+    return evaluate(fitter.to_hmm(), test_sessions)
+
+
+def cross_validate(sessions, n_folds=5, n_jobs=None, **fitter_kwargs):
+    """
+    Leave-sessions-out cross-validation, the folds are fitted in parallel processes.
+
+    :param sessions: List of (probs, labels) tuples
+    :param n_folds: Number of folds
+    :param n_jobs: Number of worker processes, defaults to the number of CPUs
+    :return: List of (accuracy, label log probability) per fold
+    """
+    folds = np.array_split(np.arange(len(sessions)), n_folds)
+    fold_args = []
+    for test_idx in folds:
+        train_sessions = [session for i, session in enumerate(sessions) if i not in test_idx]
+        test_sessions = [sessions[i] for i in test_idx]
+        fold_args.append((fitter_kwargs, train_sessions, test_sessions))
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        results = list(executor.map(_fit_fold, fold_args))
+
+    for fold, (accuracy, label_log_prob) in enumerate(results):
+        print(f"[HMM]: Fold {fold}: accuracy {accuracy*100:.1f} %, label log prob {label_log_prob:.3f}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fit the gesture HMM matrices to cached model probabilities')
+    parser.add_argument('data_dir', type=str, help='directory with cached sessions (.npz with probs and labels)')
+    parser.add_argument('--output', type=str, default='hmm_params.npz', help='matrix file loaded by the live filter')
+    parser.add_argument('--num_states', type=int, default=9, help='number of hidden states')
+    parser.add_argument('--n_iter', type=int, default=50, help='maximum number of EM iterations')
+    parser.add_argument('--n_folds', type=int, default=5, help='number of cross-validation folds (0 to skip)')
+    parser.add_argument('--n_jobs', type=int, default=None, help='number of parallel fold workers')
+    args = parser.parse_args()
+
+    sessions = load_sessions(args.data_dir, args.num_states)
+    fitter_kwargs = dict(num_states=args.num_states, trans_mask=gesture_transition_mask(args.num_states),
+                         emit_mask=gesture_emission_mask(args.num_states), n_iter=args.n_iter)
+
+    if args.n_folds > 1 and len(sessions) >= args.n_folds:
+        cross_validate(sessions, n_folds=args.n_folds, n_jobs=args.n_jobs, **fitter_kwargs)
+
+    fitter = HMMFitter(**fitter_kwargs).fit(sessions)
+    fitter.save(args.output)
@@ -0,0 +1,159 @@
+import threading
+from collections import deque
+import numpy as np
+from causal_filters import RCSEventFilter
+
+
+class KnockDetector:
+    def __init__(self, threshold=8, n_samples_peak=10, n_samples_reset=40):
+        """
+        Streaming knock detector on an accelerometer, the peak of every RCSEventFilter event is timed with the
+        timestamp of its sample.
+
+        :param threshold: RCS threshold of a knock (a knock is a much sharper jerk than a gesture)
+        :param n_samples_peak: Samples after the threshold crossing in which the peak is searched
+        :param n_samples_reset: Samples after the threshold crossing until the next knock can be detected
+        """
+        self.event_filter = RCSEventFilter(threshold=threshold, n_samples_peak=n_samples_peak,
+                                           n_samples_reset=n_samples_reset)
+        # times of the last samples, the peak is at most n_samples_peak samples old when it is reported
+        self.times = deque(maxlen=n_samples_peak + 2)
+        self.n_knocks = 0
+
+    def update(self, acc, times):
+        """
+        :param acc: Accelerations (n_samples x 3)
+        :param times: Host time of every sample (s)
+        :return: Times of the knocks detected in this block
+        """
+        knocks = []
+        for sample, t in zip(np.asarray(acc, dtype=float), times):
+            if not np.all(np.isfinite(sample)):
+                # frames lost by the link, not a jerk
+                continue
+            self.times.append(t)
+            event = self.event_filter.update(sample)
+            if event is None:
+                continue
+            age = self.event_filter.iter - 1 - event[0]
+            knock_time = self.times[-1 - age] if age < len(self.times) else np.nan
+            if np.isfinite(knock_time):
+                knocks.append(knock_time)
+                self.n_knocks += 1
+        return knocks
+
+
+class KnockSync:
+    def __init__(self, threshold=8, n_samples_peak=10, n_samples_reset=40, max_offset=1.0, tolerance=0.05,
+                 min_pairs=2, smoothing=0.2):
+        """
+        Offset between the wristband (PPG) and the IMU from knocks seen by both accelerometers. The offset is
+        established from the first min_pairs consistent knock pairs, e.g. the knock calibration at the start of a
+        session, and refined by every later pair. Subscribers are called with every new value, so the fusion and
+        the recording headers follow it without a per-window correlation or an offline realignment.
+
+        :param threshold: RCS threshold of a knock, see KnockDetector
+        :param n_samples_peak: Samples in which the peak of a knock is searched
+        :param n_samples_reset: Samples until the next knock can be detected
+        :param max_offset: Largest plausible offset (s), knocks further apart are not paired
+        :param tolerance: Deviation from the current offset (s) up to which a pair is accepted
+        :param min_pairs: Consistent pairs needed to establish the offset
+        :param smoothing: Weight of a new pair in the refinement
+        """
+        self.detectors = {name: KnockDetector(threshold, n_samples_peak, n_samples_reset) for name in ("ppg", "imu")}
+        self.knocks = {name: deque(maxlen=32) for name in ("ppg", "imu")}
+        self.max_offset = max_offset
+        self.tolerance = tolerance
+        self.min_pairs = min_pairs
+        self.smoothing = smoothing
+        self.offset = None  # t_ppg - t_imu of the same knock (s), the PPG arrives later if positive
+        self.candidates = []
+        self.n_pairs = 0
+        self.n_rejected = 0
+        self.last_knock = None
+        self.subscribers = []
+        self.lock = threading.Lock()  # the streams are fed from their own threads
+
+    def subscribe(self, callback):
+        """
+        :param callback: Called with the summary dict whenever the offset changes
+        """
+        self.subscribers.append(callback)
+
+    def update_ppg(self, acc, times):
+        return self._update("ppg", acc, times)
+
+    def update_imu(self, acc, times):
+        return self._update("imu", acc, times)
+
+    def _update(self, name, acc, times):
+        knocks = self.detectors[name].update(acc, times)
+        if not knocks:
+            return False
+        with self.lock:
+            self.knocks[name].extend(knocks)
+            changed = self._match()
+            summary = self.summary() if changed else None
+        if changed:
+            for callback in self.subscribers:
+                callback(summary)
+        return changed
+
+    def _match(self):
+        changed = False
+        expected = self.offset if self.offset is not None else 0.0
+        window = self.tolerance if self.offset is not None else self.max_offset
+        while self.knocks["ppg"] and self.knocks["imu"]:
+            ppg_time = self.knocks["ppg"][0]
+            imu_times = np.array(self.knocks["imu"])
+            differences = ppg_time - imu_times - expected
+            best = int(np.argmin(np.abs(differences)))
+            if abs(differences[best]) <= window:
+                offset = ppg_time - imu_times[best]
+                for _ in range(best + 1):
+                    # older IMU knocks have no partner anymore
+                    self.knocks["imu"].popleft()
+                self.knocks["ppg"].popleft()
+                changed |= self._add_pair(offset)
+                self.last_knock = float(ppg_time)
+            elif differences[best] < -window and best == 0:
+                # the IMU knocks are all too late, this PPG knock has no partner
+                self.knocks["ppg"].popleft()
+                self.n_rejected += 1
+            elif differences[-1] > window:
+                # the IMU knocks are all too early, wait for later ones
+                self.knocks["imu"].clear()
+                self.n_rejected += 1
+            else:
+                self.knocks["ppg"].popleft()
+                self.n_rejected += 1
+        return changed
+
+    def _add_pair(self, offset):
+        self.n_pairs += 1
+        if self.offset is not None:
+            self.offset = float(self.offset + self.smoothing * (offset - self.offset))
+            return True
+        self.candidates.append(offset)
+        candidates = np.array(self.candidates)
+        consistent = np.abs(candidates - np.median(candidates)) <= self.tolerance
+        if consistent.sum() < self.min_pairs:
+            return False
+        self.offset = float(np.median(candidates[consistent]))
+        print(f"[Sync]: PPG-IMU offset established from {consistent.sum()} knocks: {self.offset * 1000:.1f} ms")
+        return True
+
+    def lag(self, frame_rate):
+        """
+        Offset in samples as used by the fusion windows (negative if the PPG arrives later), 0 while unknown.
+        """
+        return 0 if self.offset is None else -int(round(self.offset * frame_rate))
+
+    def summary(self):
+        return {
+            "offset": self.offset,
+            "pairs": self.n_pairs,
+            "rejected": self.n_rejected,
+            "last_knock": self.last_knock,
+            "knocks": {name: detector.n_knocks for name, detector in self.detectors.items()},
+        }
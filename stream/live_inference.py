@@ -8,6 +8,7 @@ matplotlib.use('Agg')
 from PPG.wristband_listener import *
 from causal_filters import *
 from IMU.BluetoothIMU import BluetoothIMUReader
+from IMU.imu_manager import IMUManager
 from flask import Flask, jsonify, send_file
 from flask_cors import CORS
 import threading
@@ -18,7 +19,9 @@ import signal
 import time
 from scipy.signal import correlate, correlation_lags
 
-from GestureFiltering import GestureFilteringHMM
+from GestureFiltering import GestureFilteringHMM, FixedLagSmoother
+from polyphase_resampler import PolyphaseResampler
+from clock_sync import ClockDriftEstimator
 
 import torch
 from pathlib import Path
@@ -111,6 +114,13 @@ def pretty_print_matrix(m:np.array):
 parser = argparse.ArgumentParser(description='Record Wristband Signal')
 parser.add_argument('--file_index', type=int, default=0, help='recording index')
 parser.add_argument('--sensor_size', type=str, default='M', help='size of the sensor footprint')
+parser.add_argument('--activity_threshold', type=float, default=0.5, help='RCS threshold of the activity gate (negative = always infer)')
+parser.add_argument('--imu_rate', type=float, default=0, help='resample the IMU to this rate on the estimated device clock (0 = raw samples)')
+parser.add_argument('--align', action='store_true', help='resample the IMU stream to the PPG rate with the polyphase resampler, driven by the measured IMU rate')
+parser.add_argument('--hmm_params', type=str, default=None, help='matrix file fitted with hmm_fitting.py (default: hand-set matrices)')
+parser.add_argument('--hmm_lag', type=int, default=0, help='number of windows the HMM decisions are smoothed over (0 = filtering only)')
+parser.add_argument('--imu_ports', type=str, default='COM6', help='serial port of the IMU, several devices as name=port pairs read by one IMUManager (e.g. left=COM6,right=COM7), the first one feeds the model')
+parser.add_argument('--session', type=str, default=None, help='live session file of the acquisition daemon to attach to instead of the sensors')
 args = parser.parse_args()
 
 FRAME_RATE_PPG = 112.22
@@ -250,7 +260,7 @@ def init_react_app():
 
 
     
-    def update_latest_data(imu_data, gesture, confidence, probability=None, filtered_gesture=None, orientation:np.array=None, rotation=None):
+    def update_latest_data(imu_data, gesture, confidence, probability=None, filtered_gesture=None, orientation:np.array=None, rotation=None, activity=None, link=None):
         # Convert numpy arrays to JSON-serializable data
         if isinstance(imu_data, np.ndarray):
             imu_data_list = []
@@ -288,6 +298,12 @@ def init_react_app():
         if filtered_gesture is not None:
             latest_data["filtered_gesture"] = filtered_gesture
         
+        if activity is not None:
+            latest_data["activity_gate"] = activity
+        
+        if link is not None:
+            latest_data["imu_link"] = link
+        
         if probability is not None:
             latest_data["probabilities"] = [
                 {"name": LABEL_TO_GESTURE[i], "probability": float(probability[i])*100} 
@@ -310,8 +326,12 @@ if __name__ == '__main__':
     # Define a handler function
     def signal_handler(sig, frame):
         print("Keyboard interrupt received. Stopping threads...")
-        imu_listener.stop_threads()
-        wristband_listner.stop_threads()
+        if args.session is None:
+            if imu_manager is not None:
+                imu_manager.stop_threads()
+            else:
+                imu_listener.stop_threads()
+            wristband_listner.stop_threads()
         
         print("Threads stopped.")
         exit(0)
@@ -319,13 +339,35 @@ if __name__ == '__main__':
     signal.signal(signal.SIGINT, signal_handler)
    
     inference_period = 32/112.2
-    wristband_listner = WristbandListener(n_ppg_channels=N_PPG_CHANNELS, window_size=WLEN, csv_window=2,
-                                     frame_rate=FRAME_RATE_PPG, fileindex=-1, bracelet=args.sensor_size)
-    imu_listener = BluetoothIMUReader(port = 'COM6', baud_rate=115200, file_index=-1, frame_rate=FRAME_RATE_IMU)
-
-    
-    #wristband_listner.start_threads()
-    imu_listener.start_threads()
+    if args.session is None:
+        wristband_listner = WristbandListener(n_ppg_channels=N_PPG_CHANNELS, window_size=WLEN, csv_window=2,
+                                         frame_rate=FRAME_RATE_PPG, fileindex=-1, bracelet=args.sensor_size)
+        imu_ports = dict(port.split("=") for port in args.imu_ports.split(",")) if "=" in args.imu_ports else {"imu": args.imu_ports}
+        if len(imu_ports) > 1:
+            # one event loop for all devices, the model windows are taken from their common time grid
+            imu_manager = IMUManager(imu_ports, baud_rate=115200, file_index=-1, frame_rate=FRAME_RATE_IMU,
+                                     uniform_rate=args.imu_rate or None)
+            primary_imu = next(iter(imu_ports))
+            imu_listener = imu_manager[primary_imu]
+        else:
+            imu_manager = None
+            imu_listener = BluetoothIMUReader(port = imu_ports["imu"], baud_rate=115200, file_index=-1, frame_rate=FRAME_RATE_IMU,
+                                              uniform_rate=args.imu_rate or None)
+        imu_buffer = imu_listener.data_buffer
+
+        #wristband_listner.start_threads()
+        if imu_manager is not None:
+            imu_manager.start_threads()
+        else:
+            imu_listener.start_threads()
+    else:
+        # the acquisition daemon owns the sensors, the visualizer can attach at the same time
+        from live_session import LiveSessionReader, LiveStreamBuffer
+        session = LiveSessionReader(args.session)
+        imu_manager = None
+        imu_buffer = LiveStreamBuffer(session, "imu", int((WLEN+1)*FRAME_RATE_IMU + 1))
+        # the IMU rate measured from the device timestamps and the host arrival times recorded by the daemon
+        session_clock = ClockDriftEstimator(tick_scale=1e-3)
 
     model_path = r"C:\Users\lhauptmann\Code\GestureDetection\experiments\2025-01-17_111553"
     model = load_model(model_path)
@@ -334,36 +376,45 @@ if __name__ == '__main__':
     filter = GestureFilteringHMM(n_classes, start_neg_prob=0.5, trans_self_prob=trans_self_prob, emit_self_prob=0.8)
     rotation_filter = RotationFilter(track_rotation_index=8, probability_threshold=0.2, inference_interval=inference_period)
 
-    # 8 is the Rotation state, 5 is the Pinch Close state, 6 is the Pinch Open state
-    # It is not possibel to got to 8 from any state but 5 and 8
-    filter.trans_prob[8, :6] = 0
-    filter.trans_prob[8, 7:] = 0
-    # you can only transition to 6 from 5 and 8
-    filter.trans_prob[6, :] = 0
-    filter.trans_prob[6, 6] = trans_self_prob
-    # from state 5 you can either go to 5 or 8
-    filter.trans_prob[:, 5] = [0, 0, 0, 0, 0, trans_self_prob, (1 -trans_self_prob)/2, 0, (1 -trans_self_prob)/2]
-    # from state 8 you can eithet go to 8 or 6
-    filter.trans_prob[:, 8] = [0, 0, 0, 0, 0, 0, 1- trans_self_prob, 0, trans_self_prob]
-
-
-    filter.trans_prob += 0.001
+    if args.hmm_params is not None:
+        filter.load_parameters(args.hmm_params)
+        print(f"Loaded HMM matrices from {args.hmm_params}")
+    else:
+        # 8 is the Rotation state, 5 is the Pinch Close state, 6 is the Pinch Open state
+        # It is not possibel to got to 8 from any state but 5 and 8
+        filter.trans_prob[8, :6] = 0
+        filter.trans_prob[8, 7:] = 0
+        # you can only transition to 6 from 5 and 8
+        filter.trans_prob[6, :] = 0
+        filter.trans_prob[6, 6] = trans_self_prob
+        # from state 5 you can either go to 5 or 8
+        filter.trans_prob[:, 5] = [0, 0, 0, 0, 0, trans_self_prob, (1 -trans_self_prob)/2, 0, (1 -trans_self_prob)/2]
+        # from state 8 you can eithet go to 8 or 6
+        filter.trans_prob[:, 8] = [0, 0, 0, 0, 0, 0, 1- trans_self_prob, 0, trans_self_prob]
+
+
+        filter.trans_prob += 0.001
     
-    # normalize
-    filter.trans_prob = filter.trans_prob / filter.trans_prob.sum(axis=0, keepdims=True)
+        # normalize
+        filter.trans_prob = filter.trans_prob / filter.trans_prob.sum(axis=0, keepdims=True)
     
 
     
+        # 8 is never emitted, but it's possible to observe 0 when in state 8
+    
+        filter.emit_prob[0,8] += filter.emit_prob[8,8]
+        filter.emit_prob[8,8] = 0
+
     print("Transition matrix:")
     pretty_print_matrix(filter.trans_prob)
     
-    # 8 is never emitted, but it's possible to observe 0 when in state 8
-    
-    filter.emit_prob[0,8] += filter.emit_prob[8,8]
-    filter.emit_prob[8,8] = 0
     print("\nEmission matrix:")
     pretty_print_matrix(filter.emit_prob)
     
+    smoother = FixedLagSmoother(filter, lag=args.hmm_lag) if args.hmm_lag > 0 else None
+    # events of the windows still waiting for their smoothed decision, a decision is paired with its own window
+    pending_events = deque(maxlen=args.hmm_lag + 1)
+    
     
     #prediction_filter = PredictionFilter(n_classes=n_classes-1, label_to_gesture=LABEL_TO_GESTURE, gesture_prediction_len_threshold=2)
     #prediction_filter = SimplePredictionFilter(label_to_gesture=LABEL_TO_GESTURE)
@@ -371,6 +422,7 @@ if __name__ == '__main__':
     orientation_filter = MadgwickRotationFilter(sampling_frequency=112.2, history_size=800, filter_gyro=False)
     
     event_filter = RCSEventFilter(threshold=2, n_samples_peak=50, n_samples_reset = 70)
+    activity_gate = ActivityGate(threshold=args.activity_threshold, window_size=150)
   
     update_latest_data = init_react_app()
     highpassfilter = HighPassFilter(cutoff_frequency=0.5, sampling_rate=112.2, num_channels=3, order=3)
@@ -382,25 +434,40 @@ if __name__ == '__main__':
     window_size = 150
     
     imu_queue = deque(maxlen=800)
+    # streaming stage in front of the queue, the model windows are then on the PPG time grid
+    imu_aligner = PolyphaseResampler(FRAME_RATE_IMU, FRAME_RATE_PPG) if args.align else None
     
     
     try:
+        next_time = time.time()
         while not stop_event.is_set():
 
+            # Control the loop timing, at the top so the iterations that skip the model wait as well
+            sleep_time = next_time - time.time()
+            if sleep_time > 0:
+                time.sleep(sleep_time)
             start_time = time.time()
+            next_time = start_time + inference_period
            
             
             #ppg_data = wristband_listner.data_buffer.plotting_queues()
             #ppg_data = None
             
-            new_imu_data = np.array(imu_listener.data_buffer.get_new_data()[:-2]).T
+            new_imu_data = np.array(imu_buffer.get_new_data()).T
+            if args.session is not None and new_imu_data.shape[0] != 0:
+                # device timestamp (ms), host time of arrival of the last package (ms)
+                session_clock.update(new_imu_data[:, -2], new_imu_data[-1, -1] / 1000)
+            new_imu_data = new_imu_data[:, :-2]
+            if imu_aligner is not None and new_imu_data.shape[0] != 0:
+                clock = imu_listener.clock if args.session is None else session_clock
+                imu_aligner.set_rates(clock.get_sample_rate(), FRAME_RATE_PPG)
+                new_imu_data = imu_aligner.process(new_imu_data)
             time_start = time.time()
             if new_imu_data.shape[0] != 0:
                 imu_queue.extend(new_imu_data)
-                heuristic_gyro_offset = np.array([0,0,0])#np.array([10.7,-9,2.7])
-                new_imu_data[:,3:] = new_imu_data[:,3:] - heuristic_gyro_offset
                 orientation_filter.update_imu_values(new_imu_data)
                 events = event_filter.update_batch(new_imu_data[:,:3])
+                activity_gate.update_batch(new_imu_data[:,:3])
                 #if len(events) > 0:
                 #    print(events)
                 
@@ -424,24 +491,44 @@ if __name__ == '__main__':
                     print("Started inference")
                     started_inference = True
                 
-                sample = prepare_data(ppg_data = None, imu_data = imu_data, window_size=window_size)
+                model_imu_data = imu_data
+                if imu_manager is not None:
+                    # the primary device on the grid shared with the other IMUs
+                    _, aligned = imu_manager.get_aligned(window_size)
+                    if aligned is None:
+                        continue
+                    model_imu_data = aligned[primary_imu]
+                sample = prepare_data(ppg_data = None, imu_data = model_imu_data, window_size=window_size)
                 if sample is None:
                     continue
             
-                with torch.no_grad():
-                    output,_,_,xf = model(sample)
-                    output = torch.nn.functional.softmax(output, dim=1).squeeze().numpy()
-                    output = probability_mapping(output)
+                if args.activity_threshold < 0 or activity_gate.should_infer():
+                    with torch.no_grad():
+                        output,_,_,xf = model(sample)
+                        output = torch.nn.functional.softmax(output, dim=1).squeeze().numpy()
+                        output = probability_mapping(output)
+                else:
+                    # the wrist is still, skip the model
+                    output = activity_gate.idle_observation(n_classes - 1)
                     
                     
-                filtered_output = filter.update(np.append(output, [0]))
+                if smoother is None:
+                    filtered_output = filter.update(np.append(output, [0]))
+                    decision_output = filtered_output
+                    decision_events = events
+                else:
+                    smoothed = smoother.update(np.append(output, [0]))
+                    pending_events.append(events)
+                    filtered_output = filter.current_belief
+                    decision_output = smoothed[1] if smoothed is not None else None
+                    decision_events = pending_events[0]
                 #print(filtered_output)
                                     
                 pred_gesture = output.argmax()
                 pred_gesture_filtered = filtered_output.argmax()
                 #print(pred_gesture, filtered_output)
                 
-                filtered_gesture = prediction_filter.update(filtered_output, events)
+                filtered_gesture = prediction_filter.update(decision_output, decision_events) if decision_output is not None else 0
                 
                 #orientation_history = np.array(orientation_filter.get_rotation_history())
                 #if len(orientation_history) > 0:
@@ -454,7 +541,9 @@ if __name__ == '__main__':
                     probability = filtered_output, 
                     filtered_gesture = LABEL_TO_GESTURE[filtered_gesture], 
                     orientation = np.array(orientation_filter.get_rotation_history()),
-                    rotation = delta_rotation
+                    rotation = delta_rotation,
+                    activity = activity_gate.get_counters(),
+                    link = None if args.session is not None else imu_manager.get_link_summary() if imu_manager is not None else {**imu_listener.link_stats.summary(), "clock": imu_listener.clock.summary()}
                     )
                 #update_latest_data(imu_data, LABEL_TO_GESTURE[pred_gesture], output[pred_gesture], output)
                 
@@ -466,11 +555,6 @@ if __name__ == '__main__':
                     print("Stopped inference")
                     started_inference = False
                     last_inf_time = time.time()
-                    
-            # Control the loop timing
-            sleep_time = inference_period - (time.time() - start_time)
-            if sleep_time > 0:
-                time.sleep(sleep_time)
             
        
 
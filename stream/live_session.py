@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import struct
+import numpy as np
+from PPG.notification_parser import mask_invalid
+
+LIVE_MAGIC = b"WPPGLIV1"
+HEADER_SIZE = 4096
+COUNTER_OFFSET = 3072  # the counters of the streams, then the state, after the json header
+STATE_LIVE = 1
+STATE_CLOSED = 2
+
+
+def _stream_layout(streams, max_samples, dtype):
+    layout = {}
+    offset = HEADER_SIZE
+    for name, fields in streams.items():
+        n_samples = int(max_samples[name] if isinstance(max_samples, dict) else max_samples)
+        layout[name] = {"fields": list(fields), "max_samples": n_samples, "offset": offset}
+        offset += len(fields) * n_samples * np.dtype(dtype).itemsize
+    return layout, offset
+
+
+class LiveSessionWriter:
+    def __init__(self, path, streams, max_samples=128 * 3600 * 4, dtype=np.float64, metadata=None):
+        """
+        Append-only, memory-mapped columnar file of a live session. Every stream (ppg, imu, ...) has one
+        preallocated column per field and a sequence counter in the header, which is advanced after the samples are
+        written. Any number of LiveSessionReader in other processes can tail the file zero-copy, and after close it
+        is the recording of the session.
+
+        :param path: File to write (.live)
+        :param streams: Dict of stream name to field names
+        :param max_samples: Capacity per stream (int or dict per stream), samples beyond it are dropped and counted
+        :param dtype: Data type of the columns
+        :param metadata: Additional entries for the header
+        """
+        self.path = path
+        self.layout, size = _stream_layout(streams, max_samples, dtype)
+        self.names = list(self.layout)
+        self.header = {"streams": self.layout, "dtype": np.dtype(dtype).str, "start_time": time.time()}
+        self.header.update(metadata or {})
+        assert COUNTER_OFFSET + 8 * (len(self.names) + 1) <= HEADER_SIZE, "Too many streams"
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(self._encode_header().ljust(HEADER_SIZE, b"\0"))
+            f.truncate(size)
+        self.map = np.memmap(path, dtype=np.uint8, mode="r+")
+        self.counters = np.ndarray((len(self.names) + 1,), dtype="<u8", buffer=self.map, offset=COUNTER_OFFSET)
+        self.columns = {name: np.ndarray((len(entry["fields"]), entry["max_samples"]), dtype=dtype, buffer=self.map,
+                                         offset=entry["offset"]) for name, entry in self.layout.items()}
+        self.n_dropped = {name: 0 for name in self.names}
+        self.counters[-1] = STATE_LIVE
+
+    def _encode_header(self):
+        header = json.dumps(self.header).encode()
+        assert len(header) + 12 <= COUNTER_OFFSET, "Header metadata too large"
+        return (LIVE_MAGIC + struct.pack("<I", len(header)) + header).ljust(COUNTER_OFFSET, b"\0")
+
+    def update_metadata(self, entries):
+        """
+        Add or replace header entries during the session, e.g. the PPG-IMU offset of the knock sync.
+        Readers pick them up with LiveSessionReader.metadata.
+        """
+        self.header.update(entries)
+        self.map[:COUNTER_OFFSET] = np.frombuffer(self._encode_header(), dtype=np.uint8)
+
+    def seq(self, name):
+        return int(self.counters[self.names.index(name)])
+
+    def append(self, name, block):
+        """
+        Append a block of whole samples to a stream (one writer per stream).
+
+        :param block: Array of shape (n_samples, n_fields)
+        """
+        block = np.asarray(block)
+        if block.ndim != 2 or block.shape[0] == 0:
+            return
+        i = self.names.index(name)
+        columns = self.columns[name]
+        assert block.shape[1] == columns.shape[0], f"Block must have shape (n, {columns.shape[0]})"
+        seq = int(self.counters[i])
+        n = min(block.shape[0], columns.shape[1] - seq)
+        if n < block.shape[0]:
+            if self.n_dropped[name] == 0:
+                print(f"[Session]: {name} stream is full, samples are dropped")
+            self.n_dropped[name] += block.shape[0] - n
+        columns[:, seq:seq + n] = block[:n].T
+        self.counters[i] = seq + n  # readers only see the samples once they are complete
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.counters[-1] = STATE_CLOSED
+        self.map.flush()
+        del self.counters, self.columns, self.map  # the mapping is released with the last view
+
+
+class LiveSessionReader:
+    def __init__(self, path, poll_interval=0.002):
+        """
+        Read-only view of a live session file, its streams grow while the writer appends.
+
+        :param path: File written by a LiveSessionWriter
+        :param poll_interval: Interval of the counter polling while waiting for samples (s)
+        """
+        self.path = path
+        self.poll_interval = poll_interval
+        self.header = read_live_header(path)
+        self.layout = self.header["streams"]
+        self.names = list(self.layout)
+        self.map = np.memmap(path, dtype=np.uint8, mode="r")
+        self.counters = np.ndarray((len(self.names) + 1,), dtype="<u8", buffer=self.map, offset=COUNTER_OFFSET)
+        self.columns = {name: np.ndarray((len(entry["fields"]), entry["max_samples"]), dtype=self.header["dtype"],
+                                         buffer=self.map, offset=entry["offset"]) for name, entry in self.layout.items()}
+
+    @property
+    def is_live(self):
+        return int(self.counters[-1]) == STATE_LIVE
+
+    def fields(self, name):
+        return self.layout[name]["fields"]
+
+    def metadata(self):
+        """Current header, including the entries updated by the writer since the session started."""
+        self.header = read_live_header(self.path)
+        return self.header
+
+    def seq(self, name):
+        return int(self.counters[self.names.index(name)])
+
+    def get_since(self, name, seq, max_samples=None):
+        """
+        Zero-copy read of the samples of a stream after a sequence number.
+
+        :return: View (n_fields x n_samples) and the sequence number to continue from
+        """
+        end = self.seq(name)
+        if max_samples is not None:
+            end = min(end, seq + max_samples)
+        return self.columns[name][:, seq:end], end
+
+    def latest(self, name, n_samples):
+        end = self.seq(name)
+        return self.columns[name][:, max(0, end - n_samples):end]
+
+    def wait(self, name, seq, timeout=None):
+        """
+        Block until a stream has samples after a sequence number, False if the timeout expired or the session ended.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self.seq(name) <= seq:
+            if not self.is_live or (deadline is not None and time.time() >= deadline):
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+    def reader(self, name, from_start=False):
+        return LiveStreamReader(self, name, from_start=from_start)
+
+    def load(self, name):
+        """All samples of a stream so far, per field (views of the file)."""
+        view, _ = self.get_since(name, 0)
+        return {field: view[i] for i, field in enumerate(self.fields(name))}
+
+
+class LiveStreamReader:
+    def __init__(self, session, name, from_start=False):
+        """
+        Read cursor on one stream of a live session, like RingBufferReader on a ring buffer.
+        """
+        self.session = session
+        self.name = name
+        self.seq = 0 if from_start else session.seq(name)
+
+    def read(self, max_samples=None):
+        """
+        :return: View (n_fields x n_samples) of the samples since the last read
+        """
+        view, self.seq = self.session.get_since(self.name, self.seq, max_samples)
+        return view
+
+    def read_blocking(self, timeout=None, max_samples=None):
+        self.session.wait(self.name, self.seq, timeout)
+        return self.read(max_samples)
+
+    def skip_to_end(self):
+        self.seq = self.session.seq(self.name)
+
+
+class LiveStreamBuffer:
+    def __init__(self, session, name, plotting_length, valid_field=None):
+        """
+        Stand-in for the DataBuffer of a listener (plotting_queues, get_new_data) that reads from a live session,
+        so the visualizer and the inference can attach to the acquisition daemon instead of the sensors.
+
+        :param session: LiveSessionReader
+        :param name: Stream to read
+        :param plotting_length: Number of samples returned by plotting_queues
+        :param valid_field: Field with the validity bitmask of the values (the PPG stream), the invalid values
+                            are NaN in plotting_queues and the mask fields are left out
+        """
+        self.session = session
+        self.name = name
+        self.plotting_length = plotting_length
+        self.new_data_reader = session.reader(name)
+        fields = session.fields(name)
+        self.valid_index = fields.index(valid_field) if valid_field in fields else None
+        self.n_channels = self.valid_index if self.valid_index is not None else len(fields)
+
+    def plotting_queues(self):
+        block = self.session.latest(self.name, self.plotting_length)
+        if self.valid_index is None:
+            return list(np.array(block))
+        values = np.array(block[:self.n_channels])
+        mask_invalid(values[:-1], block[self.valid_index])
+        return list(values)
+
+    def get_new_data(self, timeout=None):
+        block = self.new_data_reader.read_blocking(timeout) if timeout else self.new_data_reader.read()
+        return list(np.array(block))
+
+    def set_recording(self, value):
+        # the session file is the recording
+        pass
+
+
+def read_live_header(path, retries=10):
+    for attempt in range(retries):
+        with open(path, "rb") as f:
+            raw = f.read(COUNTER_OFFSET)
+        assert raw[:len(LIVE_MAGIC)] == LIVE_MAGIC, f"{path} is not a live session file"
+        length = struct.unpack("<I", raw[len(LIVE_MAGIC):len(LIVE_MAGIC) + 4])[0]
+        try:
+            return json.loads(raw[len(LIVE_MAGIC) + 4:len(LIVE_MAGIC) + 4 + length])
+        except ValueError:
+            # read while the writer updated the header
+            if attempt == retries - 1:
+                raise
+            time.sleep(0.001)
@@ -20,6 +20,7 @@ from scipy.signal import butter, lfilter, lfilter_zi
 parser = argparse.ArgumentParser(description='Record Wristband Signal')
 parser.add_argument('--file_index', type=int, default=0, help='recording index')
 parser.add_argument('--sensor_size', type=str, default='M', help='size of the sensor footprint')
+parser.add_argument('--session', type=str, default=None, help='live session file of the acquisition daemon to attach to instead of the sensors')
 args = parser.parse_args()
 
 FRAME_RATE_PPG = 112.22
@@ -178,9 +179,17 @@ def filter_ppg(input_signal):
     return filtered_signal
 
 live_figure = LiveFigure(wlen=WLEN*max(FRAME_RATE_PPG, FRAME_RATE_IMU), n_ppg_channels=N_PPG_CHANNELS)
-wristband_listner = WristbandListener(n_ppg_channels=N_PPG_CHANNELS, window_size=WLEN, csv_window=2,
-                                     frame_rate=FRAME_RATE_PPG, fileindex=args.file_index, bracelet=args.sensor_size)
-imu_listener = BluetoothIMUReader(port = 'COM6', baud_rate=115200, file_index=args.file_index, frame_rate=FRAME_RATE_IMU)
+if args.session is None:
+    wristband_listner = WristbandListener(n_ppg_channels=N_PPG_CHANNELS, window_size=WLEN, csv_window=2,
+                                         frame_rate=FRAME_RATE_PPG, fileindex=args.file_index, bracelet=args.sensor_size)
+    imu_listener = BluetoothIMUReader(port = 'COM6', baud_rate=115200, file_index=args.file_index, frame_rate=FRAME_RATE_IMU)
+    ppg_buffer, imu_buffer = wristband_listner.data_buffer, imu_listener.data_buffer
+else:
+    # the acquisition daemon owns the sensors and records, several viewers can attach
+    from live_session import LiveSessionReader, LiveStreamBuffer
+    session = LiveSessionReader(args.session)
+    ppg_buffer = LiveStreamBuffer(session, "ppg", int((WLEN+1)*FRAME_RATE_PPG + 1), valid_field="valid")
+    imu_buffer = LiveStreamBuffer(session, "imu", int((WLEN+1)*FRAME_RATE_IMU + 1))
 
 
 def calibrate_min_max():
@@ -219,8 +228,8 @@ app.layout = html.Div(
 def update_switch1(on):
     global recording_status
     recording_status = on
-    wristband_listner.data_buffer.set_recording(on)
-    imu_listener.data_buffer.set_recording(on)
+    ppg_buffer.set_recording(on)
+    imu_buffer.set_recording(on)
     return ''
 
 @app.callback(
@@ -229,12 +238,12 @@ def update_switch1(on):
     [dash.dependencies.State('live-graph', 'figure')]
 )
 def update_graph_live(n_intervals, existing_fig):
-    global live_figure, wristband_listner
+    global live_figure
     
-    if len(wristband_listner.data_buffer.plotting_queues()[0]) != 0:
-        live_figure.update_ppg_plots(wristband_listner.data_buffer.plotting_queues())
-    if len(imu_listener.data_buffer.plotting_queues()[0]) != 0:
-        live_figure.update_imu_plots(imu_listener.data_buffer.plotting_queues())
+    if len(ppg_buffer.plotting_queues()[0]) != 0:
+        live_figure.update_ppg_plots(ppg_buffer.plotting_queues())
+    if len(imu_buffer.plotting_queues()[0]) != 0:
+        live_figure.update_imu_plots(imu_buffer.plotting_queues())
     return live_figure.fig
 
 def start_background_process():
@@ -253,8 +262,9 @@ if __name__ == '__main__':
     # Define a handler function
     def signal_handler(sig, frame):
         print("Keyboard interrupt received. Stopping threads...")
-        imu_listener.stop_threads()
-        wristband_listner.stop_threads()
+        if args.session is None:
+            imu_listener.stop_threads()
+            wristband_listner.stop_threads()
         print("Threads stopped.")
         exit(0)
     # Register the signal handler
@@ -262,8 +272,9 @@ if __name__ == '__main__':
 
 
     
-    wristband_listner.start_threads()
-    imu_listener.start_threads()
+    if args.session is None:
+        wristband_listner.start_threads()
+        imu_listener.start_threads()
     app.run(debug=True, port=8048, use_reloader=False)
         
 
@@ -0,0 +1,210 @@
+import time
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def design_filter_bank(half_taps, n_phases, cutoff, beta):
+    """
+    Kaiser windowed sinc interpolation filters at n_phases + 1 fractional delays between two input samples.
+
+    :param half_taps: Taps on each side of the output position
+    :param n_phases: Number of fractional delays per input sample
+    :param cutoff: Cutoff relative to the Nyquist frequency of the input
+    :param beta: Shape of the Kaiser window
+    :return: Tap offsets (2*half_taps) and the filters (n_phases + 1 x 2*half_taps), each with unity DC gain
+    """
+    offsets = np.arange(-half_taps + 1, half_taps + 1)
+    x = offsets[None, :] - np.arange(n_phases + 1)[:, None] / n_phases
+    window = np.i0(beta * np.sqrt(np.clip(1 - (x / half_taps) ** 2, 0, None))) / np.i0(beta)
+    # zero at the ends, so the last phase equals the first phase of the next input sample
+    window[np.abs(x) >= half_taps] = 0
+    bank = cutoff * np.sinc(cutoff * x) * window
+    return offsets, bank / bank.sum(axis=1, keepdims=True)
+
+
+class PolyphaseResampler:
+    def __init__(self, in_rate, out_rate, half_taps=16, n_phases=256, cutoff=0.9, beta=8.0):
+        """
+        Streaming band-limited resampling by an arbitrary (also irrational) ratio. Every output sample is computed
+        with a windowed sinc filter taken from a bank of precomputed phases, interpolated linearly between the two
+        nearest phases. The history and the fractional position are kept across calls, so consecutive blocks give
+        the same result as one call on the whole signal, and the ratio can follow measured rates (set_rates)
+        without a discontinuity. The output lags the input by half_taps input samples.
+
+        :param in_rate: Sample rate of the input (Hz)
+        :param out_rate: Sample rate of the output (Hz)
+        :param half_taps: Zero crossings of the filter on each side, more is sharper and slower
+        :param n_phases: Filter phases per input sample
+        :param cutoff: Passband edge relative to the Nyquist frequency of the lower of the two rates
+        :param beta: Shape of the Kaiser window (stopband attenuation)
+        """
+        self.half_taps = half_taps
+        self.n_phases = n_phases
+        self.cutoff = cutoff
+        self.beta = beta
+        self.scale = None
+        self.set_rates(in_rate, out_rate)
+        self.reset()
+
+    def reset(self):
+        self.buffer = None
+        self.position = 0.0  # of the next output sample, in input samples from the start of the buffer
+        self.n_in = 0
+        self.n_out = 0
+
+    def set_rates(self, in_rate, out_rate):
+        """
+        Change the ratio, e.g. to the rates estimated by a ClockDriftEstimator. The filters are only redesigned
+        when the anti-aliasing cutoff moves by more than 1 %.
+        """
+        if not (np.isfinite(in_rate) and np.isfinite(out_rate) and in_rate > 0 and out_rate > 0):
+            return
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.ratio = in_rate / out_rate  # input samples per output sample
+        scale = min(1.0, 1 / self.ratio)
+        if self.scale is not None and abs(scale / self.scale - 1) < 0.01:
+            return
+        self.scale = scale
+        # when downsampling the filter is stretched, so it keeps its zero crossings per output sample
+        half_taps = int(np.ceil(self.half_taps / scale))
+        self.offsets, self.bank = design_filter_bank(half_taps, self.n_phases, self.cutoff * scale, self.beta)
+        if getattr(self, "buffer", None) is not None and half_taps > self.reach:
+            # more history is needed than kept, extend it with the oldest sample
+            pad = half_taps - self.reach
+            self.buffer = np.concatenate([np.repeat(self.buffer[:1], pad, axis=0), self.buffer])
+            self.position += pad
+        self.reach = half_taps
+
+    @property
+    def delay(self):
+        """Latency of the streaming output (s)."""
+        return self.reach / self.in_rate
+
+    def _interpolate(self, buffer, n_out, chunk_size=2048):
+        out = np.empty((n_out, buffer.shape[1]))
+        if n_out == 0:
+            return out
+        # the filter windows are strided views of the buffer, chunks keep the gathered windows in the cache
+        windows = sliding_window_view(buffer, len(self.offsets), axis=0)
+        for start in range(0, n_out, chunk_size):
+            positions = self.position + np.arange(start, min(n_out, start + chunk_size)) * self.ratio
+            base = np.floor(positions).astype(np.int64)
+            phase = (positions - base) * self.n_phases
+            index = np.minimum(phase.astype(np.int64), self.n_phases - 1)
+            fraction = (phase - index)[:, None]
+            weights = (1 - fraction) * self.bank[index] + fraction * self.bank[index + 1]
+            out[start:start + len(base)] = np.matmul(windows[base + self.offsets[0]], weights[:, :, None])[..., 0]
+        return out
+
+    def _n_available(self, length):
+        # output samples whose filter lies completely inside a buffer of this length
+        last = length - 1 - self.reach
+        if last < self.position:
+            return 0
+        return int(np.floor((last - self.position) / self.ratio)) + 1
+
+    def process(self, block):
+        """
+        Resample the next block of the stream.
+
+        :param block: Array of shape (n_samples, n_channels) or (n_samples,)
+        :return: Resampled samples, (M x n_channels) or (M,)
+        """
+        block = np.asarray(block, dtype=float)
+        vector = block.ndim == 1
+        block = block.reshape(len(block), -1)
+        if len(block) == 0:
+            return np.empty(0) if vector else np.empty((0, block.shape[1]))
+        if self.buffer is None:
+            # the signal is continued before the first sample with its value
+            self.buffer = np.repeat(block[:1], self.reach, axis=0)
+            self.position = float(self.reach)
+        buffer = np.concatenate([self.buffer, block])
+        self.n_in += len(block)
+
+        n_out = self._n_available(len(buffer))
+        out = self._interpolate(buffer, n_out)
+        self.position += n_out * self.ratio
+        self.n_out += n_out
+        drop = max(0, int(np.floor(self.position)) - self.reach + 1)
+        self.buffer = buffer[drop:]
+        self.position -= drop
+        return out[:, 0] if vector else out
+
+    def flush(self):
+        """
+        End of the stream: the output samples up to the last input sample, the signal is continued after it with
+        its value. The resampler is reset.
+
+        :return: Remaining samples (M x n_channels)
+        """
+        if self.buffer is None:
+            return np.empty((0, 0))
+        last = len(self.buffer) - 1
+        buffer = np.concatenate([self.buffer, np.repeat(self.buffer[-1:], self.reach, axis=0)])
+        n_out = int(np.floor((last - self.position) / self.ratio)) + 1 if last >= self.position else 0
+        out = self._interpolate(buffer, n_out)
+        self.reset()
+        return out
+
+
+def resample(x, in_rate, out_rate, axis=0, **kwargs):
+    """
+    Resample a whole signal, all columns at once. The output starts at the first input sample and has
+    floor((N - 1) * out_rate / in_rate) + 1 samples, so output sample i is at time t0 + i / out_rate.
+
+    :param x: Signal with the samples along axis
+    :param in_rate: Sample rate of the input (Hz)
+    :param out_rate: Sample rate of the output (Hz)
+    :param axis: Axis of the samples
+    :param kwargs: Filter parameters of PolyphaseResampler
+    :return: Resampled signal
+    """
+    x = np.moveaxis(np.asarray(x, dtype=float), axis, 0)
+    shape = x.shape
+    if shape[0] == 0:
+        return np.moveaxis(x, 0, axis)
+    resampler = PolyphaseResampler(in_rate, out_rate, **kwargs)
+    flat = x.reshape(shape[0], -1)
+    out = np.concatenate([resampler.process(flat), resampler.flush()])
+    return np.moveaxis(out.reshape((len(out),) + shape[1:]), 0, axis)
+
+
+if __name__ == "__main__":
+    from scipy import signal
+
+    in_rate, out_rate = 112.1, 112.22
+    t = np.arange(int(600 * in_rate)) / in_rate
+    frequencies = np.array([0.5, 2.0, 7.0, 20.0, 40.0])
+    x = np.sin(2 * np.pi * t[:, None] * frequencies + np.arange(len(frequencies)))
+    x = np.tile(x, (1, 4))  # 20 channels, like PPG + IMU
+
+    start = time.perf_counter()
+    y = resample(x, in_rate, out_rate)
+    batch_time = time.perf_counter() - start
+    t_out = np.arange(len(y)) / out_rate
+    expected = np.sin(2 * np.pi * t_out[:, None] * frequencies + np.arange(len(frequencies)))
+    expected = np.tile(expected, (1, 4))
+    # the edges are extrapolated with a constant
+    inner = slice(64, -64)
+    error = np.abs(y[inner] - expected[inner]).max(axis=0)[:len(frequencies)]
+
+    start = time.perf_counter()
+    [signal.resample(x[:, i], len(y)) for i in range(x.shape[1])]
+    fft_time = time.perf_counter() - start
+
+    resampler = PolyphaseResampler(in_rate, out_rate)
+    rng = np.random.default_rng(0)
+    blocks, start = [], 0
+    while start < len(x):
+        size = int(rng.integers(1, 40))
+        blocks.append(resampler.process(x[start:start + size]))
+        start += size
+    streamed = np.concatenate(blocks + [resampler.flush()])
+
+    print(f"{x.shape[0]} x {x.shape[1]} samples, {in_rate} -> {out_rate} Hz")
+    print("max error per frequency: " + ", ".join(f"{f:g} Hz {e:.1e}" for f, e in zip(frequencies, error)))
+    print(f"batch {batch_time * 1000:.0f} ms, scipy.signal.resample per column {fft_time * 1000:.0f} ms")
+    print(f"streamed in random blocks equals batch: {np.allclose(streamed, y)}")
+    print(f"downsampled to 50 Hz: {resample(x, in_rate, 50.0).shape}, upsampled to 128 Hz: {resample(x, in_rate, 128.0).shape}")
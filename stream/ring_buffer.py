@@ -0,0 +1,131 @@
+import threading
+import numpy as np
+
+
+class SampleRingBuffer:
+    def __init__(self, fields, capacity, dtype=np.float64):
+        """
+        Columnar ring buffer of whole samples with a monotonically increasing sequence number.
+        Every column is stored twice (mirrored), so any range of up to capacity samples is a
+        contiguous block and reads never have to copy.
+
+        :param fields: Names of the channels of a sample
+        :param capacity: Number of samples kept
+        :param dtype: Data type of the samples
+        """
+        self.fields = list(fields)
+        self.field_index = {name: i for i, name in enumerate(self.fields)}
+        self.capacity = int(capacity)
+        self.data = np.zeros((len(self.fields), 2 * self.capacity), dtype=dtype)
+        self.seq = 0  # number of samples written so far
+        self.lock = threading.Lock()
+        self.new_data = threading.Condition(self.lock)  # notified after every write
+
+    @property
+    def n_channels(self):
+        return len(self.fields)
+
+    def write(self, block):
+        """
+        Append a block of whole samples.
+
+        :param block: Array of shape (n_samples, n_channels)
+        """
+        block = np.asarray(block)
+        assert block.ndim == 2 and block.shape[1] == self.n_channels, f"Block must have shape (n, {self.n_channels})"
+        with self.lock:
+            n = block.shape[0]
+            if n > self.capacity:
+                self.seq += n - self.capacity
+                block = block[-self.capacity:]
+                n = self.capacity
+            start = self.seq % self.capacity
+            first = min(n, self.capacity - start)
+            rest = n - first
+            for offset in (0, self.capacity):
+                self.data[:, offset + start:offset + start + first] = block[:first].T
+                if rest:
+                    self.data[:, offset:offset + rest] = block[first:].T
+            self.seq += n
+            self.new_data.notify_all()
+
+    def wait(self, seq, timeout=None):
+        """
+        Block until samples after a sequence number are written.
+
+        :return: False if the timeout expired first
+        """
+        with self.new_data:
+            return self.new_data.wait_for(lambda: self.seq > seq, timeout)
+
+    def get_since(self, seq, max_samples=None):
+        """
+        Read all samples written after a sequence number.
+
+        :param seq: Sequence number of the first sample to read (as returned by the previous read)
+        :param max_samples: Optional maximum number of samples to return (the oldest ones are returned)
+        :return: View of shape (n_channels, n_samples), the sequence number to continue from and
+                 whether samples were overwritten before they were read
+        """
+        with self.lock:
+            end = self.seq
+        oldest = max(0, end - self.capacity)
+        overrun = seq < oldest
+        start = max(seq, oldest)
+        if max_samples is not None:
+            end = min(end, start + max_samples)
+        idx = start % self.capacity
+        return self.data[:, idx:idx + end - start], end, overrun
+
+    def latest(self, n_samples):
+        """
+        View of the most recent samples, shape (n_channels, <= n_samples).
+        """
+        with self.lock:
+            end = self.seq
+        view, _, _ = self.get_since(max(0, end - n_samples))
+        return view[:, -n_samples:] if n_samples else view[:, :0]
+
+    def column(self, view, name):
+        return view[self.field_index[name]]
+
+    def reader(self, from_start=False):
+        return RingBufferReader(self, from_start=from_start)
+
+
+class RingBufferReader:
+    def __init__(self, ring, from_start=False):
+        """
+        Independent read cursor of a consumer (inference, visualizer, recorder, ...).
+
+        :param ring: SampleRingBuffer to read from
+        :param from_start: Start with the oldest sample still in the buffer instead of the next new one
+        """
+        self.ring = ring
+        self.seq = 0 if from_start else ring.seq
+        self.n_overruns = 0
+
+    def read(self, max_samples=None):
+        """
+        Read all new samples since the last read.
+
+        :return: View of shape (n_channels, n_samples) and whether samples were lost
+        """
+        view, self.seq, overrun = self.ring.get_since(self.seq, max_samples)
+        if overrun:
+            self.n_overruns += 1
+        return view, overrun
+
+    def wait(self, timeout=None):
+        """Block until new samples are available, False if the timeout expired first."""
+        return self.ring.wait(self.seq, timeout)
+
+    def read_blocking(self, timeout=None, max_samples=None):
+        """
+        Wait for new samples and read them, an empty view if the timeout expired.
+        """
+        self.wait(timeout)
+        return self.read(max_samples)
+
+    def skip_to_end(self):
+        self.seq = self.ring.seq
@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import queue
+import struct
+import threading
+import numpy as np
+
+HEADER_MAGIC = b"WPPGREC1"
+FOOTER_MAGIC = b"WPPGEND1"
+HEADER_SIZE = 4096
+FOOTER_FORMAT = "<8sQd"  # magic, number of records, end time
+FOOTER_SIZE = struct.calcsize(FOOTER_FORMAT)
+INDEX_DTYPE = np.dtype([("n_records", "<u8"), ("first_seq", "<u8"), ("host_time", "<f8")])
+
+
+def record_dtype(fields, dtype="<f8"):
+    """
+    Binary layout of one recorded sample: sequence number, host time of arrival and the typed channels.
+    """
+    return np.dtype([("seq", "<u8"), ("host_time", "<f8")] + [(name, dtype) for name in fields])
+
+
+class SessionRecorder:
+    def __init__(self, path, fields, device="", chunk_size=1024, max_pending_chunks=64, metadata=None, fsync=False,
+                 append=False):
+        """
+        Append-only binary session file written in fixed-size chunks by a background thread.
+        The file is a fixed-size JSON header, the contiguous records and, after a clean close, a footer.
+        Every written chunk is also committed to an index file, so a crashed recording can be read up to its last chunk.
+
+        :param path: File to write (.bin), the index is written to path + ".idx"
+        :param fields: Names of the channels of a sample
+        :param device: Name of the recorded device
+        :param chunk_size: Number of samples per chunk
+        :param max_pending_chunks: Maximum number of chunks waiting for the writer (bounds the memory)
+        :param metadata: Additional entries for the header
+        :param fsync: Force every chunk to disk (survives power loss, costs some write time)
+        :param append: Continue an existing recording of the same fields instead of overwriting it (keeps its header)
+        """
+        self.path = path
+        self.fields = list(fields)
+        self.dtype = record_dtype(self.fields)
+        self.chunk_size = chunk_size
+        self.fsync = fsync
+
+        self.chunk = np.zeros(chunk_size, dtype=self.dtype)
+        self.chunk_fill = 0
+        self.next_seq = 0
+        self.n_records = 0
+        self.n_dropped = 0
+        self.pending = queue.Queue(maxsize=max_pending_chunks)
+
+        header = {
+            "device": device,
+            "fields": self.fields,
+            "dtype": self.dtype.descr,
+            "chunk_size": chunk_size,
+            "start_time": time.time(),
+        }
+        header.update(metadata or {})
+        self.header = header
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if append and os.path.isfile(path):
+            self.header = read_header(path)
+            assert self.header["fields"] == self.fields, f"{path} was recorded with other fields"
+            self.n_records, _ = count_records(path, self.dtype)
+            self.file = open(path, "r+b")
+            # the records continue where the last segment ended, over its footer
+            self.file.truncate(HEADER_SIZE + self.n_records * self.dtype.itemsize)
+            self.file.seek(0, os.SEEK_END)
+            self.index_file = open(path + ".idx", "ab")
+        else:
+            self.file = open(path, "wb")
+            self.file.write(self._encode_header())
+            self.file.flush()
+            self.index_file = open(path + ".idx", "wb")
+
+        self.writer_thread = threading.Thread(target=self._writer, daemon=True)
+        self.writer_thread.start()
+
+    def _encode_header(self):
+        header = json.dumps(self.header).encode()
+        assert len(header) + 12 <= HEADER_SIZE, "Header metadata too large"
+        return (HEADER_MAGIC + struct.pack("<I", len(header)) + header).ljust(HEADER_SIZE, b"\0")
+
+    def update_metadata(self, entries):
+        """
+        Add or replace header entries while recording, e.g. the PPG-IMU offset once it is known.
+        The header has a fixed size, so it is rewritten in place next to the records.
+        """
+        self.header.update(entries)
+        raw = self._encode_header()
+        with open(self.path, "r+b") as f:
+            f.write(raw)
+
+    def write(self, block, first_seq=None, host_time=None):
+        """
+        Add a block of samples. Never blocks: if the writer falls behind, whole chunks are dropped and counted.
+
+        :param block: Array of shape (n_samples, n_channels)
+        :param first_seq: Sequence number of the first sample (continues the last one if None)
+        :param host_time: Host time of arrival, per sample or of the whole block (now if None)
+        """
+        block = np.asarray(block, dtype=float)
+        if block.ndim != 2 or block.shape[0] == 0:
+            return
+        if first_seq is not None:
+            self.next_seq = first_seq
+        host_time = np.broadcast_to(time.time() if host_time is None else host_time, block.shape[:1])
+
+        offset = 0
+        while offset < block.shape[0]:
+            n = min(block.shape[0] - offset, self.chunk_size - self.chunk_fill)
+            target = self.chunk[self.chunk_fill:self.chunk_fill + n]
+            target["seq"] = np.arange(self.next_seq, self.next_seq + n)
+            target["host_time"] = host_time[offset:offset + n]
+            for i, name in enumerate(self.fields):
+                target[name] = block[offset:offset + n, i]
+            self.chunk_fill += n
+            self.next_seq += n
+            offset += n
+            if self.chunk_fill == self.chunk_size:
+                self._commit_chunk()
+
+    def _commit_chunk(self):
+        if self.chunk_fill == 0:
+            return
+        try:
+            self.pending.put_nowait(self.chunk[:self.chunk_fill].copy())
+        except queue.Full:
+            self.n_dropped += self.chunk_fill
+        self.chunk_fill = 0
+
+    def _writer(self):
+        while True:
+            chunk = self.pending.get()
+            if chunk is None:
+                break
+            self.file.write(chunk.tobytes())
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.n_records += len(chunk)
+            entry = np.array([(self.n_records, chunk["seq"][0], chunk["host_time"][0])], dtype=INDEX_DTYPE)
+            self.index_file.write(entry.tobytes())
+            self.index_file.flush()
+
+    def close(self):
+        """
+        Write the remaining samples and the footer.
+        """
+        self._commit_chunk()
+        self.pending.put(None)
+        self.writer_thread.join()
+        self.file.write(struct.pack(FOOTER_FORMAT, FOOTER_MAGIC, self.n_records, time.time()))
+        self.file.close()
+        self.index_file.close()
+        if self.n_dropped:
+            print(f"[Recorder]: {self.n_dropped} samples dropped, writer too slow")
+
+
+def read_header(path):
+    with open(path, "rb") as f:
+        raw = f.read(HEADER_SIZE)
+    assert raw[:len(HEADER_MAGIC)] == HEADER_MAGIC, f"{path} is not a session recording"
+    length = struct.unpack("<I", raw[len(HEADER_MAGIC):len(HEADER_MAGIC) + 4])[0]
+    return json.loads(raw[len(HEADER_MAGIC) + 4:len(HEADER_MAGIC) + 4 + length])
+
+
+def count_records(path, dtype):
+    """
+    Number of complete records of a session file: up to the footer, or up to the last chunk committed to the index
+    for a crashed recording.
+
+    :return: Number of records and the end time of the footer (None if not closed)
+    """
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        f.seek(max(HEADER_SIZE, file_size - FOOTER_SIZE))
+        tail = f.read(FOOTER_SIZE)
+    if len(tail) == FOOTER_SIZE and tail[:len(FOOTER_MAGIC)] == FOOTER_MAGIC:
+        _, n_records, end_time = struct.unpack(FOOTER_FORMAT, tail)
+        return n_records, end_time
+    if os.path.isfile(path + ".idx") and os.path.getsize(path + ".idx") >= INDEX_DTYPE.itemsize:
+        index = np.fromfile(path + ".idx", dtype=INDEX_DTYPE, count=os.path.getsize(path + ".idx") // INDEX_DTYPE.itemsize)
+        n_records = int(index["n_records"][-1])
+        print(f"[Recorder]: {path} was not closed, recovered {n_records} records from the index")
+        return n_records, None
+    return (file_size - HEADER_SIZE) // dtype.itemsize, None
+
+
+def load_session(path):
+    """
+    Memory-map a recorded session without reading it.
+    Complete recordings are read up to the footer, crashed ones up to the last chunk committed to the index.
+
+    :param path: Session file (.bin)
+    :return: Structured array of the records (seq, host_time and the channels) and the header metadata
+    """
+    header = read_header(path)
+    dtype = np.dtype([tuple(field) for field in header["dtype"]])
+    n_records, end_time = count_records(path, dtype)
+    if end_time is not None:
+        header["end_time"] = end_time
+
+    if n_records == 0:
+        return np.zeros(0, dtype=dtype), header
+    return np.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(n_records,)), header
+
+
+class RotatingSessionRecorder:
+    def __init__(self, prefix, fields, device="", max_bytes=256 * 2**20, max_seconds=3600, metadata=None, **kwargs):
+        """
+        SessionRecorder that continues in a new file (prefix_000.bin, prefix_001.bin, ...) once the current one
+        exceeds a size or a duration. The sequence numbers continue across the files.
+
+        :param prefix: Path of the files without the part number
+        :param fields: Names of the channels of a sample
+        :param device: Name of the recorded device
+        :param max_bytes: Maximum size of one file (None = unlimited)
+        :param max_seconds: Maximum duration of one file (None = unlimited)
+        :param metadata: Additional entries for the headers
+        :param kwargs: Passed to SessionRecorder
+        """
+        self.prefix = prefix
+        self.fields = list(fields)
+        self.device = device
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.metadata = dict(metadata or {})
+        self.kwargs = kwargs
+        self.itemsize = record_dtype(self.fields).itemsize
+
+        self.paths = []
+        self.recorder = None
+        self.next_seq = 0
+        self.n_dropped = 0
+        self._open_part()
+
+    def _open_part(self):
+        path = f"{self.prefix}_{len(self.paths):03d}.bin"
+        metadata = dict(self.metadata, part=len(self.paths), first_seq=self.next_seq)
+        self.recorder = SessionRecorder(path, self.fields, device=self.device, metadata=metadata, **self.kwargs)
+        self.recorder.next_seq = self.next_seq
+        self.part_start = time.time()
+        self.part_samples = 0
+        self.paths.append(path)
+
+    def write(self, block, host_time=None):
+        block = np.asarray(block, dtype=float)
+        if block.ndim != 2 or block.shape[0] == 0:
+            return
+        self.recorder.write(block, host_time=host_time)
+        self.next_seq = self.recorder.next_seq
+        self.part_samples += block.shape[0]
+
+        too_large = self.max_bytes is not None and HEADER_SIZE + self.part_samples * self.itemsize >= self.max_bytes
+        too_long = self.max_seconds is not None and time.time() - self.part_start >= self.max_seconds
+        if too_large or too_long:
+            self.rotate()
+
+    def update_metadata(self, entries):
+        # the following parts start with the entries as well
+        self.metadata.update(entries)
+        self.recorder.update_metadata(entries)
+
+    def rotate(self):
+        self.recorder.close()
+        self.n_dropped += self.recorder.n_dropped
+        self._open_part()
+
+    def close(self):
+        self.recorder.close()
+        self.n_dropped += self.recorder.n_dropped
+
+    @property
+    def path(self):
+        return self.paths[-1]
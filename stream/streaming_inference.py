@@ -0,0 +1,282 @@
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+# Layers that act on every time step independently (in eval mode)
+POINTWISE_LAYERS = (nn.ReLU, nn.LeakyReLU, nn.ELU, nn.GELU, nn.SiLU, nn.Tanh, nn.Sigmoid,
+                    nn.Identity, nn.Dropout, nn.BatchNorm1d)
+
+
+class StreamingLayer:
+    def __init__(self, module):
+        """
+        Temporal geometry of a single layer: output column j reads the padded input columns
+        [j*stride, j*stride + dilation*(kernel_size-1)].
+
+        :param module: Conv1d, MaxPool1d, AvgPool1d or a pointwise layer
+        """
+        self.module = module
+        self.kernel_size, self.stride, self.padding, self.dilation = 1, 1, 0, 1
+        self.pad_value = 0.0
+
+        if isinstance(module, nn.Conv1d):
+            if module.padding_mode != "zeros" or isinstance(module.padding, str):
+                raise ValueError(f"Streaming only supports integer zero padding, got {module.padding}")
+            self.kernel_size, self.stride = module.kernel_size[0], module.stride[0]
+            self.padding, self.dilation = module.padding[0], module.dilation[0]
+        elif isinstance(module, (nn.MaxPool1d, nn.AvgPool1d)):
+            if module.ceil_mode:
+                raise ValueError("Streaming does not support ceil_mode pooling")
+            if isinstance(module, nn.AvgPool1d) and not module.count_include_pad:
+                raise ValueError("Streaming does not support AvgPool1d with count_include_pad=False")
+            as_int = lambda v: v[0] if isinstance(v, tuple) else v
+            self.kernel_size, self.stride = as_int(module.kernel_size), as_int(module.stride)
+            self.padding = as_int(module.padding)
+            self.dilation = as_int(getattr(module, "dilation", 1))
+            if isinstance(module, nn.MaxPool1d):
+                self.pad_value = -np.inf
+        elif not isinstance(module, POINTWISE_LAYERS):
+            raise ValueError(f"Layer {type(module).__name__} is not supported by the streaming execution")
+
+    def output_length(self, input_length):
+        return (input_length + 2 * self.padding - self.dilation * (self.kernel_size - 1) - 1) // self.stride + 1
+
+    def forward_columns(self, x, start, stop):
+        """
+        Compute the output columns [start, stop) from the full (unpadded) layer input.
+        """
+        if stop <= start:
+            return None
+        lo = start * self.stride
+        hi = (stop - 1) * self.stride + self.dilation * (self.kernel_size - 1) + 1
+        x = F.pad(x, (self.padding, self.padding), value=self.pad_value)[..., lo:hi]
+
+        module = self.module
+        if isinstance(module, nn.Conv1d):
+            return F.conv1d(x, module.weight, module.bias, stride=self.stride, dilation=self.dilation, groups=module.groups)
+        if isinstance(module, nn.MaxPool1d):
+            return F.max_pool1d(x, self.kernel_size, self.stride, 0, self.dilation)
+        if isinstance(module, nn.AvgPool1d):
+            return F.avg_pool1d(x, self.kernel_size, self.stride, 0)
+        return module(x)
+
+
+def _flatten_layers(layers):
+    flat = []
+    for layer in layers:
+        if isinstance(layer, nn.Sequential):
+            flat.extend(_flatten_layers(layer))
+        else:
+            flat.append(layer)
+    return flat
+
+
+class StreamingConvStack:
+    def __init__(self, layers, window_size=150, stride=32):
+        """
+        Incremental execution of a stack of temporal layers over a sliding window.
+        Intermediate activations are cached across stride steps, every update only computes the output
+        columns whose receptive field touches the new samples or the (shifted) zero padding.
+        The layers must be in eval mode.
+
+        :param layers: nn.Sequential or list of supported layers
+        :param window_size: Number of samples in one window
+        :param stride: Number of new samples per update
+        """
+        self.layers = [StreamingLayer(layer) for layer in _flatten_layers(layers)]
+        self.window_size = window_size
+        self.stride = stride
+
+        # Per layer: range of output columns that are shifted copies of the cached ones.
+        # Input columns [clean_start, clean_stop) of a layer are shifted copies as well, the others changed.
+        self.reuse = []
+        length, shift = window_size, stride
+        clean_start, clean_stop = 0, window_size - stride
+        for layer in self.layers:
+            out_length = layer.output_length(length)
+            if shift % layer.stride != 0:
+                raise ValueError(f"Stride {stride} is not compatible with the downsampling of the layers")
+            out_shift = shift // layer.stride
+            first = min(-(-(clean_start + layer.padding) // layer.stride), out_length)
+            last = (clean_stop - 1 + layer.padding - layer.dilation * (layer.kernel_size - 1)) // layer.stride + 1
+            last = max(first, min(last, out_length - out_shift))
+            self.reuse.append((first, last, out_shift, out_length))
+            length, shift = out_length, out_shift
+            clean_start, clean_stop = first, last
+
+        self.window = None
+        self.activations = None
+        self.n_computed_columns = 0
+        self.n_total_columns = 0
+
+    def reset(self):
+        self.window = None
+        self.activations = None
+
+    @torch.no_grad()
+    def forward_full(self, window):
+        """
+        Run the full window through all layers and fill the caches.
+
+        :param window: Tensor of shape (batch, channels, window_size)
+        :return: Output features of the last layer
+        """
+        assert window.shape[-1] == self.window_size, f"Window must have {self.window_size} samples"
+        self.window = window
+        self.activations = []
+        x = window
+        for layer in self.layers:
+            x = layer.module(x)
+            self.activations.append(x)
+        return x
+
+    @torch.no_grad()
+    def update(self, new_samples):
+        """
+        Shift the window by the new samples and update the cached activations.
+
+        :param new_samples: Tensor of shape (batch, channels, stride)
+        :return: Output features of the last layer
+        """
+        assert new_samples.shape[-1] == self.stride, f"Updates must have {self.stride} samples"
+        x = torch.cat([self.window[..., self.stride:], new_samples], dim=-1)
+        if self.activations is None:
+            return self.forward_full(x)
+        self.window = x
+
+        for idx, (layer, (first, last, out_shift, out_length)) in enumerate(zip(self.layers, self.reuse)):
+            cached = self.activations[idx]
+            parts = [layer.forward_columns(x, 0, first),
+                     cached[..., first + out_shift:last + out_shift],
+                     layer.forward_columns(x, last, out_length)]
+            x = torch.cat([part for part in parts if part is not None], dim=-1)
+            self.activations[idx] = x
+            self.n_computed_columns += out_length - (last - first)
+            self.n_total_columns += out_length
+        return x
+
+
+class StreamingGestureModel:
+    def __init__(self, encoders, head, window_size=150, stride=32, normalization="running", norm_momentum=0.01):
+        """
+        Streaming execution of a multi-sensor gesture model: one StreamingConvStack per sensor and a head on the features.
+        Per-window z-scoring (as in prepare_data) changes every cached column on each step, so the streaming mode
+        either normalizes the new samples with running statistics ("running") or not at all ("none").
+        The deviation from the full-window forward pass is measured with validate_streaming.
+
+        :param encoders: Dict of sensor name to temporal layer stack
+        :param head: Callable mapping the dict of features to the logits
+        :param window_size: Number of samples in one window
+        :param stride: Number of new samples per update
+        :param normalization: "running" or "none"
+        :param norm_momentum: Momentum of the running mean and variance
+        """
+        assert normalization in ("running", "none"), f"Unknown normalization {normalization}"
+        self.stacks = {name: StreamingConvStack(layers, window_size, stride) for name, layers in encoders.items()}
+        self.head = head
+        self.window_size = window_size
+        self.stride = stride
+        self.normalization = normalization
+        self.norm_momentum = norm_momentum
+        self.mean = {}
+        self.var = {}
+
+    def _normalize(self, name, samples, init=False):
+        if self.normalization == "none":
+            return samples
+        if init or name not in self.mean:
+            self.mean[name] = samples.mean(axis=0)
+            self.var[name] = samples.var(axis=0) + 1e-6
+        else:
+            self.mean[name] = (1 - self.norm_momentum) * self.mean[name] + self.norm_momentum * samples.mean(axis=0)
+            self.var[name] = (1 - self.norm_momentum) * self.var[name] + self.norm_momentum * samples.var(axis=0)
+        return (samples - self.mean[name]) / np.sqrt(self.var[name])
+
+    @staticmethod
+    def _to_tensor(samples):
+        return torch.Tensor(samples).T.unsqueeze(0)
+
+    @torch.no_grad()
+    def forward_full(self, windows):
+        """
+        Initialize all caches with full windows.
+
+        :param windows: Dict of sensor name to array (window_size x channels)
+        """
+        features = {name: stack.forward_full(self._to_tensor(self._normalize(name, windows[name], init=True)))
+                    for name, stack in self.stacks.items()}
+        return self.head(features)
+
+    @torch.no_grad()
+    def update(self, new_samples):
+        """
+        Advance all sensors by one stride.
+
+        :param new_samples: Dict of sensor name to array (stride x channels)
+        """
+        features = {name: stack.update(self._to_tensor(self._normalize(name, new_samples[name])))
+                    for name, stack in self.stacks.items()}
+        return self.head(features)
+
+    def get_saved_fraction(self):
+        computed = sum(stack.n_computed_columns for stack in self.stacks.values())
+        total = sum(stack.n_total_columns for stack in self.stacks.values())
+        return 1 - computed / total if total else 0.0
+
+
+def window_zscore(window):
+    return (window - window.mean(axis=0)) / window.std(axis=0)
+
+
+@torch.no_grad()
+def validate_streaming(encoders, head, signals, window_size=150, stride=32, normalization="none"):
+    """
+    Compare the streaming execution with the full-window forward pass over a recorded signal.
+    With normalization "none" both paths see the same input and must agree up to float rounding;
+    with "running" the full path uses per-window z-scoring like prepare_data, and the deviation is reported.
+
+    :param encoders: Dict of sensor name to temporal layer stack
+    :param head: Callable mapping the dict of features to the logits
+    :param signals: Dict of sensor name to array (n_samples x channels)
+    :return: Maximum absolute deviation of the softmax outputs and the fraction of saved columns
+    """
+    streaming = StreamingGestureModel(encoders, head, window_size, stride, normalization=normalization)
+    n_samples = min(signal.shape[0] for signal in signals.values())
+    preprocess = window_zscore if normalization == "running" else (lambda window: window)
+
+    max_deviation = 0.0
+    for end in range(window_size, n_samples + 1, stride):
+        if end == window_size:
+            streamed = streaming.forward_full({name: signal[:end] for name, signal in signals.items()})
+        else:
+            streamed = streaming.update({name: signal[end - stride:end] for name, signal in signals.items()})
+        features = {name: nn.Sequential(*_flatten_layers(layers))(StreamingGestureModel._to_tensor(preprocess(signals[name][end - window_size:end])))
+                    for name, layers in encoders.items()}
+        full = head(features)
+        deviation = (F.softmax(streamed, dim=1) - F.softmax(full, dim=1)).abs().max().item()
+        max_deviation = max(max_deviation, deviation)
+
+    print(f"[Streaming]: max deviation {max_deviation:.2e}, saved {streaming.get_saved_fraction()*100:.1f} % of the conv columns")
+    return max_deviation, streaming.get_saved_fraction()
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    np.random.seed(0)
+    encoders = {
+        sensor: nn.Sequential(
+            nn.Conv1d(3, 16, kernel_size=9, padding=4), nn.BatchNorm1d(16), nn.ReLU(),
+            nn.MaxPool1d(2),
+            nn.Conv1d(16, 32, kernel_size=5, padding=2, dilation=2), nn.ReLU(),
+            nn.Conv1d(32, 32, kernel_size=3), nn.ReLU(),
+        ).eval()
+        for sensor in ["accel", "gyro"]
+    }
+    linear = nn.Linear(2 * 32, 9)
+    head = lambda features: linear(torch.cat([f.mean(dim=-1) for f in features.values()], dim=1))
+
+    signals = {sensor: np.cumsum(np.random.normal(size=(2000, 3)), axis=0) for sensor in encoders}
+    validate_streaming(encoders, head, signals, normalization="none")
+    validate_streaming(encoders, head, signals, normalization="running")